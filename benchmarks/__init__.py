@@ -0,0 +1,4 @@
+"""Offline benchmark harness for the feed amalgamator.
+
+Everything in this package runs against local fake Mastodon instances (see fake_mastodon.py), so performance
+can be measured without tokens for, or network access to, real Mastodon servers"""
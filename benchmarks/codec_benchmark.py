@@ -0,0 +1,107 @@
+"""Benchmarks for the encodings of stored and cached timelines, on timelines generated by a fake Mastodon instance.
+
+Run from the repository root:
+
+    python -m benchmarks.codec_benchmark --posts 40 --timelines 50 --json codec_output.json
+
+Every encoding encodes and decodes the same timelines. The report shows the time per timeline and the size per post"""
+
+import argparse
+import gc
+import json
+import pickle
+import sys
+import time
+from collections.abc import Callable
+from datetime import datetime
+
+from benchmarks.fake_mastodon import FakeMastodonServer
+from feed_amalgamator.helpers.post_view import PostView
+from feed_amalgamator.helpers.timeline_codec import decode_timeline, encode_timeline
+
+
+def generate_timelines(num_timelines: int, num_posts: int, reblog_ratio: float) -> list[list[PostView]]:
+    """Timelines of a fake server, standardized the way Mastodon.py and the data interface would"""
+    with FakeMastodonServer(name="codec.fake", timeline_size=num_posts, reblog_ratio=reblog_ratio) as server:
+        raw_timelines = [server.get_timeline("token{t}".format(t=t), "home") for t in range(num_timelines)]
+        server_domain = server.base_url
+
+    def standardize(status: dict) -> dict:
+        status = dict(status, id=int(status["id"]), created_at=datetime.fromisoformat(status["created_at"]))
+        if status["reblog"] is not None:
+            status["reblog"] = standardize(status["reblog"])
+        return status
+    return [[PostView.from_status(standardize(status), server_domain) for status in timeline]
+            for timeline in raw_timelines]
+
+
+ENCODINGS = {
+    "json": (lambda posts: json.dumps([post.to_dict() for post in posts]).encode("utf-8"),
+             lambda payload: [PostView.from_dict(post) for post in json.loads(payload)]),
+    "pickle": (pickle.dumps, pickle.loads),
+    "codec": (encode_timeline, decode_timeline),
+    "codec_compressed": (lambda posts: encode_timeline(posts, compress=True), decode_timeline),
+}
+"""Encoding name -> (encode, decode). json is how timelines were stored before timeline_codec"""
+
+
+def benchmark_encoding(encode: Callable[[list[PostView]], bytes], decode: Callable[[bytes], list[PostView]],
+                       timelines: list[list[PostView]], rounds: int) -> dict:
+    """
+    :return: Milliseconds to encode and to decode a timeline, bytes per post, and whether decoding restored every
+    timeline as it was
+    """
+    gc.collect()
+    gc.disable()  # Like timeit, so that collections triggered by earlier encodings do not skew later ones
+    try:
+        start = time.perf_counter()
+        for _ in range(rounds):
+            payloads = [encode(timeline) for timeline in timelines]
+        encode_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(rounds):
+            decoded = [decode(payload) for payload in payloads]
+        decode_time = time.perf_counter() - start
+    finally:
+        gc.enable()
+    num_timelines = rounds * len(timelines)
+    return {
+        "encode_ms": encode_time / num_timelines * 1000,
+        "decode_ms": decode_time / num_timelines * 1000,
+        "bytes_per_post": sum(map(len, payloads)) / max(sum(map(len, timelines)), 1),
+        "round_trips": decoded == timelines,
+    }
+
+
+def format_report(summaries: dict[str, dict]) -> str:
+    lines = ["{n:<18} {e:>10} {d:>10} {b:>14}".format(n="encoding", e="encode_ms", d="decode_ms", b="bytes/post")]
+    for name, summary in summaries.items():
+        lines.append("{n:<18} {e:>10.3f} {d:>10.3f} {b:>14.1f}{w}".format(
+            n=name, e=summary["encode_ms"], d=summary["decode_ms"], b=summary["bytes_per_post"],
+            w="" if summary["round_trips"] else "  (does not round trip)"))
+    return "\n".join(lines)
+
+
+def main(argv=None) -> int:
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--encoding", choices=sorted(ENCODINGS), action="append",
+                            help="Encoding to run. Can be repeated. Runs all encodings by default")
+    arg_parser.add_argument("--timelines", type=int, default=50)
+    arg_parser.add_argument("--posts", type=int, default=40, help="Posts per timeline")
+    arg_parser.add_argument("--reblog-ratio", type=float, default=0.2)
+    arg_parser.add_argument("--rounds", type=int, default=5)
+    arg_parser.add_argument("--json", help="Write the summaries to this file")
+    args = arg_parser.parse_args(argv)
+
+    timelines = generate_timelines(args.timelines, args.posts, args.reblog_ratio)
+    summaries = {name: benchmark_encoding(*ENCODINGS[name], timelines, args.rounds)
+                 for name in args.encoding or ENCODINGS}
+    print(format_report(summaries))
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(summaries, file, indent=2)
+    return 0 if all(summary["round_trips"] for summary in summaries.values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
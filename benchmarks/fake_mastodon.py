@@ -0,0 +1,396 @@
+"""A small, local stand-in for a Mastodon instance.
+
+Only the endpoints the feed amalgamator (and Mastodon.py on its behalf) actually calls are implemented,
+including the server-sent events endpoint used by the streaming API.
+Latency, error rates, rate-limit headers and timeline sizes are configurable per instance so that benchmarks
+and tests can reproduce slow, flaky or throttled servers deterministically"""
+
+import json
+import queue
+import random
+import socket
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+FAKE_MASTODON_VERSION = "4.2.0"
+POSTS_PER_AUTHOR = 4  # Controls how often the same author shows up in a generated timeline
+AVATAR_SIZE = 400  # Width and height of the served avatars, in pixels. Larger than the feed shows them
+
+
+def _solid_png(width: int, height: int, rgb: tuple[int, int, int]) -> bytes:
+    """Encodes a single-colour RGB image as a PNG, so avatars can be served without an imaging library"""
+    def chunk(chunk_type: bytes, data: bytes) -> bytes:
+        body = chunk_type + data
+        return struct.pack(">I", len(data)) + body + struct.pack(">I", zlib.crc32(body))
+
+    rows = b"".join(b"\x00" + bytes(rgb) * width for _ in range(height))
+    return b"".join([b"\x89PNG\r\n\x1a\n",
+                     chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)),
+                     chunk(b"IDAT", zlib.compress(rows)),
+                     chunk(b"IEND", b"")])
+
+
+AVATAR_PNG = _solid_png(AVATAR_SIZE, AVATAR_SIZE, (99, 100, 255))
+
+
+class FakeMastodonServer:
+    """A fake Mastodon instance served over plain http on 127.0.0.1.
+
+    Timelines are generated lazily per (access token, timeline name) and are stable between calls, so repeated
+    requests return the same posts unless new ones are published with publish_status"""
+
+    def __init__(self, name: str = "fake.social", latency: float = 0.0, latency_jitter: float = 0.0,
+                 error_rate: float = 0.0, timeline_size: int = 40, reblog_ratio: float = 0.2,
+                 rate_limit: int = 300, rate_limit_window: int = 300, heartbeat_interval: float = 1.0,
+                 seed: int = 0):
+        """
+        :param name: Name of the fake instance. Shown in generated posts and account handles
+        :param latency: Seconds to wait before answering any request
+        :param latency_jitter: Up to this many extra seconds are randomly added on top of latency
+        :param error_rate: Probability (0 to 1) that a request is answered with a 503 instead
+        :param timeline_size: Number of posts that exist in every generated timeline
+        :param reblog_ratio: Fraction of generated posts that are boosts of another post
+        :param rate_limit: Value reported in the X-RateLimit-Limit header
+        :param rate_limit_window: Seconds until the reported rate limit resets
+        :param heartbeat_interval: Seconds between heartbeats on idle streaming connections
+        :param seed: Seed for the random number generator, for reproducible runs
+        """
+        self.name = name
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.timeline_size = timeline_size
+        self.reblog_ratio = reblog_ratio
+        self.rate_limit = rate_limit
+        self.rate_limit_window = rate_limit_window
+        self.heartbeat_interval = heartbeat_interval
+        """Number of requests received, keyed by path. Useful to check how many round trips a code path makes"""
+        self.request_counts = {}
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._timelines = {}
+        self._stream_queues = {}
+        self._next_id = 10 ** 9
+        self._rate_limit_remaining = rate_limit
+        self._rate_limit_reset = None
+        self._httpd = None
+        self._thread = None
+
+    # ===== Lifecycle =====
+    def start(self) -> "FakeMastodonServer":
+        """Starts serving on a free local port in a background thread"""
+        handler = _build_handler(self)
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="fake-mastodon-" + self.name,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.disconnect_streams()
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    @property
+    def base_url(self) -> str:
+        """Url to use as the server domain. Mastodon.py keeps the http scheme when it is given explicitly"""
+        assert self._httpd is not None, "Fake server has not been started"
+        return "http://127.0.0.1:{p}".format(p=self._httpd.server_address[1])
+
+    # ===== Timeline data =====
+    def get_timeline(self, token: str, timeline_name: str) -> list[dict]:
+        """Returns (generating on first use) the full timeline for the given token, newest post first"""
+        key = (token, timeline_name)
+        with self._lock:
+            if key not in self._timelines:
+                self._timelines[key] = [self._generate_status(token, timeline_name, i)
+                                        for i in range(self.timeline_size)]
+            return self._timelines[key]
+
+    def publish_status(self, token: str, timeline_name: str = "home", content: str | None = None) -> dict:
+        """Adds a new post at the top of a timeline and returns it"""
+        timeline = self.get_timeline(token, timeline_name)
+        with self._lock:
+            status = self._generate_status(token, timeline_name, len(timeline), content=content)
+            timeline.insert(0, status)
+        if timeline_name == "home":
+            self._push_event(token, "update", json.dumps(status))
+        return status
+
+    def edit_status(self, token: str, status_id: str, content: str) -> dict:
+        """Changes the content of a post on the home timeline and returns it"""
+        with self._lock:
+            status = next(s for s in self._timelines[(token, "home")] if s["id"] == status_id)
+            status["content"] = content
+            status["edited_at"] = datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+        self._push_event(token, "status.update", json.dumps(status))
+        return status
+
+    def delete_status(self, token: str, status_id: str):
+        """Removes a post from the home timeline"""
+        with self._lock:
+            timeline = self._timelines[(token, "home")]
+            timeline[:] = [s for s in timeline if s["id"] != status_id]
+        self._push_event(token, "delete", status_id)
+
+    # ===== Streaming =====
+    def _push_event(self, token: str, event: str, data: str):
+        with self._lock:
+            for stream_queue in self._stream_queues.get(token, []):
+                stream_queue.put((event, data))
+
+    def _open_stream(self, token: str) -> queue.Queue:
+        stream_queue = queue.Queue()
+        with self._lock:
+            self._stream_queues.setdefault(token, []).append(stream_queue)
+        return stream_queue
+
+    def _close_stream(self, token: str, stream_queue: queue.Queue):
+        with self._lock:
+            self._stream_queues[token].remove(stream_queue)
+
+    def open_stream_count(self, token: str) -> int:
+        with self._lock:
+            return len(self._stream_queues.get(token, []))
+
+    def disconnect_streams(self):
+        """Drops all open streaming connections, like a restarting instance would"""
+        with self._lock:
+            for stream_queues in self._stream_queues.values():
+                for stream_queue in stream_queues:
+                    stream_queue.put(None)
+
+    def _new_id(self) -> int:
+        self._next_id += 1
+        return self._next_id
+
+    def _generate_account(self, author_num: int) -> dict:
+        username = "author{n}".format(n=author_num)
+        return {
+            "id": str(author_num + 1),
+            "username": username,
+            "acct": "{u}@{s}".format(u=username, s=self.name),
+            "display_name": "Author {n} of {s}".format(n=author_num, s=self.name),
+            "url": "https://{s}/@{u}".format(s=self.name, u=username),
+            # Served by this fake server too, so the media proxy can be exercised offline
+            "avatar": "{b}/avatars/{u}.png".format(b=self.base_url, u=username),
+            "avatar_static": "{b}/avatars/{u}.png".format(b=self.base_url, u=username),
+            "note": "",
+            "bot": False,
+            "locked": False,
+            "created_at": "2023-01-01T00:00:00.000Z",
+            "followers_count": 0,
+            "following_count": 0,
+            "statuses_count": POSTS_PER_AUTHOR,
+            "emojis": [],
+            "fields": [],
+        }
+
+    def _generate_status(self, token: str, timeline_name: str, post_num: int, content: str | None = None,
+                         allow_reblog: bool = True) -> dict:
+        # Must be called while holding self._lock
+        status_id = self._new_id()
+        created_at = datetime(2023, 12, 1, tzinfo=timezone.utc) + timedelta(seconds=status_id % 10 ** 6)
+        if content is None:
+            content = "<p>Post {i} of {t} on {s} for {k}</p>".format(i=post_num, t=timeline_name, s=self.name,
+                                                                     k=token)
+        status = {
+            "id": str(status_id),
+            "uri": "https://{s}/users/x/statuses/{i}".format(s=self.name, i=status_id),
+            "url": "https://{s}/@x/{i}".format(s=self.name, i=status_id),
+            "created_at": created_at.isoformat().replace("+00:00", ".000Z"),
+            "edited_at": None,
+            "account": self._generate_account(post_num // POSTS_PER_AUTHOR),
+            "content": content,
+            "visibility": self._random.choice(["public", "public", "unlisted", "private"]),
+            "sensitive": False,
+            "spoiler_text": "",
+            "reblogs_count": self._random.randint(0, 50),
+            "favourites_count": self._random.randint(0, 200),
+            "replies_count": self._random.randint(0, 10),
+            "in_reply_to_id": None,
+            "in_reply_to_account_id": None,
+            "reblog": None,
+            "media_attachments": [],
+            "mentions": [],
+            "tags": [],
+            "emojis": [],
+            "card": None,
+            "poll": None,
+            "muted": False,
+            "language": "en",
+        }
+        if allow_reblog and self._random.random() < self.reblog_ratio:
+            status["reblog"] = self._generate_status(token, timeline_name, post_num + self.timeline_size,
+                                                     content=content, allow_reblog=False)
+            status["content"] = ""
+            status["favourites_count"] = 0
+            status["reblogs_count"] = 0
+        return status
+
+    def instance_info(self) -> dict:
+        return {
+            "uri": self.name,
+            "domain": self.name,
+            "title": self.name,
+            "version": FAKE_MASTODON_VERSION,
+            "urls": {"streaming_api": self.base_url},
+            "configuration": {"urls": {"streaming": self.base_url}},
+        }
+
+    # ===== Request behaviour =====
+    def _simulate_conditions(self) -> bool:
+        """Sleeps for the configured latency and returns True if the request should fail"""
+        with self._lock:
+            delay = self.latency + self._random.random() * self.latency_jitter
+            should_fail = self._random.random() < self.error_rate
+        if delay > 0:
+            time.sleep(delay)
+        return should_fail
+
+    def _rate_limit_headers(self) -> dict:
+        with self._lock:
+            now = datetime.now(timezone.utc)
+            if self._rate_limit_reset is None or now >= self._rate_limit_reset:
+                self._rate_limit_reset = now + timedelta(seconds=self.rate_limit_window)
+                self._rate_limit_remaining = self.rate_limit
+            # Never report 0 remaining, as Mastodon.py would then sleep until the reset time
+            self._rate_limit_remaining = max(self._rate_limit_remaining - 1, 1)
+            return {
+                "X-RateLimit-Limit": str(self.rate_limit),
+                "X-RateLimit-Remaining": str(self._rate_limit_remaining),
+                "X-RateLimit-Reset": self._rate_limit_reset.isoformat(),
+            }
+
+    def _record_request(self, path: str):
+        with self._lock:
+            self.request_counts[path] = self.request_counts.get(path, 0) + 1
+
+
+def _build_handler(server: FakeMastodonServer):
+    """Builds a request handler class bound to a specific fake server"""
+
+    class FakeMastodonHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # Allows keep-alive connections, like a real instance
+
+        def setup(self):
+            super().setup()
+            # Headers and body are written separately, so avoid waiting on delayed ACKs between them
+            self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        def log_message(self, format, *args):
+            pass  # Keep benchmark and test output clean
+
+        def do_GET(self):
+            self._dispatch("GET")
+
+        def do_POST(self):
+            self._dispatch("POST")
+
+        def _dispatch(self, method: str):
+            parsed = urlparse(self.path)
+            path = parsed.path.rstrip("/")
+            query = parse_qs(parsed.query)
+            server._record_request(path)
+            form = parse_qs(self._drain_body().decode("utf-8", errors="replace"))
+
+            if server._simulate_conditions():
+                self._send_json({"error": "Service Unavailable"}, HTTPStatus.SERVICE_UNAVAILABLE)
+                return
+
+            if method == "GET" and path in ("/api/v1/instance", "/api/v2/instance"):
+                self._send_json(server.instance_info())
+            elif method == "GET" and path == "/api/v1/streaming/user":
+                self._handle_stream()
+            elif method == "GET" and path.startswith("/api/v1/timelines/"):
+                self._handle_timeline(path[len("/api/v1/timelines/"):], query)
+            elif method == "GET" and path.startswith("/avatars/"):
+                self._send_body(AVATAR_PNG, "image/png")
+            elif method == "POST" and path == "/api/v1/apps":
+                self._send_json({"client_id": "fake-client-id", "client_secret": "fake-client-secret",
+                                 "name": "Feed Amalgamator"})
+            elif method == "POST" and path == "/oauth/token":
+                # Users exchanging an authorization code get a token of their own, the app gets the same every time
+                code = form.get("code", [None])[0]
+                access_token = "fake-access-token" if code is None else "access-token-for-" + code
+                self._send_json({"access_token": access_token, "token_type": "Bearer",
+                                 "scope": "read write push", "created_at": int(time.time())})
+            else:
+                self._send_json({"error": "Record not found"}, HTTPStatus.NOT_FOUND)
+
+        def _handle_timeline(self, timeline_name: str, query: dict):
+            token = self._bearer_token()
+            if token is None and timeline_name == "home":
+                self._send_json({"error": "The access token is invalid"}, HTTPStatus.UNAUTHORIZED)
+                return
+            limit = int(query.get("limit", ["20"])[0])
+            timeline = server.get_timeline(token or "", timeline_name)
+            self._send_json(timeline[:limit])
+
+        def _handle_stream(self):
+            token = self._bearer_token()
+            if token is None:
+                self._send_json({"error": "The access token is invalid"}, HTTPStatus.UNAUTHORIZED)
+                return
+            stream_queue = server._open_stream(token)
+            self.close_connection = True  # The body has no length, so it ends when the connection does
+            try:
+                self.send_response(HTTPStatus.OK)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                self.wfile.write(b":)\n")  # Sent by real instances as soon as the stream opens
+                while True:
+                    try:
+                        item = stream_queue.get(timeout=server.heartbeat_interval)
+                    except queue.Empty:
+                        self.wfile.write(b":thump\n")
+                        continue
+                    if item is None:
+                        break
+                    event, data = item
+                    self.wfile.write("event: {e}\ndata: {d}\n\n".format(e=event, d=data).encode("utf-8"))
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # The client went away
+            finally:
+                server._close_stream(token, stream_queue)
+
+        def _bearer_token(self) -> str | None:
+            header = self.headers.get("Authorization", "")
+            if header.startswith("Bearer "):
+                return header[len("Bearer "):]
+            return None
+
+        def _drain_body(self) -> bytes:
+            length = int(self.headers.get("Content-Length") or 0)
+            return self.rfile.read(length) if length else b""
+
+        def _send_json(self, payload, status: HTTPStatus = HTTPStatus.OK):
+            self._send_body(json.dumps(payload).encode("utf-8"), "application/json; charset=utf-8", status)
+
+        def _send_body(self, body: bytes, content_type: str, status: HTTPStatus = HTTPStatus.OK):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for header, value in server._rate_limit_headers().items():
+                self.send_header(header, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+    return FakeMastodonHandler
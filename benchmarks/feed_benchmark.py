@@ -0,0 +1,258 @@
+"""Benchmarks for the feed path, driven through create_app against local fake Mastodon instances.
+
+Run from the repository root, as the app reads its configuration relative to it:
+
+    python -m benchmarks.feed_benchmark --users 5 --servers 3 --json bench_output.json
+
+Results can be compared against a previous run with --baseline, in which case the process exits with a
+non-zero status if any scenario got slower by more than --max-regression"""
+
+import argparse
+import json
+import logging
+import math
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+from benchmarks.fake_mastodon import FakeMastodonServer
+from feed_amalgamator import create_app
+from feed_amalgamator.constants.common_constants import USER_ID_FIELD
+from feed_amalgamator.helpers.db_interface import dbi, User, UserServer
+
+BENCHMARK_DB_NAME = "benchmark.sqlite"
+FEED_HOME_URL = "/feed/home"
+APP_LOGGER_NAMES = ["feed_page", "auth_page"]
+
+
+def percentile(samples: list[float], pct: float) -> float:
+    """
+    Nearest-rank percentile, which is exact for the small sample sizes benchmarks tend to have
+
+    :param samples: Unsorted measurements
+    :param pct: Wanted percentile, between 0 and 100
+    :return: The measurement at that percentile, or 0 if there are no measurements
+    """
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(math.ceil(pct / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+class BenchmarkResult:
+    """Latencies and error counts collected for a single scenario"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies = []
+        self.errors = 0
+        self.wall_time = 0.0
+
+    def record(self, latency: float, is_error: bool):
+        self.latencies.append(latency)
+        if is_error:
+            self.errors += 1
+
+    def summary(self) -> dict:
+        num_requests = len(self.latencies)
+        return {
+            "requests": num_requests,
+            "errors": self.errors,
+            "throughput_rps": num_requests / self.wall_time if self.wall_time else 0.0,
+            "p50_ms": percentile(self.latencies, 50) * 1000,
+            "p95_ms": percentile(self.latencies, 95) * 1000,
+            "p99_ms": percentile(self.latencies, 99) * 1000,
+        }
+
+
+class FeedBenchmark:
+    """Sets up an app with users tied to fake servers, and times requests to the feed page"""
+
+    def __init__(self, servers: list[FakeMastodonServer], num_users: int, keep_logs: bool = False):
+        """
+        :param servers: Started fake servers. Every user gets an account on each of them
+        :param num_users: Number of users to create
+        :param keep_logs: If False, the app's loggers are silenced so request logs don't drown the report
+        """
+        self.app = create_app(db_file_name=BENCHMARK_DB_NAME)
+        self.app.config.update({"TESTING": True})
+        if not keep_logs:
+            for logger_name in APP_LOGGER_NAMES:
+                logging.getLogger(logger_name).setLevel(logging.CRITICAL)
+
+        self.user_ids = []
+        with self.app.app_context():
+            dbi.drop_all()
+            dbi.create_all()
+            for user_num in range(num_users):
+                user = User(username="bench_user_{n}".format(n=user_num), password="unused")
+                dbi.session.add(user)
+                dbi.session.flush()
+                for server_num, server in enumerate(servers):
+                    token = "user{u}-server{s}".format(u=user_num, s=server_num)
+                    dbi.session.add(UserServer(user_id=user.user_id, server=server.base_url, token=token))
+                self.user_ids.append(user.user_id)
+            dbi.session.commit()
+
+    def _timed_feed_request(self, user_id: int) -> (float, bool):
+        client = self.app.test_client()
+        with client.session_transaction() as sess:
+            sess[USER_ID_FIELD] = user_id
+        start = time.perf_counter()
+        try:
+            response = client.get(FEED_HOME_URL)
+            is_error = response.status_code != HTTPStatus.OK
+        except Exception:
+            # Unhandled errors propagate through the test client instead of becoming a 500
+            is_error = True
+        return time.perf_counter() - start, is_error
+
+    def run(self, result: BenchmarkResult, rounds: int, concurrency: int = 1) -> BenchmarkResult:
+        """
+        Requests the feed page once per user per round, and records the outcome in result
+
+        :param result: Where measurements are accumulated
+        :param rounds: Number of times every user loads their feed
+        :param concurrency: Number of requests in flight at once
+        :return: The same result object, for chaining
+        """
+        user_ids = self.user_ids * rounds
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for latency, is_error in executor.map(self._timed_feed_request, user_ids):
+                result.record(latency, is_error)
+        result.wall_time += time.perf_counter() - start
+        return result
+
+
+def _start_servers(num_servers: int, latency: float, error_rate: float = 0.0,
+                   timeline_size: int = 40) -> list[FakeMastodonServer]:
+    return [FakeMastodonServer(name="server{n}.fake".format(n=n), latency=latency, error_rate=error_rate,
+                               timeline_size=timeline_size, seed=n).start()
+            for n in range(num_servers)]
+
+
+def _stop_servers(servers: list[FakeMastodonServer]):
+    for server in servers:
+        server.stop()
+
+
+def scenario_users_by_servers(num_users: int, num_servers: int, rounds: int, latency: float,
+                              concurrency: int, keep_logs: bool = False) -> list[BenchmarkResult]:
+    """N users, each with an account on all of M equally fast servers"""
+    servers = _start_servers(num_servers, latency)
+    try:
+        bench = FeedBenchmark(servers, num_users, keep_logs)
+        name = "{u}_users_x_{s}_servers".format(u=num_users, s=num_servers)
+        return [bench.run(BenchmarkResult(name), rounds, concurrency)]
+    finally:
+        _stop_servers(servers)
+
+
+def scenario_cold_vs_warm(num_users: int, num_servers: int, rounds: int, latency: float,
+                          concurrency: int, keep_logs: bool = False) -> list[BenchmarkResult]:
+    """The first feed load of every user after startup, compared against the loads that follow it"""
+    servers = _start_servers(num_servers, latency)
+    try:
+        bench = FeedBenchmark(servers, num_users, keep_logs)
+        cold = bench.run(BenchmarkResult("cold_first_load"), 1, concurrency)
+        warm = bench.run(BenchmarkResult("warm_repeat_load"), max(rounds - 1, 1), concurrency)
+        return [cold, warm]
+    finally:
+        _stop_servers(servers)
+
+
+def scenario_flaky_instance(num_users: int, num_servers: int, rounds: int, latency: float, concurrency: int,
+                            keep_logs: bool = False, error_rate: float = 0.3) -> list[BenchmarkResult]:
+    """Same as scenario_users_by_servers, except that one of the servers fails a share of its requests"""
+    servers = _start_servers(max(num_servers - 1, 1), latency)
+    servers.append(FakeMastodonServer(name="flaky.fake", latency=latency, error_rate=error_rate,
+                                      seed=len(servers)).start())
+    try:
+        bench = FeedBenchmark(servers, num_users, keep_logs)
+        return [bench.run(BenchmarkResult("flaky_instance"), rounds, concurrency)]
+    finally:
+        _stop_servers(servers)
+
+
+SCENARIOS = {
+    "users_by_servers": scenario_users_by_servers,
+    "cold_vs_warm": scenario_cold_vs_warm,
+    "flaky_instance": scenario_flaky_instance,
+}
+
+
+def format_report(results: list[BenchmarkResult]) -> str:
+    header = "{:<28}{:>10}{:>8}{:>12}{:>10}{:>10}{:>10}".format(
+        "scenario", "requests", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms")
+    lines = [header, "-" * len(header)]
+    for result in results:
+        s = result.summary()
+        lines.append("{:<28}{:>10}{:>8}{:>12.1f}{:>10.1f}{:>10.1f}{:>10.1f}".format(
+            result.name, s["requests"], s["errors"], s["throughput_rps"], s["p50_ms"], s["p95_ms"], s["p99_ms"]))
+    return "\n".join(lines)
+
+
+def find_regressions(current: dict, baseline: dict, max_regression: float) -> list[str]:
+    """
+    Compares summaries of the current run with those of a previous run
+
+    :param current: Scenario name -> summary dict, for this run
+    :param baseline: Scenario name -> summary dict, for the run to compare against
+    :param max_regression: Allowed relative slowdown, eg. 0.2 for 20%
+    :return: Human-readable descriptions of every regression found
+    """
+    regressions = []
+    for name, summary in current.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        if old["p95_ms"] and summary["p95_ms"] > old["p95_ms"] * (1 + max_regression):
+            regressions.append("{n}: p95 went from {o:.1f}ms to {c:.1f}ms".format(
+                n=name, o=old["p95_ms"], c=summary["p95_ms"]))
+        if summary["throughput_rps"] < old["throughput_rps"] * (1 - max_regression):
+            regressions.append("{n}: throughput went from {o:.1f} to {c:.1f} req/s".format(
+                n=name, o=old["throughput_rps"], c=summary["throughput_rps"]))
+    return regressions
+
+
+def main(argv=None) -> int:
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--scenario", choices=sorted(SCENARIOS), action="append",
+                            help="Scenario to run. Can be repeated. Runs all scenarios by default")
+    arg_parser.add_argument("--users", type=int, default=5)
+    arg_parser.add_argument("--servers", type=int, default=3)
+    arg_parser.add_argument("--rounds", type=int, default=5)
+    arg_parser.add_argument("--concurrency", type=int, default=1)
+    arg_parser.add_argument("--latency", type=float, default=0.02, help="Seconds of latency per fake request")
+    arg_parser.add_argument("--keep-logs", action="store_true", help="Keep the app's request and error logs")
+    arg_parser.add_argument("--json", help="Write the summaries to this file")
+    arg_parser.add_argument("--baseline", help="Summaries from a previous run to compare against")
+    arg_parser.add_argument("--max-regression", type=float, default=0.2)
+    args = arg_parser.parse_args(argv)
+
+    results = []
+    for scenario_name in args.scenario or sorted(SCENARIOS):
+        results.extend(SCENARIOS[scenario_name](args.users, args.servers, args.rounds, args.latency,
+                                                args.concurrency, args.keep_logs))
+    print(format_report(results))
+
+    summaries = {result.name: result.summary() for result in results}
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(summaries, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = find_regressions(summaries, json.load(file), args.max_regression)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,247 @@
+"""Load test of the feed path, driven through create_app by many simulated users against local fake Mastodon instances.
+
+Run from the repository root, as the app reads its configuration relative to it:
+
+    python -m benchmarks.load_test --users 40 --servers 6 --servers-per-user 3 --concurrency 1 4 16 32
+
+Every user has accounts on several of the fake servers, with an access token of their own, and fake posts name the
+token they were fetched with. So besides timing feed requests at increasing concurrency, the load test checks that
+every user sees the posts of all of their servers and of no one else's, and that users adding servers at the same
+time each get their own. The process exits with a non-zero status if any request failed or any check did not hold"""
+
+import argparse
+import json
+import logging
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+from benchmarks.fake_mastodon import FakeMastodonServer
+from benchmarks.feed_benchmark import APP_LOGGER_NAMES, BenchmarkResult
+from feed_amalgamator import create_app
+from feed_amalgamator.constants.common_constants import USER_ID_FIELD, USER_DOMAIN_FIELD, VERIFIED_DOMAIN_FIELD
+from feed_amalgamator.helpers.db_interface import dbi, ApplicationTokens, User, UserServer
+
+LOAD_TEST_DB_NAME = "load_test.sqlite"
+FEED_API_URL = "/feed/api/home"
+HANDLE_OAUTH_URL = "/feed/handle_oauth"
+TOKEN_PATTERN = re.compile(r" for (user\d+-server\d+)</p>$")
+"""Finds the token a fake post was fetched with in its content"""
+MAX_REPORTED_VIOLATIONS = 20
+
+
+class LoadResult(BenchmarkResult):
+    """Latencies, error counts and isolation violations collected at a single concurrency"""
+
+    def __init__(self, name: str, concurrency: int):
+        super().__init__(name)
+        self.concurrency = concurrency
+        self.num_violations = 0
+        self.violations = []
+        """The first MAX_REPORTED_VIOLATIONS, described"""
+
+    def record_violations(self, violations: list[str]):
+        self.num_violations += len(violations)
+        self.violations.extend(violations[:MAX_REPORTED_VIOLATIONS - len(self.violations)])
+
+    def summary(self) -> dict:
+        summary = super().summary()
+        summary["concurrency"] = self.concurrency
+        summary["violations"] = self.num_violations
+        return summary
+
+
+class FeedLoadTest:
+    """Sets up an app with users spread over fake servers, and drives it with concurrent simulated users"""
+
+    def __init__(self, servers: list[FakeMastodonServer], num_users: int, servers_per_user: int,
+                 keep_logs: bool = False):
+        """
+        :param servers: Started fake servers
+        :param num_users: Number of users to create
+        :param servers_per_user: Number of the servers every user has an account on. Users are spread over the
+        servers, so that neighbouring users share some servers but not all of them
+        :param keep_logs: If False, the app's loggers are silenced so request logs don't drown the report
+        """
+        self.servers = servers
+        self.app = create_app(db_file_name=LOAD_TEST_DB_NAME)
+        self.app.config.update({"TESTING": True})
+        if not keep_logs:
+            for logger_name in APP_LOGGER_NAMES:
+                logging.getLogger(logger_name).setLevel(logging.CRITICAL)
+
+        self.user_tokens = {}
+        """User id -> {access token: server domain} of the user's servers"""
+        with self.app.app_context():
+            dbi.drop_all()
+            dbi.create_all()
+            for user_num in range(num_users):
+                user = User(username="load_user_{n}".format(n=user_num), password="unused")
+                dbi.session.add(user)
+                dbi.session.flush()
+                tokens = {}
+                for offset in range(min(servers_per_user, len(servers))):
+                    server_num = (user_num + offset) % len(servers)
+                    token = "user{u}-server{s}".format(u=user_num, s=server_num)
+                    dbi.session.add(UserServer(user_id=user.user_id, server=servers[server_num].base_url, token=token))
+                    tokens[token] = servers[server_num].base_url
+                self.user_tokens[user.user_id] = tokens
+            # Registering the app on a server needs https, which the fake servers do not speak
+            for server in servers:
+                dbi.session.add(ApplicationTokens(server=server.base_url, client_id="fake-client-id",
+                                                  client_secret="fake-client-secret", access_token=None,
+                                                  redirect_uri="urn:ietf:wg:oauth:2.0:oob"))
+            dbi.session.commit()
+
+    def check_isolation(self, user_id: int, posts: list[dict]) -> list[str]:
+        """
+        :param user_id: The user whose feed it is
+        :param posts: The posts of the feed, as returned by the feed API
+        :return: Descriptions of every post of the feed that is not the user's, and of every server of the user
+        missing from it
+        """
+        tokens = self.user_tokens[user_id]
+        violations = []
+        seen_tokens = set()
+        for post in posts:
+            match = TOKEN_PATTERN.search(post["content"])
+            if match is None or match.group(1) not in tokens:
+                violations.append("user {u} got post {p} of someone else: {c}".format(u=user_id, p=post["id"],
+                                                                                    c=post["content"]))
+            elif post["original_server"] != tokens[match.group(1)]:
+                violations.append("user {u} got post {p} attributed to {s} instead of {e}".format(
+                    u=user_id, p=post["id"], s=post["original_server"], e=tokens[match.group(1)]))
+            else:
+                seen_tokens.add(match.group(1))
+        for token in sorted(tokens.keys() - seen_tokens):
+            violations.append("user {u} got no posts of {s}".format(u=user_id, s=tokens[token]))
+        return violations
+
+    def _simulated_user(self, user_id: int) -> (float, bool, list[str]):
+        """Loads the feed of a user once"""
+        client = self.app.test_client()
+        with client.session_transaction() as sess:
+            sess[USER_ID_FIELD] = user_id
+        start = time.perf_counter()
+        try:
+            response = client.get(FEED_API_URL)
+            latency = time.perf_counter() - start
+        except Exception as err:
+            # Unhandled errors propagate through the test client instead of becoming a 500
+            return time.perf_counter() - start, True, ["user {u} got error {e}".format(u=user_id, e=err)]
+        if response.status_code != HTTPStatus.OK:
+            return latency, True, []
+        return latency, False, self.check_isolation(user_id, response.get_json()["posts"])
+
+    def run(self, concurrency: int, rounds: int) -> LoadResult:
+        """
+        Loads the feed of every user once per round, with concurrency users at a time
+
+        :return: The measurements and violations
+        """
+        result = LoadResult("feed_x{c}".format(c=concurrency), concurrency)
+        user_ids = list(self.user_tokens) * rounds
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for latency, is_error, violations in executor.map(self._simulated_user, user_ids):
+                result.record(latency, is_error)
+                result.record_violations(violations)
+        result.wall_time = time.perf_counter() - start
+        return result
+
+    def _add_server(self, user_id: int) -> (float, bool, list[str]):
+        """Completes the OAuth flow of adding a server for a user, as if they came back from the server"""
+        server = self.servers[user_id % len(self.servers)]
+        client = self.app.test_client()
+        with client.session_transaction() as sess:
+            sess[USER_ID_FIELD] = user_id
+            sess[USER_DOMAIN_FIELD] = server.base_url
+            sess[VERIFIED_DOMAIN_FIELD] = server.base_url
+        code = "code-of-user{u}".format(u=user_id)
+        start = time.perf_counter()
+        try:
+            response = client.get(HANDLE_OAUTH_URL, query_string={"code": code})
+            latency = time.perf_counter() - start
+        except Exception as err:
+            return time.perf_counter() - start, True, ["user {u} got error {e}".format(u=user_id, e=err)]
+        if response.status_code != HTTPStatus.FOUND:
+            return latency, True, []
+        with self.app.app_context():
+            added = UserServer.query.filter_by(user_id=user_id, token="access-token-for-" + code).all()
+            if [user_server.server for user_server in added] != [server.base_url]:
+                return latency, False, ["user {u} did not get their own server {s} added: {a}".format(
+                    u=user_id, s=server.base_url, a=[(added_server.server, added_server.token)
+                                                     for added_server in added])]
+        return latency, False, []
+
+    def add_servers(self, concurrency: int) -> LoadResult:
+        """
+        Makes every user add a server, with concurrency users at a time
+
+        :return: The measurements and violations
+        """
+        result = LoadResult("add_server_x{c}".format(c=concurrency), concurrency)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for latency, is_error, violations in executor.map(self._add_server, list(self.user_tokens)):
+                result.record(latency, is_error)
+                result.record_violations(violations)
+        result.wall_time = time.perf_counter() - start
+        return result
+
+
+def run_load_test(num_users: int, num_servers: int, servers_per_user: int, concurrency_levels: list[int],
+                  rounds: int, latency: float, keep_logs: bool = False) -> list[LoadResult]:
+    """Loads feeds at every concurrency level in turn, then adds servers at the highest one"""
+    servers = [FakeMastodonServer(name="server{n}.fake".format(n=n), latency=latency, timeline_size=10, seed=n).start()
+               for n in range(num_servers)]
+    try:
+        load_test = FeedLoadTest(servers, num_users, servers_per_user, keep_logs)
+        results = [load_test.run(concurrency, rounds) for concurrency in concurrency_levels]
+        results.append(load_test.add_servers(max(concurrency_levels)))
+        return results
+    finally:
+        for server in servers:
+            server.stop()
+
+
+def format_report(results: list[LoadResult]) -> str:
+    header = "{:<20}{:>10}{:>8}{:>12}{:>12}{:>10}{:>10}{:>10}".format(
+        "scenario", "requests", "errors", "violations", "req/s", "p50 ms", "p95 ms", "p99 ms")
+    lines = [header, "-" * len(header)]
+    for result in results:
+        s = result.summary()
+        lines.append("{:<20}{:>10}{:>8}{:>12}{:>12.1f}{:>10.1f}{:>10.1f}{:>10.1f}".format(
+            result.name, s["requests"], s["errors"], s["violations"], s["throughput_rps"], s["p50_ms"], s["p95_ms"],
+            s["p99_ms"]))
+    for result in results:
+        lines.extend("VIOLATION {n}: {v}".format(n=result.name, v=violation) for violation in result.violations)
+    return "\n".join(lines)
+
+
+def main(argv=None) -> int:
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--users", type=int, default=40)
+    arg_parser.add_argument("--servers", type=int, default=6)
+    arg_parser.add_argument("--servers-per-user", type=int, default=3)
+    arg_parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 32],
+                            help="Simulated users in flight at once, one level after the other")
+    arg_parser.add_argument("--rounds", type=int, default=3, help="Feed loads per user at every level")
+    arg_parser.add_argument("--latency", type=float, default=0.02, help="Seconds of latency per fake request")
+    arg_parser.add_argument("--keep-logs", action="store_true", help="Keep the app's request and error logs")
+    arg_parser.add_argument("--json", help="Write the summaries to this file")
+    args = arg_parser.parse_args(argv)
+
+    results = run_load_test(args.users, args.servers, args.servers_per_user, args.concurrency, args.rounds,
+                            args.latency, args.keep_logs)
+    print(format_report(results))
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({result.name: result.summary() for result in results}, file, indent=2)
+    return 0 if all(result.errors == 0 and result.num_violations == 0 for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
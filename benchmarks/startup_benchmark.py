@@ -0,0 +1,104 @@
+"""Benchmark of how long a worker takes to start, each round in a fresh interpreter.
+
+Run from the repository root, as the app reads its configuration relative to it:
+
+    python -m benchmarks.startup_benchmark --rounds 10 --json startup_output.json
+
+Every round times importing the app, create_app and the first request, once without and once with the warm-up.
+The report shows the medians"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+FIRST_REQUEST_URL = "/auth/login"
+VARIANTS = {"cold": False, "warm_up": True}
+"""Variant name -> whether the app is warmed up"""
+TIMINGS = ("import_ms", "create_app_ms", "first_request_ms", "total_ms")
+
+
+def measure_startup(warm_up: bool, db_dir: str) -> dict:
+    """Measures the current interpreter starting the app. Only meaningful in a fresh interpreter
+
+    :param warm_up: Whether the app is warmed up
+    :param db_dir: Directory for the benchmark's database
+    :return: Milliseconds per step, and whether Mastodon.py was imported by the end of the first request
+    """
+    started = time.perf_counter()
+    from feed_amalgamator import create_app
+    from feed_amalgamator.constants.common_constants import WARM_UP_SETTING
+    imported = time.perf_counter()
+    app = create_app(test_config={"TESTING": True, WARM_UP_SETTING: warm_up},
+                     db_file_name=str(Path(db_dir, "startup_benchmark.sqlite")))
+    created = time.perf_counter()
+    response = app.test_client().get(FIRST_REQUEST_URL)
+    response.close()
+    served = time.perf_counter()
+    return {
+        "import_ms": (imported - started) * 1000,
+        "create_app_ms": (created - imported) * 1000,
+        "first_request_ms": (served - created) * 1000,
+        "total_ms": (served - started) * 1000,
+        "status": response.status_code,
+        "mastodon_imported": "mastodon" in sys.modules,
+    }
+
+
+def run_round(warm_up: bool, db_dir: str) -> dict:
+    """Runs measure_startup in a fresh interpreter"""
+    completed = subprocess.run([sys.executable, "-m", "benchmarks.startup_benchmark", "--measure", db_dir]
+                               + (["--warm-up"] if warm_up else []), capture_output=True, text=True, check=True)
+    # The app logs to stdout as well, so the measurements are the last line
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def summarize(measurements: list[dict]) -> dict:
+    summary = {timing: statistics.median(measurement[timing] for measurement in measurements) for timing in TIMINGS}
+    summary["rounds"] = len(measurements)
+    summary["mastodon_imported"] = any(measurement["mastodon_imported"] for measurement in measurements)
+    return summary
+
+
+def format_report(summaries: dict[str, dict]) -> str:
+    lines = ["{n:<10} {i:>10} {c:>14} {f:>17} {t:>10}".format(n="variant", i="import_ms", c="create_app_ms",
+                                                              f="first_request_ms", t="total_ms")]
+    for name, summary in summaries.items():
+        lines.append("{n:<10} {i:>10.1f} {c:>14.1f} {f:>17.1f} {t:>10.1f}".format(
+            n=name, i=summary["import_ms"], c=summary["create_app_ms"], f=summary["first_request_ms"],
+            t=summary["total_ms"]))
+    return "\n".join(lines)
+
+
+def main(argv=None) -> int:
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--rounds", type=int, default=10, help="Fresh interpreters started per variant")
+    arg_parser.add_argument("--json", help="Write the summaries to this file")
+    arg_parser.add_argument("--measure", metavar="DB_DIR", help=argparse.SUPPRESS)
+    arg_parser.add_argument("--warm-up", action="store_true", help=argparse.SUPPRESS)
+    args = arg_parser.parse_args(argv)
+
+    if args.measure:
+        print(json.dumps(measure_startup(args.warm_up, args.measure)))
+        return 0
+
+    with tempfile.TemporaryDirectory() as db_dir:
+        run_round(False, db_dir)  # Creates the database, and fills the OS file cache, so that rounds are alike
+        measurements = {name: [] for name in VARIANTS}
+        for _ in range(args.rounds):
+            for name, warm_up in VARIANTS.items():  # Interleaved, so that both variants see the same noise
+                measurements[name].append(run_round(warm_up, db_dir))
+    summaries = {name: summarize(variant_measurements) for name, variant_measurements in measurements.items()}
+    print(format_report(summaries))
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(summaries, file, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,26 +1,36 @@
 import os
-import configparser
 import urllib
+from pathlib import Path
 
 
+import click
 from flask import Flask, redirect, url_for
+from flask.cli import with_appcontext
 
 from . import auth, feed, about
 from feed_amalgamator.helpers.db_interface import dbi
+from feed_amalgamator.helpers.app_settings import read_app_settings
 from feed_amalgamator.helpers import error_handler # noqa
-from feed_amalgamator.constants.common_constants import CONFIG_LOC
+from feed_amalgamator.helpers.db_engine import build_engine_options, install_connection_settings
+from feed_amalgamator.helpers.server_session import build_session_interface
+from feed_amalgamator.helpers.response_optimization import install_response_optimization
+from feed_amalgamator.helpers.request_profiling import install_request_profiling
+from feed_amalgamator.helpers.warm_up import warm_up
+from feed_amalgamator.helpers.schema_migrations import migrate_application_tokens
+from feed_amalgamator.constants.common_constants import STREAM_INGESTION_SETTING, \
+    DB_POOL_METRICS_EXTENSION, SEARCH_INDEX_FILE, INGESTION_SHARDING_SETTING, CREATE_SCHEMA_SETTING, WARM_UP_SETTING
 
 
 def create_app(test_config=None, db_file_name=None):
-    parser = configparser.ConfigParser()
-    # Setting up the loggers and interface layers
-    with open(CONFIG_LOC) as file:
-        parser.read_file(file)
+    parser = read_app_settings()
     # create and configure the app
     environment_type = parser["ENVIRONMENT"]["ENVIRONMENT"]
     secret_key = parser["ENVIRONMENT"]["SECRET_KEY"]
     app = Flask(__name__, instance_relative_config=True)
     app.config["SECRET_KEY"] = secret_key
+    session_interface = build_session_interface(parser)
+    if session_interface is not None:
+        app.session_interface = session_interface
     db_location = None
     if environment_type == "dev":
         app.config["DATABASE"] = os.path.join(app.instance_path, "flaskr.sqlite")
@@ -50,13 +60,42 @@ def create_app(test_config=None, db_file_name=None):
     app.register_blueprint(auth.bp)
     app.register_blueprint(feed.bp)
     app.register_blueprint(about.bp)
+    install_response_optimization(app)
+    install_request_profiling(app)
     app.config["SQLALCHEMY_DATABASE_URI"] = db_location
+    engine_options, pool_metrics = build_engine_options(parser, is_sqlite=str(db_location).startswith("sqlite"),
+                                                        metrics_logger=feed.logger)
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", engine_options)  # Unless set by the test or instance config
+    app.extensions[DB_POOL_METRICS_EXTENSION] = pool_metrics
     dbi.init_app(app)
 
+    app.cli.add_command(init_db_command)
+
     @app.route("/", methods=["GET"])
     def redirect_internal():
         return redirect(url_for("feed.feed_home"))
 
     with app.app_context():
-        dbi.create_all()
+        install_connection_settings(dbi.engine, parser)
+        # Outside dev, the schema is created once per deployment with `flask init-db`, rather than by every worker
+        if app.config.get(CREATE_SCHEMA_SETTING, environment_type == "dev"):
+            dbi.create_all()
+        feed.search_index.open(Path(app.instance_path, SEARCH_INDEX_FILE))
+        if app.config.get(STREAM_INGESTION_SETTING, False):
+            if app.config.get(INGESTION_SHARDING_SETTING, False):
+                feed.start_sharded_ingestion(app)
+            else:
+                feed.start_stream_ingestion()
+    if app.config.get(WARM_UP_SETTING, False):
+        warm_up(app, feed.auth_api, feed.logger)
     return app
+
+
+@click.command("init-db")
+@with_appcontext
+def init_db_command():
+    """Creates the tables that do not exist yet, and migrates the existing ones create_all does not change"""
+    dbi.create_all()
+    for change in migrate_application_tokens(dbi.engine, feed.logger):
+        click.echo(change)
+    click.echo("Initialized the database")
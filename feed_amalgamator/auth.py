@@ -2,12 +2,13 @@
 
 import functools
 import logging
-import configparser
 from pathlib import Path
 
 import sqlalchemy.exc
+from blinker import Namespace
 from flask import (
     Blueprint,
+    current_app,
     g,
     redirect,
     render_template,
@@ -16,30 +17,41 @@ from flask import (
     url_for,
 )
 
-from feed_amalgamator.helpers.custom_exceptions import InvalidCredentialsError, IntegrityError
+from feed_amalgamator.helpers.custom_exceptions import InvalidCredentialsError, IntegrityError, \
+    ServiceUnavailableError
 
 from feed_amalgamator.helpers.db_interface import dbi, User
 
+from feed_amalgamator.helpers.app_settings import read_app_settings
 from feed_amalgamator.helpers.logging_helper import LoggingHelper
 
-from werkzeug.security import check_password_hash, generate_password_hash
+from feed_amalgamator.helpers.password_hashing import PasswordHashingService, HashingOverloadedError
 
 from sqlalchemy import exc
 
-from feed_amalgamator.constants.common_constants import USERNAME_FIELD, PASSWORD_FIELD, USER_ID_FIELD, CONFIG_LOC
+from feed_amalgamator.constants.common_constants import USERNAME_FIELD, PASSWORD_FIELD, USER_ID_FIELD, \
+    PASSWORD_HASH_METHOD, PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_PENDING, PASSWORD_HASH_QUEUE_TIMEOUT
 from feed_amalgamator.constants.error_messages import USER_ALREADY_EXISTS_MSG, INVALID_USERNAME_MSG, \
-    INVALID_PASSWORD_MSG, USER_DOES_NOT_EXIST_MSG, REDIRECT_LOGIN, REDIRECT_REGISTER
+    INVALID_PASSWORD_MSG, USER_DOES_NOT_EXIST_MSG, REDIRECT_LOGIN, REDIRECT_REGISTER, LOGIN_BUSY_MSG
 
 bp = Blueprint("auth", __name__, url_prefix="/auth")
+user_logged_in = Namespace().signal("user-logged-in")
+"""Sent by the app with the user_id of every user that logs in, once their credentials are validated"""
 
 # Setup for logging and interface layers
 
 # Setting up the loggers and interface layers
-parser = configparser.ConfigParser()
-with open(CONFIG_LOC) as file:
-    parser.read_file(file)
+parser = read_app_settings()
 log_file_loc = Path(parser["LOG_SETTINGS"]["auth_log_loc"])
 logger = LoggingHelper.generate_logger(logging.INFO, log_file_loc, "auth_page")
+# The PASSWORD_HASHING section is optional
+password_hashing = PasswordHashingService(
+    method=parser.get("PASSWORD_HASHING", "METHOD", fallback=PASSWORD_HASH_METHOD),
+    max_workers=parser.getint("PASSWORD_HASHING", "WORKERS", fallback=PASSWORD_HASH_WORKERS),
+    max_pending=parser.getint("PASSWORD_HASHING", "MAX_PENDING", fallback=PASSWORD_HASH_MAX_PENDING),
+    queue_timeout=parser.getfloat("PASSWORD_HASHING", "QUEUE_TIMEOUT", fallback=PASSWORD_HASH_QUEUE_TIMEOUT),
+    use_processes=parser.getboolean("PASSWORD_HASHING", "USE_PROCESSES", fallback=False),
+)
 
 # Constants for form fields
 
@@ -51,7 +63,11 @@ def register():
     """Endpoint for the user to register a new account with the app"""
     if request.method == "POST":
         username = request.form[USERNAME_FIELD]
-        password = generate_password_hash(request.form[PASSWORD_FIELD])
+        try:
+            password = password_hashing.hash_password(request.form[PASSWORD_FIELD])
+        except HashingOverloadedError:
+            raise ServiceUnavailableError({"message": LOGIN_BUSY_MSG,
+                                           "redirect_path": REDIRECT_REGISTER})
         try:
             user = User(username=username, password=password)
             dbi.session.add(user)
@@ -77,16 +93,44 @@ def login():
         if user is None:
             raise InvalidCredentialsError({"message": INVALID_USERNAME_MSG,
                                            "redirect_path": REDIRECT_LOGIN})
-        elif not check_password_hash(user.password, password):
+        try:
+            is_valid_password = password_hashing.check_password(user.password, password)
+        except HashingOverloadedError:
+            logger.error("Turned away a login, hashing metrics: {m}".format(m=password_hashing.metrics.summary()))
+            raise ServiceUnavailableError({"message": LOGIN_BUSY_MSG,
+                                           "redirect_path": REDIRECT_LOGIN})
+        if not is_valid_password:
             raise InvalidCredentialsError({"message": INVALID_PASSWORD_MSG,
                                            "redirect_path": REDIRECT_LOGIN})
         else:
+            rehash_password(user, password)
             session.clear()
             session[USER_ID_FIELD] = user.user_id
+            user_logged_in.send(current_app._get_current_object(), user_id=user.user_id)
             return redirect(url_for("feed.feed_home"))
     return render_template(REDIRECT_LOGIN)
 
 
+def rehash_password(user: User, password: str):
+    """
+    Upgrades a stored hash made with older hashing parameters to the configured ones. Only possible at login,
+    as it needs the plain password. Failing to do so is logged, but does not fail the login
+
+    :param user: The user that just logged in
+    :param password: The password they logged in with
+    """
+    try:
+        if password_hashing.needs_rehash(user.password):
+            user.password = password_hashing.hash_password(password)
+            dbi.session.commit()
+            logger.info("Rehashed the password of user id {i}".format(i=user.user_id))
+    except HashingOverloadedError:
+        logger.info("Skipped rehashing the password of user id {i} while busy".format(i=user.user_id))
+    except exc.SQLAlchemyError as err:
+        dbi.session.rollback()
+        logger.error("Encountered {e} rehashing the password of user id {i}".format(e=err, i=user.user_id))
+
+
 @bp.before_app_request
 def load_logged_in_user():
     """Helps to load data for a user that is already logged in"""
@@ -4,7 +4,95 @@ CONFIG_LOC = "configuration/app_settings.ini"
 NUM_POSTS_TO_GET = 20
 
 SORT_BY = "favourites_count"
-FILTER_LIST = ["uri", "in_reply_to_id", "in_reply_to_account_id", "muted", "language"]
+POST_DATE_FORMAT = "%b %d, %Y, %I:%M"
+RENDERED_MEDIA_TYPES = ("image", "video")
+FRAGMENT_CACHE_SIZE = 5000
+FRAGMENT_COUNT_BUCKET_SIZE = 5
+FETCH_WORKERS = 8
+STREAM_FEED_SETTING = "STREAM_FEED"  # App config key. Streams the feed page by default when True
+STREAM_INGESTION_SETTING = "STREAM_INGESTION"  # App config key. Streams home timelines instead of polling when True
+TIMELINE_STORE_SIZE = 100  # Posts kept per streamed timeline
+INGESTION_SHARDING_SETTING = "INGESTION_SHARDING"  # App config key. Splits stream ingestion between processes when True
+INGESTION_WORKER_ID_SETTING = "INGESTION_WORKER_ID"  # App config key. Defaults to the host name and process id
+SHARDED_INGESTION_EXTENSION = "sharded_ingestion"  # Key of the app's ShardedIngestion in app.extensions
+INGESTION_PARTITIONS = 128  # Must be the same for all workers. Caps the number of workers that get any work
+INGESTION_VIRTUAL_NODES = 64
+INGESTION_LEASE_TTL = 30.0
+INGESTION_REBALANCE_INTERVAL = 5.0
+INGESTION_SYNC_INTERVAL = 1.0  # Delay of published timelines reaching the other processes
+SNAPSHOT_TTL = 15.0  # Published timelines that are not renewed for this long are polled again
+SNAPSHOT_FOLLOW_TTL = 600.0  # Published timelines are mirrored for this long after they were last read
+STREAM_INITIAL_BACKOFF = 1.0
+STREAM_MAX_BACKOFF = 300.0
+STREAM_READ_TIMEOUT = 90.0  # Instances send heartbeats far more often than this
+LIVE_FEED_QUEUE_SIZE = 200  # New posts buffered per open page before it is told to reload instead
+LIVE_FEED_HEARTBEAT_INTERVAL = 15.0  # Keeps proxies from closing idle live feed connections
+LIVE_FEED_MAX_DURATION = 900.0  # Live feed connections are recycled after this long. Browsers reconnect by themselves
+LIVE_FEED_RETRY_MS = 5000
+INSTANCE_METADATA_TTL = 86400.0  # Seconds a verified instance is trusted before it is verified again
+INSTANCE_NEGATIVE_TTL = 300.0  # Seconds a domain that failed verification is remembered as invalid
+INSTANCE_CACHE_SIZE = 1000
+HTTP_CONNECT_TIMEOUT = 3.05  # Timeouts of the plain https requests made to instances, in seconds
+HTTP_READ_TIMEOUT = 10.0
+PASSWORD_HASH_METHOD = "scrypt"  # Defaults of the optional PASSWORD_HASHING section of the app settings
+PASSWORD_HASH_WORKERS = 2
+PASSWORD_HASH_MAX_PENDING = 16
+PASSWORD_HASH_QUEUE_TIMEOUT = 5.0
+DB_POOL_SIZE = 10  # Defaults of the optional database engine settings in the DATABASE section of the app settings
+DB_MAX_OVERFLOW = 20
+DB_POOL_TIMEOUT = 10.0
+DB_POOL_RECYCLE = 1800
+DB_STATEMENT_TIMEOUT = 30
+SQLITE_BUSY_TIMEOUT = 5.0
+DB_SLOW_CHECKOUT_THRESHOLD = 0.1
+DB_POOL_METRICS_EXTENSION = "db_pool_metrics"  # Key of the pool's PoolMetrics in app.extensions
+SESSION_BACKEND = "cookie"  # Defaults of the optional SESSION section of the app settings. Or "local", or "redis"
+SESSION_STORE_SIZE = 10000  # Sessions kept by the local store
+DERIVED_STATE_TTL = 600
+USER_CLIENT_POOL_SIZE = 2  # Idle, already started API clients kept per (server, access token)
+USER_CLIENT_IDLE_TTL = 300.0
+MEDIA_PROXY_SETTING = "MEDIA_PROXY"  # App config key. Serves avatars and images through the media proxy when True
+MEDIA_CACHE_DIR_SETTING = "MEDIA_CACHE_DIR"  # App config key. Defaults to media_cache in the instance folder
+MEDIA_PROXY_EXTENSION = "media_proxy"  # Key of the app's MediaProxy in app.extensions
+MEDIA_CACHE_MAX_BYTES = 512 * 1024 * 1024
+MEDIA_MAX_FETCH_BYTES = 16 * 1024 * 1024  # Larger remote images are linked to directly instead
+MEDIA_MAX_REDIRECTS = 3  # Redirects followed per proxied image, each checked like the image's own url
+# App config key. Lets the media proxy fetch from private, loopback and link-local addresses when True, eg. local fakes
+MEDIA_PROXY_ALLOW_PRIVATE_SETTING = "MEDIA_PROXY_ALLOW_PRIVATE_ADDRESSES"
+MEDIA_CACHE_MAX_AGE = 365 * 24 * 3600  # Proxied urls never change for the same image, so browsers may keep them
+MEDIA_DISPLAY_WIDTHS = {"avatar": 100, "image": 1200}  # Widths images are shrunk to, twice their size on the page
+COMPRESSION_MIN_SIZE = 500  # Smaller responses are sent uncompressed, as compressing them saves next to nothing
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5  # Higher qualities cost far more time than they save bytes for dynamic pages
+COMPRESSED_STATIC_CACHE_SIZE = 256
+STATIC_FINGERPRINT_ARG = "v"  # Query argument of static urls holding a hash of the file's contents
+STATIC_CACHE_MAX_AGE = 365 * 24 * 3600
+SEARCH_INDEX_FILE = "search_index.sqlite"  # In the instance folder
+SEARCH_INDEX_MAX_POSTS = 500000
+SEARCH_SEEN_CACHE_SIZE = 100000  # Post versions remembered as indexed, so that feed reloads do not rewrite them
+SEARCH_PAGE_SIZE = 20
+SEARCH_RANK_CANDIDATES = 5000  # Newest matches of a search that are ranked. Keeps searches for common words fast
+FILTER_CACHE_SIZE = 10000  # Users whose mute filter is kept compiled
+FILTER_CACHE_TTL = 300.0  # Other processes serving the app pick up changed rules after this long
+FILTER_VERDICT_CACHE_SIZE = 2000  # Posts whose verdict is remembered per compiled filter
+MAX_FILTER_RULES = 1000  # Per user
+MAX_FILTER_RULE_LENGTH = 200
+SHARED_TIMELINE_CACHE_SIZE = 1000  # Local, public and hashtag timelines kept for sharing between users
+SHARED_TIMELINE_TTL = 30.0
+SHARED_TIMELINE_LOGIN_TTL = 3600.0  # Instances that require logging in to see their public timelines are remembered
+MAX_USER_TIMELINES = 50  # Per user
+PROFILING_TOKEN_SETTING = "PROFILING_TOKEN"  # App config key. Requests carrying this admin token are profiled
+PROFILING_SAMPLE_RATE_SETTING = "PROFILING_SAMPLE_RATE"  # App config key. Share of all requests that are profiled
+PROFILE_DIR_SETTING = "PROFILE_DIR"  # App config key. Defaults to profiles in the instance folder
+PROFILE_RING_SIZE = 200  # Profiles kept on disk
+PROFILE_TOKEN_HEADER = "X-Profile-Token"
+PROFILE_ID_HEADER = "X-Profile-Id"  # Set on profiled responses, to find their profile
+ADD_SERVER_WORKERS = 4  # Threads running the independent steps of adding a server side by side
+CREATE_SCHEMA_SETTING = "CREATE_SCHEMA"  # App config key. Creates missing tables on start. Defaults to True in dev only
+WARM_UP_SETTING = "WARM_UP"  # App config key. Warms the app up before it serves requests when True
+PREFETCH_AT_LOGIN_SETTING = "PREFETCH_AT_LOGIN"  # App config key. Prefetches a user's feed at login when True
+PREFETCH_CACHE_SIZE = 2000  # Prefetched timelines kept, across users
+PREFETCH_TTL = 30.0  # Seconds after login the feed picks up prefetched timelines
 
 # Constants
 USERNAME_FIELD = "username"
@@ -13,5 +101,19 @@ USER_ID_FIELD = "user_id"
 SERVERS_FIELD = "servers"
 HOME_TIMELINE_NAME = "home"
 USER_DOMAIN_FIELD = "domain"
+VERIFIED_DOMAIN_FIELD = "verified_domain"  # The user provided domain, as the instance reported it
 LOGIN_TOKEN_FIELD = "token"
 ORIGINAL_SERVER_FIELD = "original_server"
+STREAM_FEED_ARG = "stream"
+POSTS_FIELD = "posts"
+SEARCH_QUERY_ARG = "q"
+SEARCH_PAGE_ARG = "page"
+HAS_MORE_FIELD = "has_more"
+FILTER_KIND_FIELD = "kind"
+FILTER_VALUE_FIELD = "value"
+FILTER_RULES_FIELD = "filter_rules"
+USER_SERVER_ID_FIELD = "user_server_id"
+TIMELINE_KIND_FIELD = "timeline_kind"
+TIMELINE_VALUE_FIELD = "timeline_value"
+TIMELINES_FIELD = "timelines"
+ERROR_FIELD = "error"
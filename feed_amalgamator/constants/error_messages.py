@@ -19,8 +19,23 @@ INVALID_MASTODON_DOMAIN_MSG = "The desired domain was not a valid mastodon domai
                               "page for domain"
 INVALID_JSON_RESPONSE_MSG = "Server returned a value that cannot be parsed. Server is likely to not be a " \
                              "legitimate server"
+FEED_SERVER_UNAVAILABLE_MSG = "Could not load posts from server"
+LOGIN_REQUIRED_MSG = "You need to be logged in to view your feed"
+INSTANCE_TIMEOUT_MSG = "Timed out waiting for a response. Please try again later. Failed to verify domain"
+LOGIN_BUSY_MSG = "Too many people are logging in right now. Please try again in a moment"
 SERVICE_UNAVAILABLE_MSG = "Something is wrong. Not sure if it us or Mastodon. Please try again later"
+INVALID_FILTER_RULE_MSG = "Please enter a word, an account (user@server) or a domain to mute"
+FILTER_RULE_TOO_LONG_MSG = "Filter rules can be at most 200 characters long"
+TOO_MANY_FILTER_RULES_MSG = "You have reached the maximum number of filter rules. Please delete some first"
+FILTER_RULE_ALREADY_EXISTS_MSG = "This filter rule already exists"
+INVALID_TIMELINE_MSG = "Please choose one of your servers, and enter a hashtag or the id of a list if needed"
+TOO_MANY_TIMELINES_MSG = "You have reached the maximum number of timelines. Please remove some first"
+TIMELINE_ALREADY_EXISTS_MSG = "This timeline is already part of your feed"
 REDIRECT_REGISTER = "auth/register.html"
 REDIRECT_LOGIN = "auth/login.html"
 REDIRECT_HOME = "feed/home.html"
-REDIRECT_ADD_SERVER = "feed/add_server.html"
\ No newline at end of file
+POST_FRAGMENT = "feed/post.html"
+REDIRECT_SEARCH = "feed/search.html"
+REDIRECT_ADD_SERVER = "feed/add_server.html"
+REDIRECT_FILTERS = "feed/filters.html"
+REDIRECT_TIMELINES = "feed/timelines.html"
\ No newline at end of file
@@ -1,49 +1,264 @@
 """Code for handling the main, feed page via flask"""
 
-import configparser
+import hashlib
+import json
 import logging
+import os
+import socket
+import time
+from collections.abc import Callable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
 from pathlib import Path
 
-from flask import Blueprint, flash, redirect, render_template, request, session, url_for
-
-from feed_amalgamator.constants.common_constants import CONFIG_LOC, FILTER_LIST, USER_ID_FIELD, HOME_TIMELINE_NAME, \
-    NUM_POSTS_TO_GET, USER_DOMAIN_FIELD, SORT_BY, SERVERS_FIELD, ORIGINAL_SERVER_FIELD
+from flask import Blueprint, abort, current_app, flash, jsonify, redirect, render_template, request, send_file, \
+    session, stream_template, stream_with_context, url_for
+from markupsafe import Markup
+
+from feed_amalgamator.constants.common_constants import USER_ID_FIELD, HOME_TIMELINE_NAME, \
+    NUM_POSTS_TO_GET, USER_DOMAIN_FIELD, SORT_BY, SERVERS_FIELD, FRAGMENT_CACHE_SIZE, FRAGMENT_COUNT_BUCKET_SIZE, \
+    FETCH_WORKERS, STREAM_FEED_SETTING, STREAM_FEED_ARG, POSTS_FIELD, ERROR_FIELD, STREAM_INGESTION_SETTING, \
+    TIMELINE_STORE_SIZE, STREAM_INITIAL_BACKOFF, STREAM_MAX_BACKOFF, STREAM_READ_TIMEOUT, LIVE_FEED_QUEUE_SIZE, \
+    LIVE_FEED_HEARTBEAT_INTERVAL, LIVE_FEED_MAX_DURATION, LIVE_FEED_RETRY_MS, ADD_SERVER_WORKERS, \
+    USER_CLIENT_POOL_SIZE, USER_CLIENT_IDLE_TTL, MEDIA_PROXY_SETTING, MEDIA_CACHE_DIR_SETTING, MEDIA_PROXY_EXTENSION, \
+    MEDIA_CACHE_MAX_BYTES, MEDIA_MAX_FETCH_BYTES, MEDIA_CACHE_MAX_AGE, MEDIA_DISPLAY_WIDTHS, SEARCH_INDEX_MAX_POSTS, \
+    SEARCH_SEEN_CACHE_SIZE, SEARCH_PAGE_SIZE, SEARCH_QUERY_ARG, SEARCH_PAGE_ARG, HAS_MORE_FIELD, \
+    SEARCH_RANK_CANDIDATES, FILTER_CACHE_SIZE, FILTER_CACHE_TTL, FILTER_VERDICT_CACHE_SIZE, MAX_FILTER_RULES, \
+    MAX_FILTER_RULE_LENGTH, FILTER_KIND_FIELD, FILTER_VALUE_FIELD, FILTER_RULES_FIELD, SHARED_TIMELINE_CACHE_SIZE, \
+    SHARED_TIMELINE_TTL, SHARED_TIMELINE_LOGIN_TTL, MAX_USER_TIMELINES, USER_SERVER_ID_FIELD, TIMELINE_KIND_FIELD, \
+    TIMELINE_VALUE_FIELD, TIMELINES_FIELD, INGESTION_WORKER_ID_SETTING, SHARDED_INGESTION_EXTENSION, \
+    INGESTION_PARTITIONS, INGESTION_VIRTUAL_NODES, INGESTION_LEASE_TTL, INGESTION_REBALANCE_INTERVAL, \
+    INGESTION_SYNC_INTERVAL, SNAPSHOT_TTL, SNAPSHOT_FOLLOW_TTL, PREFETCH_AT_LOGIN_SETTING, PREFETCH_CACHE_SIZE, \
+    PREFETCH_TTL, VERIFIED_DOMAIN_FIELD, MEDIA_PROXY_ALLOW_PRIVATE_SETTING
 from feed_amalgamator.helpers.custom_exceptions import (
     MastodonConnError, NoContentFoundError, InvalidDomainError, IntegrityError, InvalidApiInputError, AddServerInvalidCredentialsError, AddServerIntegrityError,
-    AddServerServiceUnavailableError)
+    AddServerServiceUnavailableError, InvalidCredentialsError, ServiceUnavailableError, FilterRuleError,
+    InvalidTimelineError)
+from feed_amalgamator.helpers.app_settings import read_app_settings
 from feed_amalgamator.helpers.logging_helper import LoggingHelper
-from feed_amalgamator.helpers.mastodon_data_interface import MastodonDataInterface
 from feed_amalgamator.helpers.mastodon_oauth_interface import MastodonOAuthInterface
-from feed_amalgamator.helpers.db_interface import dbi, UserServer
+from feed_amalgamator.helpers.post_view import PostView
+from feed_amalgamator.helpers.fragment_cache import FragmentCache
+from feed_amalgamator.helpers.feed_filter import CompiledFilter, FilterCache, RULE_KINDS, normalize_rule
+from feed_amalgamator.helpers.media_proxy import MediaCache, MediaFetchError, MediaProxy
+from feed_amalgamator.helpers.search_index import SearchIndex
+from feed_amalgamator.helpers.feed_updates import FeedSubscription
+from feed_amalgamator.helpers.timeline_fetcher import TimelineFetcher
+from feed_amalgamator.helpers.timeline_prefetch import PrefetchedTimelines
+from feed_amalgamator.helpers.user_client_pool import UserClientPool
+from feed_amalgamator.helpers.server_session import ServerSideSessionInterface
+from feed_amalgamator.helpers.timeline_store import TimelineStore
+from feed_amalgamator.helpers.timeline_sources import SharedTimelineCache, TIMELINE_KINDS, build_timeline_name
+from feed_amalgamator.helpers.stream_ingestion import StreamIngestionService
+from feed_amalgamator.helpers.ingestion_sharding import LeaseCoordinator, ShardedIngestion
+from feed_amalgamator.helpers.request_profiling import profiled_span
+from feed_amalgamator.helpers.db_interface import dbi, UserServer, FilterRule, UserTimeline
+from feed_amalgamator.auth import user_logged_in
 from feed_amalgamator.constants.error_messages import NO_CONTENT_FOUND_MSG, USER_SERVER_COMBI_ALREADY_EXISTS_MSG, \
     LOGIN_TOKEN_ERROR_MSG, AUTHORIZATION_TOKEN_REQUIRED_MSG, PASSWORD_REQUIRED_MSG, DOMAIN_REQUIRED_MSG, \
-    INVALID_DELETE_SERVER_RECORD_MSG, AUTH_CODE_ERROR_MSG, REDIRECT_HOME, REDIRECT_ADD_SERVER
+    INVALID_DELETE_SERVER_RECORD_MSG, AUTH_CODE_ERROR_MSG, REDIRECT_HOME, REDIRECT_ADD_SERVER, POST_FRAGMENT, \
+    FEED_SERVER_UNAVAILABLE_MSG, LOGIN_REQUIRED_MSG, SERVICE_UNAVAILABLE_MSG, REDIRECT_SEARCH, REDIRECT_FILTERS, \
+    INVALID_FILTER_RULE_MSG, FILTER_RULE_TOO_LONG_MSG, TOO_MANY_FILTER_RULES_MSG, FILTER_RULE_ALREADY_EXISTS_MSG, \
+    REDIRECT_TIMELINES, INVALID_TIMELINE_MSG, TOO_MANY_TIMELINES_MSG, TIMELINE_ALREADY_EXISTS_MSG
 
 bp = Blueprint("feed", __name__, url_prefix="/feed")
-parser = configparser.ConfigParser()
 # Setting up the loggers and interface layers
-with open(CONFIG_LOC) as file:
-    parser.read_file(file)
+parser = read_app_settings()
 log_file_loc = Path(parser["LOG_SETTINGS"]["feed_log_loc"])
 redirect_uri = parser["REDIRECT_URI"]["REDIRECT_URI"]
 logger = LoggingHelper.generate_logger(logging.INFO, log_file_loc, "feed_page")
 auth_api = MastodonOAuthInterface(logger, redirect_uri)
-data_api = MastodonDataInterface(logger)
+timeline_store = TimelineStore(TIMELINE_STORE_SIZE)
+user_client_pool = UserClientPool(USER_CLIENT_POOL_SIZE, USER_CLIENT_IDLE_TTL)
+# Opened by create_app
+search_index = SearchIndex(SEARCH_INDEX_MAX_POSTS, SEARCH_SEEN_CACHE_SIZE, SEARCH_RANK_CANDIDATES)
+shared_timelines = SharedTimelineCache(SHARED_TIMELINE_CACHE_SIZE, SHARED_TIMELINE_TTL, SHARED_TIMELINE_LOGIN_TTL)
+prefetched_timelines = PrefetchedTimelines(PREFETCH_CACHE_SIZE, PREFETCH_TTL)
+timeline_fetcher = TimelineFetcher(logger, FETCH_WORKERS, timeline_store, user_client_pool, search_index,
+                                   shared_timelines, prefetched_timelines)
+stream_ingestion = StreamIngestionService(logger, timeline_store, NUM_POSTS_TO_GET, STREAM_INITIAL_BACKOFF,
+                                          STREAM_MAX_BACKOFF, STREAM_READ_TIMEOUT)
+fragment_cache = FragmentCache(FRAGMENT_CACHE_SIZE, FRAGMENT_COUNT_BUCKET_SIZE)
+filter_cache = FilterCache(FILTER_CACHE_SIZE, FILTER_CACHE_TTL, FILTER_VERDICT_CACHE_SIZE)
+add_server_executor = ThreadPoolExecutor(max_workers=ADD_SERVER_WORKERS, thread_name_prefix="add-server")
 AUTH_LOGIN = "auth.login"
 
 
+def start_stream_ingestion():
+    """Subscribes to the home timeline stream of every user server. Must be called within an app context"""
+    user_servers = UserServer.query.all()
+    logger.info("Starting stream ingestion for {n} user servers".format(n=len(user_servers)))
+    for user_server in user_servers:
+        stream_ingestion.subscribe(user_server.server, user_server.token)
+
+
+def start_sharded_ingestion(app):
+    """Takes part in stream ingestion as one of several workers, each streaming a share of the user servers"""
+    worker_id = app.config.get(INGESTION_WORKER_ID_SETTING) or "{h}:{p}".format(h=socket.gethostname(),
+                                                                                p=os.getpid())
+    coordinator = LeaseCoordinator(worker_id, INGESTION_PARTITIONS, INGESTION_VIRTUAL_NODES, INGESTION_LEASE_TTL)
+    sharded_ingestion = ShardedIngestion(logger, coordinator, stream_ingestion, timeline_store, NUM_POSTS_TO_GET,
+                                         INGESTION_REBALANCE_INTERVAL, INGESTION_SYNC_INTERVAL, SNAPSHOT_TTL,
+                                         SNAPSHOT_FOLLOW_TTL)
+    app.extensions[SHARDED_INGESTION_EXTENSION] = sharded_ingestion
+    logger.info("Starting sharded stream ingestion as worker {w}".format(w=worker_id))
+    sharded_ingestion.start(app)
+
+
+def ensure_ingested(server_domain: str, access_token: str):
+    """Makes sure the home timeline of a user server is ingested, by this process or, with sharding, by the
+    worker owning the server. No-op for timelines that already are"""
+    sharded_ingestion = current_app.extensions.get(SHARDED_INGESTION_EXTENSION)
+    if sharded_ingestion is None:
+        stream_ingestion.subscribe(server_domain, access_token)
+    else:
+        sharded_ingestion.ensure(server_domain, access_token)
+
+
+def get_derived_state(state_name: str, derive: Callable[[], list]) -> list:
+    """
+    With server-side sessions, state derived from the database is derived once and kept in the session store until
+    it is invalidated. Otherwise, it is derived every time
+
+    :param state_name: Name of the state, unique across users
+    :param derive: Derives the state from the database
+    """
+    session_interface = current_app.session_interface
+    if not isinstance(session_interface, ServerSideSessionInterface):
+        return derive()
+    state = session_interface.get_derived_state(state_name)
+    if state is None:
+        state = derive()
+        session_interface.set_derived_state(state_name, state)
+    return state
+
+
+def get_user_server_tokens(user_id: int) -> list[tuple[str, str]]:
+    """
+    Gets the servers of a user. With server-side sessions, the list is derived from the database once and kept
+    in the session store until the user adds or deletes a server
+
+    :param user_id: Id of the user
+    :return: (server domain, access token) pairs of the user's servers
+    """
+    def derive() -> list[tuple[str, str]]:
+        user_servers = UserServer.query.filter_by(user_id=user_id).all()
+        logger.info("Found {n} servers tied to user id {i}".format(n=len(user_servers), i=user_id))
+        # These are user_server objects defined in the data interface. Treat them like python objects.
+        # Their attributes are read here, as the fetches themselves run on other threads
+        return [(user_server.server, user_server.token) for user_server in user_servers]
+    return get_derived_state("servers:{u}".format(u=user_id), derive)
+
+
+def get_user_timeline_sources(user_id: int) -> list[tuple[str, str, str]]:
+    """
+    Gets the timelines a user's feed is made of. Servers the user did not choose any timelines of contribute their
+    home timeline. Kept in the session store like the user's servers
+
+    :param user_id: Id of the user
+    :return: (server domain, access token, timeline name) of every timeline
+    """
+    def derive() -> list[tuple[str, str, str]]:
+        query = dbi.session.query(UserServer.server, UserServer.token, UserTimeline.timeline) \
+            .join(UserTimeline, UserTimeline.user_server_id == UserServer.user_server_id) \
+            .filter(UserTimeline.user_id == user_id)
+        return [tuple(row) for row in query.all()]
+
+    chosen_timelines = {}
+    for server, token, timeline_name in get_derived_state("timelines:{u}".format(u=user_id), derive):
+        chosen_timelines.setdefault((server, token), []).append(timeline_name)
+    return [(server, token, timeline_name) for server, token in get_user_server_tokens(user_id)
+            for timeline_name in sorted(chosen_timelines.get((server, token), [HOME_TIMELINE_NAME]))]
+
+
+def invalidate_user_server_tokens(user_id: int):
+    """Must be called whenever a user's servers or timelines change"""
+    session_interface = current_app.session_interface
+    if isinstance(session_interface, ServerSideSessionInterface):
+        for state_name in ("servers:{u}", "timelines:{u}"):
+            session_interface.invalidate_derived_state(state_name.format(u=user_id))
+
+
+@user_logged_in.connect
+def prefetch_user_feed(app, user_id: int, **extra):
+    """
+    Starts fetching the feed of a user who just logged in, while they are redirected to it. Their timelines are
+    fetched in the background, which also starts their server clients, and their mute filter is compiled
+
+    :param app: The app the user logged in to
+    :param user_id: Id of the user
+    """
+    if not app.config.get(PREFETCH_AT_LOGIN_SETTING, False):
+        return
+    sources = get_user_timeline_sources(user_id)
+    num_prefetches = timeline_fetcher.prefetch_sources(sources, NUM_POSTS_TO_GET)
+    get_user_filter(user_id)
+    logger.info("Prefetching {n} timelines of user id {i}".format(n=num_prefetches, i=user_id))
+
 
-def filter_sort_feed(timelines: list[dict]) -> list[dict]:
+def get_user_filter(user_id: int) -> CompiledFilter:
+    """Gets the compiled mute filter of a user, compiling it from the database if it is not cached"""
+    def load_rules() -> list[tuple[str, str]]:
+        return [(rule.kind, rule.value) for rule in FilterRule.query.filter_by(user_id=user_id).all()]
+    return filter_cache.get(user_id, load_rules)
+
+
+@profiled_span("filter_sort_feed")
+def filter_sort_feed(timelines: list[PostView], user_filter: CompiledFilter | None = None) -> list[PostView]:
     """
     Function that sorts and fiters the timeline
 
-    :param timelines: timeline data (list of dicts) to need to be filtered and sorted
+    :param timelines: timeline data (list of PostViews) to need to be filtered and sorted
+    :param user_filter: The user's mute filter. Posts it mutes are left out
     """
-    for post in timelines:
-        for delete in FILTER_LIST:
-            post.pop(delete)
+    # PostViews only hold rendered fields, so there are no unwanted keys left to strip here
+    # A post can be in several timelines of the same server, eg. home and a hashtag. It is only shown once
+    timelines = list({(post.original_server, post.id): post for post in timelines}.values())
+    if user_filter is not None:
+        timelines = user_filter.apply(timelines)
+    return sorted(timelines, key=lambda x: getattr(x, SORT_BY), reverse=True)
+
+
+def render_post_fragment(post: PostView) -> str:
+    """
+    Renders a single post into the HTML fragment stitched into the feed page
+
+    :param post: The post to render
+    """
+    # The fragment template only uses the post itself, so skip render_template's context processing
+    return current_app.jinja_env.get_template(POST_FRAGMENT).render(post=post)
+
 
-    return sorted(timelines, key=lambda x: x[SORT_BY], reverse=True)
+def should_stream_feed() -> bool:
+    """Whether the feed page should be streamed. Defaults to the STREAM_FEED app setting, and can be
+    overridden per request with ?stream=1 or ?stream=0"""
+    requested = request.args.get(STREAM_FEED_ARG)
+    if requested is not None:
+        return requested == "1"
+    return current_app.config.get(STREAM_FEED_SETTING, False)
+
+
+def stream_feed_fragments(sources: list[tuple[str, str, str]], user_filter: CompiledFilter) -> Iterator[Markup]:
+    """
+    Generator consumed by the streamed feed page. As it is lazy, the page shell is flushed to the browser
+    before any server is contacted
+
+    :param sources: (server domain, access token, timeline name) of the timelines the user's feed is made of
+    :param user_filter: The user's mute filter
+    :return: Yields the rendered post fragments in feed order, preceded by an error notice for every timeline
+    that could not be loaded
+    """
+    timelines = []
+    for server_domain, timeline, error in timeline_fetcher.fetch_sources_as_completed(sources, NUM_POSTS_TO_GET):
+        if error is not None:
+            # Headers are already sent, so the error handlers can no longer replace the page
+            logger.error("Encountered error {e} streaming the feed from {s}".format(e=error, s=server_domain))
+            yield Markup('<div class="flash">{m}: {s}</div>').format(m=FEED_SERVER_UNAVAILABLE_MSG, s=server_domain)
+            continue
+        timelines.extend(timeline)
+    # Posts are ranked across all servers, so they can only be sent once every fetch has completed
+    for post in filter_sort_feed(timelines, user_filter):
+        yield fragment_cache.get_or_render(post, render_post_fragment)
 
 
 @bp.route("/home", methods=["GET"])
@@ -54,28 +269,228 @@ def feed_home():
         if provided_user_id is None:
             return redirect(url_for(AUTH_LOGIN))
 
-        user_servers = UserServer.query.filter_by(user_id=provided_user_id).all()
-        if len(user_servers) == 0:
+        sources = get_user_timeline_sources(provided_user_id)
+        if len(sources) == 0:
             raise NoContentFoundError({"redirect_path": REDIRECT_HOME,
                                        "message": NO_CONTENT_FOUND_MSG})
         else:
-            logger.info("Found {n} servers tied to user id {i}".format(n=len(user_servers), i=provided_user_id))
-            timelines = []
-            for user_server in user_servers:
-                # These are user_server objects defined in the data interface. Treat them like python objects
-                server_domain = user_server.server
-                access_token = user_server.token
-                data_api.start_user_api_client(user_domain=server_domain, user_access_token=access_token)
+            if should_stream_feed():
+                user_filter = get_user_filter(provided_user_id)  # Loaded before the database session is released
+                return stream_template(REDIRECT_HOME, fragments=stream_feed_fragments(sources, user_filter))
+
+            timelines = timeline_fetcher.fetch_sources(sources, NUM_POSTS_TO_GET)
+            timelines = filter_sort_feed(timelines, get_user_filter(provided_user_id))
+            fragments = fragment_cache.render_all(timelines, render_post_fragment)
+            return render_template(REDIRECT_HOME, fragments=fragments)
 
-                timeline = data_api.get_timeline_data(HOME_TIMELINE_NAME, NUM_POSTS_TO_GET)
-                # Add server it was retrieved from to be accessed by frontend
-                for post in timeline:
-                    post[ORIGINAL_SERVER_FIELD] = server_domain
-                timelines.extend(timeline)
-            timelines = filter_sort_feed(timelines)
-            return render_template(REDIRECT_HOME, timelines=timelines)
+    return render_template(REDIRECT_HOME, fragments=None)  # Default return
 
-    return render_template(REDIRECT_HOME, timelines=None)  # Default return
+
+def compute_feed_etag(sources: list[tuple[str, str, str]], timelines: list[PostView],
+                      filter_fingerprint: str = "") -> str:
+    """
+    Computes a strong ETag for a feed from the latest status id of every server in it, and from the id, edit time
+    and counts of every post in it, in order. Favourites, boosts, edits and deletions change the feed and its ranking
+    without a new status, so the latest ids alone cannot tell if a client is up-to-date
+
+    :param sources: (server domain, access token, timeline name) of all timelines of the feed, including those that
+    returned no posts
+    :param timelines: The posts in the feed, filtered and sorted as they are served
+    :param filter_fingerprint: Fingerprint of the mute filter the feed is filtered with. Changing the rules changes
+    the feed
+    :return: The ETag, without quotes
+    """
+    latest_ids = {server: None for server, _, _ in sources}
+    for post in timelines:
+        latest_id = latest_ids.get(post.original_server)
+        if latest_id is None or post.id > latest_id:
+            latest_ids[post.original_server] = post.id
+    digest = hashlib.sha256(filter_fingerprint.encode("utf-8"))
+    for server, _, timeline_name in sorted(sources):
+        digest.update("{s} {t}\n".format(s=server, t=timeline_name).encode("utf-8"))
+    for server in sorted(latest_ids):
+        digest.update("{s}={i}\n".format(s=server, i=latest_ids[server]).encode("utf-8"))
+    for post in timelines:
+        digest.update("{s} {i} {e} {f} {r}\n".format(s=post.original_server, i=post.id, e=post.edited_at,
+                                                     f=post.favourites_count, r=post.reblogs_count).encode("utf-8"))
+    return digest.hexdigest()
+
+
+@bp.route("/api/home", methods=["GET"])
+def feed_api_home():
+    """JSON version of the feed page. Supports conditional GETs: when the If-None-Match header holds the ETag of
+    the previous response and the feed did not change since, 304 Not Modified is returned without a body"""
+    provided_user_id = session.get(USER_ID_FIELD)
+    if provided_user_id is None:
+        return jsonify({ERROR_FIELD: LOGIN_REQUIRED_MSG}), HTTPStatus.UNAUTHORIZED
+
+    sources = get_user_timeline_sources(provided_user_id)
+    try:
+        timelines = timeline_fetcher.fetch_sources(sources, NUM_POSTS_TO_GET)
+    except (ServiceUnavailableError, MastodonConnError, InvalidCredentialsError) as err:
+        logger.exception(err)
+        return jsonify({ERROR_FIELD: SERVICE_UNAVAILABLE_MSG}), HTTPStatus.SERVICE_UNAVAILABLE
+
+    user_filter = get_user_filter(provided_user_id)
+    timelines = filter_sort_feed(timelines, user_filter)
+    etag = compute_feed_etag(sources, timelines, user_filter.fingerprint)
+    if request.if_none_match.contains_weak(etag):  # Compressed responses carry the ETag as a weak one
+        # Skip serializing the feed entirely
+        response = current_app.response_class(status=HTTPStatus.NOT_MODIFIED)
+    else:
+        response = jsonify({POSTS_FIELD: [post.to_dict() for post in timelines]})
+    response.set_etag(etag)
+    # Clients may keep the feed, but must revalidate it before every use
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+def live_feed_events(server_tokens: list[tuple[str, str]], user_filter: CompiledFilter) -> Iterator[str]:
+    """
+    Generator of the Server-Sent Events stream of the live feed. Every new post is sent as a "post" event holding
+    its id, server and rendered fragment as JSON. Comments are sent as heartbeats while nothing happens, and a
+    "reload" event is sent if the page fell too far behind to be updated incrementally
+
+    :param server_tokens: (server domain, access token) pairs of the user's servers
+    :param user_filter: The user's mute filter, as of the connection. Muted posts are not sent
+    """
+    # Subscribing here rather than in the view ensures the finally clause, and thus unsubscribing, always runs
+    subscription = FeedSubscription(set(server_tokens), LIVE_FEED_QUEUE_SIZE)
+    timeline_store.subscribe(subscription)
+    deadline = time.monotonic() + LIVE_FEED_MAX_DURATION
+    try:
+        yield "retry: {r}\n\n".format(r=LIVE_FEED_RETRY_MS)
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return  # The browser reconnects after the retry delay
+            post = subscription.get(timeout=min(LIVE_FEED_HEARTBEAT_INTERVAL, remaining))
+            if subscription.overflowed:
+                yield "event: reload\ndata: \n\n"
+                return
+            if post is None:
+                yield ": heartbeat\n\n"
+                continue
+            if not user_filter.allows(post):
+                continue
+            data = json.dumps({"id": str(post.id), "server": post.original_server,
+                               "html": str(fragment_cache.get_or_render(post, render_post_fragment))})
+            yield "event: post\ndata: {d}\n\n".format(d=data)
+    finally:
+        timeline_store.unsubscribe(subscription)
+
+
+@bp.route("/live", methods=["GET"])
+def feed_live():
+    """Server-Sent Events stream that pushes new posts to an open feed page as they are ingested, so that users
+    do not have to reload the page to check for them. Only available when streaming ingestion is enabled"""
+    provided_user_id = session.get(USER_ID_FIELD)
+    if provided_user_id is None:
+        return jsonify({ERROR_FIELD: LOGIN_REQUIRED_MSG}), HTTPStatus.UNAUTHORIZED
+    if not current_app.config.get(STREAM_INGESTION_SETTING, False):
+        # Browsers stop reconnecting on 204 No Content
+        return current_app.response_class(status=HTTPStatus.NO_CONTENT)
+
+    server_tokens = get_user_server_tokens(provided_user_id)
+    for server_domain, access_token in server_tokens:
+        ensure_ingested(server_domain, access_token)
+
+    response = current_app.response_class(stream_with_context(live_feed_events(server_tokens,
+                                                                               get_user_filter(provided_user_id))),
+                                          mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"  # Keeps reverse proxies such as nginx from buffering the events
+    return response
+
+
+def search_user_posts(user_id: int) -> tuple[str, int, list[PostView], bool]:
+    """
+    Runs the search of the current request over the posts of a user's servers
+
+    :param user_id: Id of the user
+    :return: The query, the page, the posts on the page, and whether there are more pages
+    """
+    query = request.args.get(SEARCH_QUERY_ARG, "").strip()
+    page = max(request.args.get(SEARCH_PAGE_ARG, 1, type=int), 1)
+    if not query:
+        return query, page, [], False
+    started_at = time.perf_counter()
+    posts, has_more = search_index.search(get_user_server_tokens(user_id), query, page, SEARCH_PAGE_SIZE)
+    posts = get_user_filter(user_id).apply(posts)  # Muted posts leave gaps in their pages
+    logger.info("Searched for {q!r} (page {p}) in {t:.1f}ms, found {n} posts".format(
+        q=query, p=page, t=1000 * (time.perf_counter() - started_at), n=len(posts)))
+    return query, page, posts, has_more
+
+
+@bp.route("/search", methods=["GET"])
+def feed_search():
+    """Searches the posts of all of the user's servers that have been shown in their feed"""
+    provided_user_id = session.get(USER_ID_FIELD)
+    if provided_user_id is None:
+        return redirect(url_for(AUTH_LOGIN))
+    query, page, posts, has_more = search_user_posts(provided_user_id)
+    fragments = fragment_cache.render_all(posts, render_post_fragment)
+    return render_template(REDIRECT_SEARCH, query=query, page=page, fragments=fragments, has_more=has_more)
+
+
+@bp.route("/api/search", methods=["GET"])
+def feed_api_search():
+    """JSON version of the search page"""
+    provided_user_id = session.get(USER_ID_FIELD)
+    if provided_user_id is None:
+        return jsonify({ERROR_FIELD: LOGIN_REQUIRED_MSG}), HTTPStatus.UNAUTHORIZED
+    _, _, posts, has_more = search_user_posts(provided_user_id)
+    return jsonify({POSTS_FIELD: [post.to_dict() for post in posts], HAS_MORE_FIELD: has_more})
+
+
+def get_media_proxy() -> MediaProxy:
+    """Gets the media proxy of the current app, setting it up on first use"""
+    media_proxy = current_app.extensions.get(MEDIA_PROXY_EXTENSION)
+    if media_proxy is None:
+        cache_dir = current_app.config.get(MEDIA_CACHE_DIR_SETTING) or Path(current_app.instance_path, "media_cache")
+        media_proxy = MediaProxy(logger, MediaCache(Path(cache_dir), MEDIA_CACHE_MAX_BYTES), current_app.secret_key,
+                                 MEDIA_MAX_FETCH_BYTES,
+                                 current_app.config.get(MEDIA_PROXY_ALLOW_PRIVATE_SETTING, False))
+        # Two requests may set it up at once. Only the first one is kept
+        media_proxy = current_app.extensions.setdefault(MEDIA_PROXY_EXTENSION, media_proxy)
+    return media_proxy
+
+
+@bp.app_template_filter("proxied_media")
+def proxied_media(url: str | None, kind: str) -> str | None:
+    """
+    Template filter pointing an avatar or image at the media proxy, when the MEDIA_PROXY app setting is on
+
+    :param url: Url of the remote image
+    :param kind: Key of MEDIA_DISPLAY_WIDTHS the image is shown as, eg. "avatar"
+    :return: Url of the proxied image, or the remote url if the proxy is off
+    """
+    if not url or not current_app.config.get(MEDIA_PROXY_SETTING, False):
+        return url
+    return url_for("feed.media", token=get_media_proxy().sign(url, MEDIA_DISPLAY_WIDTHS[kind]))
+
+
+@bp.route("/media/<token>", methods=["GET"])
+def media(token: str):
+    """Serves a remote avatar or image, shrunk to the width signed into the token, from the on-disk cache. Images
+    that cannot be proxied are redirected to, so that they still show"""
+    media_proxy = get_media_proxy()
+    signed = media_proxy.unsign(token)
+    if signed is None:
+        abort(HTTPStatus.NOT_FOUND)
+    url, width = signed
+    try:
+        path = media_proxy.get(url, width)
+    except MediaFetchError as err:
+        logger.warning(err)
+        return redirect(url)
+
+    # Cached files are named after their digest. The modification time is not stable, as it tracks their use
+    response = send_file(path, max_age=MEDIA_CACHE_MAX_AGE, conditional=True, etag=path.stem)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    response.headers["X-Content-Type-Options"] = "nosniff"
+    return response
 
 
 @bp.route("/add_server", methods=["GET", "POST"])
@@ -90,6 +505,12 @@ def add_server():
     return render_template(REDIRECT_ADD_SERVER, is_domain_set=False)
 
 
+def run_in_app_context(app, func: Callable, *args):
+    """Runs a function on another thread within its own app context, so that it can use the database"""
+    with app.app_context():
+        return func(*args)
+
+
 def render_redirect_url_page():
     """Helper function to handle the logic for redirecting users to the Mastodon OAuth flow
     Should inherit the request and session of add_server"""
@@ -98,25 +519,29 @@ def render_redirect_url_page():
     logger.info("Rendering redirect url for user inputted domain {d}".format(d=domain))
     session[USER_DOMAIN_FIELD] = domain
 
-    is_valid_domain, parsed_domain = auth_api.verify_user_provided_domain(domain)
+    # Verifying the domain and looking up our app's credentials on it do not depend on each other, so they overlap.
+    # The lookup never registers, so it is harmless for domains that then fail verification
+    app = current_app._get_current_object()
+    verification = add_server_executor.submit(run_in_app_context, app, auth_api.verify_user_provided_domain, domain)
+    lookup = add_server_executor.submit(run_in_app_context, app, auth_api.find_app_credentials, domain)
+    is_valid_domain, parsed_domain = verification.result()
 
     if not is_valid_domain:
         error_message = parsed_domain  # If verify fails, error is returned in place of the domain
         raise InvalidDomainError({
             "redirect_path": REDIRECT_ADD_SERVER,
             "message": error_message})
-    app_token_obj = auth_api.check_if_domain_exists_in_database(parsed_domain)
-    if app_token_obj is not None:
-        logger.info("App token for domain found in database")
-        client_id = app_token_obj.client_id
-        client_secret = app_token_obj.client_secret
-        access_token = app_token_obj.access_token
-    else:
-        client_id, client_secret, access_token = auth_api.add_domain_to_database(parsed_domain)
-        logger.info("New domain added to the database")
-
-    auth_api.start_app_api_client(parsed_domain, client_id, client_secret, access_token)
-    url = auth_api.generate_redirect_url()
+    looked_up_domain, credentials = lookup.result()
+    if credentials is None or looked_up_domain != parsed_domain:
+        # First time domain (or the user typed a domain other than the canonical one). Registering only creates
+        # the client, as the app's access token is not needed for the redirect
+        credentials = auth_api.get_app_credentials(parsed_domain)
+    client_id, client_secret, access_token = credentials
+    session[VERIFIED_DOMAIN_FIELD] = parsed_domain  # The code the user comes back with is exchanged on it
+
+    # The interface is shared by all requests, so this request's client is passed along rather than kept in it
+    app_client = auth_api.start_app_api_client(parsed_domain, client_id, client_secret, access_token)
+    url = auth_api.generate_redirect_url(app_client=app_client)
     logger.info("Generated redirect url: {u}".format(u=url))
     return redirect(url)
 
@@ -132,7 +557,11 @@ def process_provided_auth_token(auth_token):
         try:
             # The auth_token input by the user is a one-time token used to generate the actual login token
             # Once the auth_token is used, it cannot be reused. We need to save the actual login token
-            access_token = auth_api.generate_user_access_token(auth_token)
+            # The client is started again, as the redirect may have been generated by another request or process
+            verified_domain = session.get(VERIFIED_DOMAIN_FIELD, domain)
+            client_id, client_secret, app_access_token = auth_api.get_app_credentials(verified_domain)
+            app_client = auth_api.start_app_api_client(verified_domain, client_id, client_secret, app_access_token)
+            access_token = auth_api.generate_user_access_token(auth_token, app_client=app_client)
             user_server_exists = UserServer.query.filter_by(user_id=user_id,
                                                             server=domain, token=access_token).first() is not None
             if user_server_exists:
@@ -142,6 +571,9 @@ def process_provided_auth_token(auth_token):
                 user_server_obj = UserServer(user_id=user_id, server=domain, token=access_token)
                 dbi.session.add(user_server_obj)
                 dbi.session.commit()
+                invalidate_user_server_tokens(user_id)
+                if current_app.config.get(STREAM_INGESTION_SETTING, False):
+                    ensure_ingested(domain, access_token)
         except MastodonConnError:
             raise AddServerServiceUnavailableError({"redirect_path": "feed.add_server",
                                                     "message": LOGIN_TOKEN_ERROR_MSG})
@@ -206,8 +638,12 @@ def delete_server():
         for server in servers:
             server = UserServer.query.filter_by(user_id=user_id, server=server).first()
             if server:
+                UserTimeline.query.filter_by(user_server_id=server.user_server_id).delete()
                 dbi.session.delete(server)
                 dbi.session.commit()
+                invalidate_user_server_tokens(user_id)
+                stream_ingestion.unsubscribe(server.server, server.token)
+                user_client_pool.discard((server.server, server.token))
                 logger.info("Deleted server {} of user {}".format(server.server, server.user_id))
             else:
                 invalid_record_msg = "{base}. Server: {s}".format(base=INVALID_DELETE_SERVER_RECORD_MSG, s=server)
@@ -222,3 +658,92 @@ def delete_server():
         if provided_user_id is None:
             return redirect(url_for(AUTH_LOGIN))
         return render_user_servers()
+
+
+def add_filter_rule(user_id: int, kind: str, value: str):
+    """Validates a mute filter rule typed in by the user, and adds it to their rules"""
+    value = normalize_rule(kind, value) if kind in RULE_KINDS else ""
+    if not value:
+        raise FilterRuleError({"redirect_path": "feed.filters", "message": INVALID_FILTER_RULE_MSG})
+    if len(value) > MAX_FILTER_RULE_LENGTH:
+        raise FilterRuleError({"redirect_path": "feed.filters", "message": FILTER_RULE_TOO_LONG_MSG})
+    if FilterRule.query.filter_by(user_id=user_id).count() >= MAX_FILTER_RULES:
+        raise FilterRuleError({"redirect_path": "feed.filters", "message": TOO_MANY_FILTER_RULES_MSG})
+    if FilterRule.query.filter_by(user_id=user_id, kind=kind, value=value).first() is not None:
+        raise FilterRuleError({"redirect_path": "feed.filters", "message": FILTER_RULE_ALREADY_EXISTS_MSG})
+    dbi.session.add(FilterRule(user_id=user_id, kind=kind, value=value))
+    dbi.session.commit()
+    filter_cache.invalidate(user_id)
+    logger.info("Added {k} filter rule for user {u}".format(k=kind, u=user_id))
+
+
+@bp.route("/filters", methods=["GET", "POST"])
+def filters():
+    """Endpoint for the user to mute words, accounts and domains across all of their servers"""
+    provided_user_id = session.get(USER_ID_FIELD)
+    if provided_user_id is None:
+        return redirect(url_for(AUTH_LOGIN))
+    if request.method == "POST":
+        if FILTER_VALUE_FIELD in request.form:
+            add_filter_rule(provided_user_id, request.form.get(FILTER_KIND_FIELD, ""), request.form[FILTER_VALUE_FIELD])
+        else:
+            rule_ids = request.form.getlist(FILTER_RULES_FIELD, type=int)
+            FilterRule.query.filter(FilterRule.user_id == provided_user_id,
+                                    FilterRule.filter_rule_id.in_(rule_ids)).delete()
+            dbi.session.commit()
+            filter_cache.invalidate(provided_user_id)
+            logger.info("Deleted {n} filter rules of user {u}".format(n=len(rule_ids), u=provided_user_id))
+        # Redirecting keeps a reload of the page from submitting the form again
+        return redirect(url_for("feed.filters"))
+    rules = FilterRule.query.filter_by(user_id=provided_user_id).order_by(FilterRule.kind, FilterRule.value).all()
+    return render_template(REDIRECT_FILTERS, rules=rules, rule_kinds=RULE_KINDS)
+
+
+def add_user_timeline(user_id: int, user_server_id: int | None, kind: str, value: str):
+    """Validates a timeline chosen by the user, and adds it to their feed"""
+    user_server = None if user_server_id is None else \
+        UserServer.query.filter_by(user_id=user_id, user_server_id=user_server_id).first()
+    timeline_name = build_timeline_name(kind, value)
+    if user_server is None or timeline_name is None:
+        raise InvalidTimelineError({"redirect_path": "feed.timelines", "message": INVALID_TIMELINE_MSG})
+    if UserTimeline.query.filter_by(user_id=user_id).count() >= MAX_USER_TIMELINES:
+        raise InvalidTimelineError({"redirect_path": "feed.timelines", "message": TOO_MANY_TIMELINES_MSG})
+    if UserTimeline.query.filter_by(user_server_id=user_server_id, timeline=timeline_name).first() is not None:
+        raise InvalidTimelineError({"redirect_path": "feed.timelines", "message": TIMELINE_ALREADY_EXISTS_MSG})
+    is_first_timeline = UserTimeline.query.filter_by(user_server_id=user_server_id).first() is None
+    if is_first_timeline and timeline_name != HOME_TIMELINE_NAME:
+        # Until now, the server contributed its home timeline without it being chosen. Adding another timeline
+        # should not take it away
+        dbi.session.add(UserTimeline(user_id=user_id, user_server_id=user_server_id, timeline=HOME_TIMELINE_NAME))
+    dbi.session.add(UserTimeline(user_id=user_id, user_server_id=user_server_id, timeline=timeline_name))
+    dbi.session.commit()
+    invalidate_user_server_tokens(user_id)
+    logger.info("Added timeline {t} of {s} to the feed of user {u}".format(t=timeline_name, s=user_server.server,
+                                                                          u=user_id))
+
+
+@bp.route("/timelines", methods=["GET", "POST"])
+def timelines():
+    """Endpoint for the user to choose the timelines of each of their servers their feed is made of"""
+    provided_user_id = session.get(USER_ID_FIELD)
+    if provided_user_id is None:
+        return redirect(url_for(AUTH_LOGIN))
+    if request.method == "POST":
+        if TIMELINE_KIND_FIELD in request.form:
+            add_user_timeline(provided_user_id, request.form.get(USER_SERVER_ID_FIELD, type=int),
+                              request.form[TIMELINE_KIND_FIELD], request.form.get(TIMELINE_VALUE_FIELD, ""))
+        else:
+            timeline_ids = request.form.getlist(TIMELINES_FIELD, type=int)
+            UserTimeline.query.filter(UserTimeline.user_id == provided_user_id,
+                                      UserTimeline.user_timeline_id.in_(timeline_ids)).delete()
+            dbi.session.commit()
+            invalidate_user_server_tokens(provided_user_id)
+            logger.info("Removed {n} timelines of user {u}".format(n=len(timeline_ids), u=provided_user_id))
+        # Redirecting keeps a reload of the page from submitting the form again
+        return redirect(url_for("feed.timelines"))
+    user_servers = UserServer.query.filter_by(user_id=provided_user_id).all()
+    chosen_timelines = {}
+    for user_timeline in UserTimeline.query.filter_by(user_id=provided_user_id).order_by(UserTimeline.timeline):
+        chosen_timelines.setdefault(user_timeline.user_server_id, []).append(user_timeline)
+    return render_template(REDIRECT_TIMELINES, user_servers=user_servers, chosen_timelines=chosen_timelines,
+                           timeline_kinds=TIMELINE_KINDS)
@@ -0,0 +1,17 @@
+"""The app settings file, read once per process rather than once by every module that needs it"""
+
+import configparser
+import functools
+
+from feed_amalgamator.constants.common_constants import CONFIG_LOC
+
+
+@functools.cache
+def read_app_settings() -> configparser.ConfigParser:
+    """
+    :return: The settings in CONFIG_LOC. Shared by all callers, so it must not be modified
+    """
+    parser = configparser.ConfigParser()
+    with open(CONFIG_LOC) as file:
+        parser.read_file(file)
+    return parser
@@ -0,0 +1,112 @@
+"""Process-wide registry of the app credentials our app holds on each Mastodon server.
+
+Credentials are read through from the application_tokens table and kept in memory, as they never change once
+registered. Registering on a new server is single-flight: when several users add the same new server at once,
+one of them registers our app while the others wait for, and share, the outcome.
+
+Registering only creates the client (client id and secret), which is all the OAuth flow needs. No access token
+is requested for the app itself"""
+
+import threading
+from collections.abc import Callable
+from typing import NamedTuple
+
+
+class AppCredentials(NamedTuple):
+    """Credentials of our app on a single server"""
+
+    client_id: str
+    client_secret: str
+    access_token: str | None
+    """None, unless the server was registered when the app still requested one"""
+
+
+class _Flight:
+    """A lookup (and possibly registration) in progress, which other threads wait on"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class AppTokenRegistry:
+    """Thread-safe, read-through cache of AppCredentials keyed by domain"""
+
+    def __init__(self):
+        self._credentials = {}
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def get_or_register(self, domain: str, load: Callable[[str], AppCredentials | None],
+                        register: Callable[[str], AppCredentials]) -> AppCredentials:
+        """
+        Gets the credentials for a domain, registering our app on it if there are none yet.
+        At most one load (and registration) per domain is in progress at a time, in this process
+
+        :param domain: Domain of the server
+        :param load: Reads the credentials from the database. Returns None if there are none
+        :param register: Registers our app on the server and stores the credentials in the database. Must cope with
+        another process having registered concurrently, which the database's unique constraint on the domain reveals
+        :return: The credentials
+        """
+        with self._lock:
+            credentials = self._credentials.get(domain)
+            if credentials is not None:
+                return credentials
+            flight = self._in_flight.get(domain)
+            is_leader = flight is None
+            if is_leader:
+                flight = _Flight()
+                self._in_flight[domain] = flight
+
+        if not is_leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            credentials = load(domain)
+            if credentials is None:
+                credentials = register(domain)
+            flight.result = credentials
+        except Exception as err:
+            # Failures are not cached: the next caller tries again
+            flight.error = err
+            raise
+        finally:
+            with self._lock:
+                if flight.error is None and flight.result is not None:
+                    self._credentials[domain] = flight.result
+                del self._in_flight[domain]
+            flight.done.set()
+        return credentials
+
+    def lookup(self, domain: str, load: Callable[[str], AppCredentials | None]) -> AppCredentials | None:
+        """
+        Gets the credentials for a domain without ever registering our app on it. Lookups do not join registrations
+        in flight, nor hold up registrations that start meanwhile, whose callers would otherwise share their None
+
+        :param domain: Domain of the server
+        :param load: Reads the credentials from the database. Returns None if there are none
+        :return: The credentials, or None if there are none yet
+        """
+        with self._lock:
+            credentials = self._credentials.get(domain)
+        if credentials is not None:
+            return credentials
+        credentials = load(domain)
+        if credentials is not None:
+            with self._lock:
+                self._credentials.setdefault(domain, credentials)
+        return credentials
+
+    def update(self, domain: str, credentials: AppCredentials):
+        """Sets the cached credentials of a domain, eg. when preloading them from the database"""
+        with self._lock:
+            self._credentials[domain] = credentials
+
+    def clear(self):
+        with self._lock:
+            self._credentials.clear()
@@ -60,3 +60,13 @@ class AddServerServiceUnavailableError(Exception):
 class AddServerInvalidCredentialsError(Exception):
     code = 403
     description = "Invalid Credentials when adding a new server"
+
+
+class FilterRuleError(Exception):
+    code = 400
+    description = "Invalid filter rule"
+
+
+class InvalidTimelineError(Exception):
+    code = 400
+    description = "Invalid timeline"
@@ -0,0 +1,140 @@
+"""Configuration of the database engine behind dbi.
+
+Covers the connection pool (sizing, health checks, recycling) and per-connection settings: a statement timeout on
+the production database, and WAL journaling with a busy timeout on SQLite, so that concurrent feed loads do not
+fail on a locked database. Connection checkouts are timed, as waiting for a free connection is otherwise invisible"""
+
+import configparser
+import logging
+import threading
+import time
+
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+from feed_amalgamator.constants.common_constants import DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, \
+    DB_POOL_RECYCLE, DB_STATEMENT_TIMEOUT, SQLITE_BUSY_TIMEOUT, DB_SLOW_CHECKOUT_THRESHOLD
+
+
+class PoolMetrics:
+    """Counters describing how long requests wait for a database connection, and how full the pool is"""
+
+    def __init__(self, logger: logging.Logger, capacity: int, slow_checkout_threshold: float):
+        """
+        :param logger: Slow checkouts are logged as warnings here
+        :param capacity: Connections the pool can hand out at once, overflow included
+        :param slow_checkout_threshold: Seconds of waiting after which a checkout is logged
+        """
+        self.logger = logger
+        self.capacity = capacity
+        self.slow_checkout_threshold = slow_checkout_threshold
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.peak_in_use = 0
+        self._lock = threading.Lock()
+
+    def record_checkout(self, wait: float, in_use: int):
+        with self._lock:
+            self.checkouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            self.peak_in_use = max(self.peak_in_use, in_use)
+        if wait >= self.slow_checkout_threshold:
+            self.logger.warning("Waited {w:.0f}ms for a database connection, {n}/{c} connections in use".format(
+                w=1000 * wait, n=in_use, c=self.capacity))
+
+    def record_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+        self.logger.error("Timed out waiting for a database connection, all {c} in use".format(c=self.capacity))
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "mean_wait_ms": 1000 * self.total_wait / max(self.checkouts, 1),
+                "max_wait_ms": 1000 * self.max_wait,
+                "peak_saturation": self.peak_in_use / self.capacity,
+            }
+
+
+def make_instrumented_pool_class(metrics: PoolMetrics) -> type[QueuePool]:
+    """Creates a QueuePool that reports every checkout to metrics. The engine instantiates the pool class itself,
+    so the metrics are bound to the class"""
+
+    class InstrumentedQueuePool(QueuePool):
+        def connect(self):
+            started_at = time.perf_counter()
+            try:
+                connection = super().connect()
+            except exc.TimeoutError:
+                metrics.record_timeout()
+                raise
+            metrics.record_checkout(time.perf_counter() - started_at, self.checkedout())
+            return connection
+
+    return InstrumentedQueuePool
+
+
+def build_engine_options(parser: configparser.ConfigParser, is_sqlite: bool,
+                         metrics_logger: logging.Logger) -> tuple[dict, PoolMetrics]:
+    """
+    Builds SQLALCHEMY_ENGINE_OPTIONS from the optional DATABASE settings
+
+    :param parser: The app settings
+    :param is_sqlite: Whether the database is SQLite (dev) rather than the production database
+    :param metrics_logger: Where slow checkouts are logged
+    :return: The engine options, and the metrics their pool reports to
+    """
+    pool_size = parser.getint("DATABASE", "POOL_SIZE", fallback=DB_POOL_SIZE)
+    max_overflow = parser.getint("DATABASE", "MAX_OVERFLOW", fallback=DB_MAX_OVERFLOW)
+    metrics = PoolMetrics(metrics_logger, pool_size + max_overflow,
+                          parser.getfloat("DATABASE", "SLOW_CHECKOUT_THRESHOLD", fallback=DB_SLOW_CHECKOUT_THRESHOLD))
+    engine_options = {
+        "poolclass": make_instrumented_pool_class(metrics),
+        "pool_size": pool_size,
+        "max_overflow": max_overflow,
+        "pool_timeout": parser.getfloat("DATABASE", "POOL_TIMEOUT", fallback=DB_POOL_TIMEOUT),
+    }
+    if is_sqlite:
+        # The sqlite3 driver's timeout is how long it waits for a lock held by another connection
+        engine_options["connect_args"] = {
+            "timeout": parser.getfloat("DATABASE", "SQLITE_BUSY_TIMEOUT", fallback=SQLITE_BUSY_TIMEOUT),
+        }
+    else:
+        # Connections to a remote server can be dropped by it or by the network while idle in the pool
+        engine_options["pool_pre_ping"] = True
+        engine_options["pool_recycle"] = parser.getint("DATABASE", "POOL_RECYCLE", fallback=DB_POOL_RECYCLE)
+    return engine_options, metrics
+
+
+def install_connection_settings(engine: Engine, parser: configparser.ConfigParser):
+    """
+    Applies per-connection settings to every new connection of the engine
+
+    :param engine: The engine, as created by dbi
+    :param parser: The app settings
+    """
+    if engine.dialect.name == "sqlite":
+        busy_timeout_ms = int(1000 * parser.getfloat("DATABASE", "SQLITE_BUSY_TIMEOUT", fallback=SQLITE_BUSY_TIMEOUT))
+
+        @event.listens_for(engine, "connect")
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            # WAL lets readers (feed loads) run alongside a writer instead of waiting for it
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")  # Safe with WAL, and avoids an fsync per commit
+            cursor.execute("PRAGMA busy_timeout={t}".format(t=busy_timeout_ms))
+            cursor.close()
+
+    elif engine.dialect.name == "mssql":
+        statement_timeout = parser.getint("DATABASE", "STATEMENT_TIMEOUT", fallback=DB_STATEMENT_TIMEOUT)
+
+        @event.listens_for(engine, "connect")
+        def set_statement_timeout(dbapi_connection, connection_record):
+            # pyodbc's query timeout, in seconds
+            dbapi_connection.timeout = statement_timeout
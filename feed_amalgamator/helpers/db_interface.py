@@ -1,6 +1,8 @@
 """Abstraction layer for connecting to the database.
 This allows for easier manipulation of the data. More importantly, it allows the program to work
 with any SQL backend, be it PostGRE or MySQl."""
+from datetime import datetime
+
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 
@@ -32,13 +34,87 @@ class UserServer(dbi.Model):
     token: Mapped[str] = mapped_column(dbi.String(500), nullable=False, name="token")
 
 
+class UserTimeline(dbi.Model):
+    """Class that represents the table that stores the timelines each users' feed is made of.
+    A server without any timelines in this table contributes its home timeline"""
+
+    __tablename__ = "user_timeline"
+    __table_args__ = (dbi.UniqueConstraint("user_server_id", "timeline"),)
+    user_timeline_id: Mapped[int] = mapped_column(dbi.Integer, primary_key=True, autoincrement=True, name="id")
+    user_id: Mapped[int] = mapped_column(dbi.Integer, dbi.ForeignKey("user.id"), index=True, name="user_id")
+    user_server_id: Mapped[int] = mapped_column(dbi.Integer, dbi.ForeignKey("user_server.id"),
+                                                name="user_server_id")
+    # As known to the Mastodon API, eg. home, local, public, tag/caturday or list/42
+    timeline: Mapped[str] = mapped_column(dbi.String(200), nullable=False, name="timeline")
+
+
+class FilterRule(dbi.Model):
+    """Class that represents the table that stores each users' mute filter rules"""
+
+    __tablename__ = "filter_rule"
+    __table_args__ = (dbi.UniqueConstraint("user_id", "kind", "value"),)
+    filter_rule_id: Mapped[int] = mapped_column(dbi.Integer, primary_key=True, autoincrement=True, name="id")
+    user_id: Mapped[int] = mapped_column(dbi.Integer, dbi.ForeignKey("user.id"), index=True, name="user_id")
+    kind: Mapped[str] = mapped_column(dbi.String(20), nullable=False, name="kind")  # word, account or domain
+    value: Mapped[str] = mapped_column(dbi.String(200), nullable=False, name="value")
+
+
 class ApplicationTokens(dbi.Model):
     """Class that represents the table for storing data related to clients for various servers"""
 
     __tablename__ = "application_tokens"
     server_id: Mapped[int] = mapped_column(dbi.Integer, primary_key=True, autoincrement=True, name="id")
-    server: Mapped[str] = mapped_column(dbi.String(100), nullable=False, name="server")
+    # Unique, so that concurrent registrations on the same server cannot both be stored
+    server: Mapped[str] = mapped_column(dbi.String(100), nullable=False, unique=True, name="server")
     client_id: Mapped[str] = mapped_column(dbi.String(500), nullable=False, name="client_id")
     client_secret: Mapped[str] = mapped_column(dbi.String(500), nullable=False, name="client_secret")
-    access_token: Mapped[str] = mapped_column(dbi.String(500), nullable=False, name="access_token")
+    # Null for servers registered without one. The OAuth flow only needs the client id and secret
+    access_token: Mapped[str | None] = mapped_column(dbi.String(500), nullable=True, name="access_token")
     redirect_uri: Mapped[str] = mapped_column(dbi.String(500), nullable=False, name="redirect_uri")
+
+
+class InstanceMetadata(dbi.Model):
+    """Class that represents the table caching the outcome of verifying user provided domains"""
+
+    __tablename__ = "instance_metadata"
+    instance_id: Mapped[int] = mapped_column(dbi.Integer, primary_key=True, autoincrement=True, name="id")
+    domain: Mapped[str] = mapped_column(dbi.String(100), nullable=False, unique=True, name="domain")
+    # Null when the domain is not a valid Mastodon instance
+    canonical_domain: Mapped[str | None] = mapped_column(dbi.String(100), nullable=True, name="canonical_domain")
+    version: Mapped[str | None] = mapped_column(dbi.String(100), nullable=True, name="version")
+    streaming_url: Mapped[str | None] = mapped_column(dbi.String(500), nullable=True, name="streaming_url")
+    rate_limit: Mapped[int | None] = mapped_column(dbi.Integer, nullable=True, name="rate_limit")
+    error_message: Mapped[str | None] = mapped_column(dbi.String(1000), nullable=True, name="error_message")
+    checked_at: Mapped[datetime] = mapped_column(dbi.DateTime(timezone=True), nullable=False, name="checked_at")
+
+
+class IngestionWorker(dbi.Model):
+    """Class that represents the table of processes taking part in sharded timeline ingestion"""
+
+    __tablename__ = "ingestion_worker"
+    worker_id: Mapped[str] = mapped_column(dbi.String(100), primary_key=True, name="worker_id")
+    heartbeat_at: Mapped[datetime] = mapped_column(dbi.DateTime(timezone=True), nullable=False, name="heartbeat_at")
+
+
+class PartitionLease(dbi.Model):
+    """Class that represents the table of which ingestion worker owns which partition of the server domains"""
+
+    __tablename__ = "partition_lease"
+    partition: Mapped[int] = mapped_column(dbi.Integer, primary_key=True, autoincrement=False, name="partition")
+    worker_id: Mapped[str] = mapped_column(dbi.String(100), nullable=False, name="worker_id")
+    expires_at: Mapped[datetime] = mapped_column(dbi.DateTime(timezone=True), nullable=False, name="expires_at")
+
+
+class TimelineSnapshot(dbi.Model):
+    """Class that represents the table of ingested timelines, as published by the worker ingesting them"""
+
+    __tablename__ = "timeline_snapshot"
+    __table_args__ = (dbi.UniqueConstraint("server", "token_digest"),)
+    snapshot_id: Mapped[int] = mapped_column(dbi.Integer, primary_key=True, autoincrement=True, name="id")
+    server: Mapped[str] = mapped_column(dbi.String(100), nullable=False, name="server")
+    # Hash of the access token, so that tokens are not copied around
+    token_digest: Mapped[str] = mapped_column(dbi.String(64), nullable=False, name="token_digest")
+    posts: Mapped[bytes] = mapped_column(dbi.LargeBinary, nullable=False, name="posts")  # See timeline_codec
+    updated_at: Mapped[datetime] = mapped_column(dbi.DateTime(timezone=True), nullable=False, name="updated_at")
+    # Renewed while the timeline is live. Followers stop trusting the snapshot when it is not renewed in time
+    live_until: Mapped[datetime] = mapped_column(dbi.DateTime(timezone=True), nullable=False, name="live_until")
@@ -2,23 +2,20 @@
 raised exceptions"""
 
 import logging
-import configparser
 from flask import render_template, redirect, url_for, flash
 from pathlib import Path
 
-from feed_amalgamator.constants.common_constants import CONFIG_LOC
+from feed_amalgamator.helpers.app_settings import read_app_settings
 from feed_amalgamator.helpers.custom_exceptions import (
     InvalidCredentialsError, NoContentFoundError, InvalidDomainError,
     ServiceUnavailableError, IntegrityError, AddServerIntegrityError, AddServerServiceUnavailableError,
-    AddServerInvalidCredentialsError)
+    AddServerInvalidCredentialsError, FilterRuleError, InvalidTimelineError)
 from feed_amalgamator.auth import bp as auth_bp
 from feed_amalgamator.feed import bp as feed_bp
 from feed_amalgamator.helpers.logging_helper import LoggingHelper
 
-parser = configparser.ConfigParser()
 # Setting up the loggers and interface layers
-with open(CONFIG_LOC) as file:
-    parser.read_file(file)
+parser = read_app_settings()
 log_file_loc = Path(parser["LOG_SETTINGS"]["feed_log_loc"])
 redirect_uri = parser["REDIRECT_URI"]["REDIRECT_URI"]
 feed_logger = LoggingHelper.generate_logger(logging.INFO, log_file_loc, "feed_page")
@@ -37,6 +34,7 @@ def handle_feed_exceptions(err):
 
 @auth_bp.errorhandler(InvalidCredentialsError)
 @auth_bp.errorhandler(IntegrityError)
+@auth_bp.errorhandler(ServiceUnavailableError)
 def handle_auth_exceptions(err):
     auth_logger.exception(err)
     return render_template(err.args[0]['redirect_path'], error_message=err.args[0]['message'])
@@ -45,6 +43,8 @@ def handle_auth_exceptions(err):
 @feed_bp.errorhandler(AddServerInvalidCredentialsError)
 @feed_bp.errorhandler(AddServerServiceUnavailableError)
 @feed_bp.errorhandler(AddServerIntegrityError)
+@feed_bp.errorhandler(FilterRuleError)
+@feed_bp.errorhandler(InvalidTimelineError)
 def handle_exception_and_redirect(err):
     feed_logger.exception(err)
     flash(err.args[0]['message'])
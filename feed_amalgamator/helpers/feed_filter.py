@@ -0,0 +1,184 @@
+"""Per-user mute filters, applied to the posts of all servers when their timelines are merged into the feed.
+
+A user's rules mute words (or phrases, or hashtags), accounts and whole domains. They are compiled once into a
+single pattern matching all muted words, built from a trie of the words so that the regex engine never backtracks
+over more than one branch per character, and into sets of accounts and domains. Compiled filters are cached per
+user, and every filter remembers its verdict on the posts it has seen, so the posts of a reloaded feed are not
+matched again"""
+
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable, Iterable
+from urllib.parse import urlsplit
+
+from feed_amalgamator.helpers.post_view import PostView
+from feed_amalgamator.helpers.search_index import strip_html
+
+WORD_RULE = "word"
+ACCOUNT_RULE = "account"
+DOMAIN_RULE = "domain"
+RULE_KINDS = (WORD_RULE, ACCOUNT_RULE, DOMAIN_RULE)
+
+
+def normalize_rule(kind: str, value: str) -> str:
+    """
+    Brings a rule into the form it is matched in. Accounts lose their leading @, domains their scheme and path
+
+    :param kind: One of RULE_KINDS
+    :param value: The rule, as typed by the user
+    :return: The normalized rule, or an empty string if nothing is left to match
+    """
+    value = " ".join(value.split()).casefold()
+    if kind == ACCOUNT_RULE:
+        return value.lstrip("@")
+    if kind == DOMAIN_RULE:
+        if "://" in value:
+            value = urlsplit(value).hostname or ""
+        return value.strip("./@")
+    return value
+
+
+def _trie_pattern(trie: dict) -> str:
+    """Regex matching every word of a trie. The empty key marks the end of a word"""
+    is_word_end = "" in trie
+    branches = [re.escape(char) + _trie_pattern(child) for char, child in sorted(trie.items()) if char]
+    if not branches:
+        return ""
+    if len(branches) == 1 and not is_word_end:
+        return branches[0]
+    pattern = "(?:" + "|".join(branches) + ")"
+    return pattern + "?" if is_word_end else pattern
+
+
+def compile_words(words: Iterable[str]) -> re.Pattern | None:
+    """
+    Compiles muted words into one pattern. Words only match whole, so that muting "cat" does not hide "category"
+
+    :param words: Normalized (casefolded) words or phrases
+    :return: The pattern, to be searched in casefolded text, or None if there are no words
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+    if not trie:
+        return None
+    return re.compile(r"(?<!\w)" + _trie_pattern(trie) + r"(?!\w)")
+
+
+def author_domain(post: PostView) -> str:
+    """Domain of a post's author. Accounts on the server the post was fetched from have no domain in their acct"""
+    acct = post.account.acct
+    if "@" in acct:
+        return acct.rsplit("@", 1)[1].casefold()
+    server = post.original_server or ""
+    if "://" in server:
+        server = urlsplit(server).hostname or ""
+    return server.casefold()
+
+
+class CompiledFilter:
+    """The mute rules of a user, compiled for matching. Thread-safe"""
+
+    def __init__(self, rules: Iterable[tuple[str, str]], verdict_cache_size: int):
+        """
+        :param rules: (kind, normalized value) pairs
+        :param verdict_cache_size: Posts whose verdict is remembered
+        """
+        rules = sorted(set(rules))
+        self.fingerprint = hashlib.sha256(repr(rules).encode("utf-8")).hexdigest()[:16]
+        """Changes whenever the rules do, eg. to tell apart feeds filtered by different rules"""
+        self.words = compile_words(value for kind, value in rules if kind == WORD_RULE)
+        self.accounts = frozenset(value for kind, value in rules if kind == ACCOUNT_RULE)
+        self.domains = frozenset(value for kind, value in rules if kind == DOMAIN_RULE)
+        self.is_empty = not rules
+        self.verdict_cache_size = verdict_cache_size
+        self._verdicts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _is_muted(self, post: PostView) -> bool:
+        domain = author_domain(post)
+        if self.domains:
+            # Muting a domain mutes its subdomains too
+            labels = domain.split(".")
+            if any(".".join(labels[i:]) in self.domains for i in range(len(labels))):
+                return True
+        if self.accounts:
+            username = post.account.acct.split("@", 1)[0].casefold()
+            if "{u}@{d}".format(u=username, d=domain) in self.accounts:
+                return True
+        if self.words is not None:
+            text = strip_html(post.content).casefold()
+            if self.words.search(text) is not None or any(
+                    media.description and self.words.search(media.description.casefold()) for media in post.media):
+                return True
+        return False
+
+    def allows(self, post: PostView) -> bool:
+        """Whether the post is shown. Evaluated once per version of a post"""
+        if self.is_empty:
+            return True
+        key = (post.original_server, post.uri or post.id, post.edited_at)
+        with self._lock:
+            verdict = self._verdicts.get(key)
+            if verdict is not None:
+                self._verdicts.move_to_end(key)
+                return verdict
+        verdict = not self._is_muted(post)
+        with self._lock:
+            self._verdicts[key] = verdict
+            while len(self._verdicts) > self.verdict_cache_size:
+                self._verdicts.popitem(last=False)
+        return verdict
+
+    def apply(self, posts: Iterable[PostView]) -> list[PostView]:
+        """:return: The posts that are shown, in the same order"""
+        return [post for post in posts if self.allows(post)]
+
+
+class FilterCache:
+    """Thread-safe, size-bounded LRU cache of the compiled filters of users"""
+
+    def __init__(self, max_users: int, ttl: float, verdict_cache_size: int):
+        """
+        :param max_users: Users whose filter is kept compiled
+        :param ttl: Seconds a compiled filter is used before it is compiled again. Only matters when several
+        processes serve the app, as each process only hears of the rule changes it makes itself
+        :param verdict_cache_size: Passed on to every CompiledFilter
+        """
+        self.max_users = max_users
+        self.ttl = ttl
+        self.verdict_cache_size = verdict_cache_size
+        self._filters = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int, load_rules: Callable[[], Iterable[tuple[str, str]]]) -> CompiledFilter:
+        """
+        :param user_id: Id of the user
+        :param load_rules: Loads the (kind, normalized value) rules of the user. Only called when the filter is
+        not cached
+        :return: The compiled filter of the user
+        """
+        now = time.monotonic()
+        with self._lock:
+            cached = self._filters.get(user_id)
+            if cached is not None and now - cached[1] < self.ttl:
+                self._filters.move_to_end(user_id)
+                return cached[0]
+        compiled_filter = CompiledFilter(load_rules(), self.verdict_cache_size)
+        with self._lock:
+            self._filters[user_id] = (compiled_filter, now)
+            self._filters.move_to_end(user_id)
+            while len(self._filters) > self.max_users:
+                self._filters.popitem(last=False)
+        return compiled_filter
+
+    def invalidate(self, user_id: int):
+        """Must be called whenever the rules of a user change"""
+        with self._lock:
+            self._filters.pop(user_id, None)
@@ -0,0 +1,47 @@
+"""Delivery of newly ingested posts to open feed pages.
+
+Every open page holds a FeedSubscription to the TimelineStore, covering the timelines of the user's servers.
+The store hands new posts to the subscription as they are ingested, and the live updates endpoint drains them
+into the page's Server-Sent Events stream"""
+
+import queue
+
+from feed_amalgamator.helpers.post_view import PostView
+
+
+class FeedSubscription:
+    """Bounded buffer of new posts for a single open feed page.
+
+    Posts are offered by the ingestion threads and consumed by the thread serving the page. A page that does not
+    keep up (eg. a stalled connection) must not make the buffer grow without limit, so once it is full the
+    subscription is marked as overflowed and further posts are dropped. The page is then told to reload instead"""
+
+    def __init__(self, keys: set[tuple[str, str]], max_queued_posts: int):
+        """
+        :param keys: (server domain, access token) of every timeline the page shows
+        :param max_queued_posts: Number of posts buffered before the subscription overflows
+        """
+        self.keys = frozenset(keys)
+        self.overflowed = False
+        self._posts = queue.Queue(maxsize=max_queued_posts)
+
+    def offer(self, post: PostView):
+        """Buffers a post without ever blocking the caller, which is an ingestion thread"""
+        if self.overflowed:
+            return
+        try:
+            self._posts.put_nowait(post)
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout: float) -> PostView | None:
+        """
+        Waits for the next post
+
+        :param timeout: Seconds to wait at most
+        :return: The post, or None if no post arrived in time
+        """
+        try:
+            return self._posts.get(timeout=timeout)
+        except queue.Empty:
+            return None
@@ -0,0 +1,80 @@
+"""Cache for the rendered HTML of individual posts.
+
+A status' markup rarely changes between two loads of the feed, so each post is rendered into its own fragment
+once and the feed page is stitched together from cached fragments. Only new or changed posts are re-rendered"""
+
+import threading
+from collections import OrderedDict
+from collections.abc import Callable
+
+from markupsafe import Markup
+
+from feed_amalgamator.helpers.post_view import PostView
+
+
+class FragmentCache:
+    """Thread-safe, size-bounded LRU cache of rendered post fragments"""
+
+    def __init__(self, max_entries: int, count_bucket_size: int):
+        """
+        :param max_entries: Maximum number of fragments kept. The least recently used ones are evicted first
+        :param count_bucket_size: Reblog and favourite counts are bucketed by this much before being used in
+        the cache key, so that every new favourite does not force a re-render
+        """
+        self.max_entries = max_entries
+        self.count_bucket_size = count_bucket_size
+        self.hits = 0
+        self.misses = 0
+        self._fragments = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key_for(self, post: PostView) -> tuple:
+        """
+        Builds the cache key for a post: anything that changes the rendered markup must be part of it
+
+        :param post: The post to build the key for
+        :return: (status uri, edited_at, counts bucket, original server)
+        """
+        counts_bucket = (post.reblogs_count // self.count_bucket_size,
+                         post.favourites_count // self.count_bucket_size)
+        # The same status fetched via two servers is shown with a different "original server" line
+        return post.uri, post.edited_at, counts_bucket, post.original_server
+
+    def get_or_render(self, post: PostView, render_func: Callable[[PostView], str]) -> Markup:
+        """
+        Returns the cached fragment for a post, rendering (and caching) it first if needed
+
+        :param post: The post to get the fragment for
+        :param render_func: Renders a single post into HTML
+        :return: The fragment, marked safe so the page template does not escape it again
+        """
+        key = self.key_for(post)
+        with self._lock:
+            fragment = self._fragments.get(key)
+            if fragment is not None:
+                self._fragments.move_to_end(key)
+                self.hits += 1
+                return fragment
+            self.misses += 1
+
+        # Render outside the lock. Two threads may render the same post at once, which is harmless
+        fragment = Markup(render_func(post))
+        with self._lock:
+            self._fragments[key] = fragment
+            self._fragments.move_to_end(key)
+            while len(self._fragments) > self.max_entries:
+                self._fragments.popitem(last=False)
+        return fragment
+
+    def render_all(self, posts: list[PostView], render_func: Callable[[PostView], str]) -> list[Markup]:
+        """Returns the fragments for a list of posts, in the same order"""
+        return [self.get_or_render(post, render_func) for post in posts]
+
+    def clear(self):
+        with self._lock:
+            self._fragments.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._fragments)
@@ -0,0 +1,310 @@
+"""Sharding of streaming ingestion across the processes and nodes serving the app.
+
+Without sharding, every process streams the home timeline of every user server. With sharding, server domains are
+split into a fixed number of partitions, and every partition is ingested by a single worker, so that ingestion
+capacity grows with the number of workers. As all timelines of a domain are ingested by the same worker, all
+streaming requests to an instance, and so its rate limit, stay in one place.
+
+Partitions are assigned to the live workers by a consistent hash ring, so a worker joining or leaving only moves
+the partitions it gains or loses. Ownership is enforced by leases in the database: a worker only ingests the
+partitions it holds the lease of, and the leases of a worker that stops renewing them (eg. because it crashed)
+expire, for the others to take over.
+
+Ingested timelines live in the memory of the worker ingesting them. The worker publishes them to the
+timeline_snapshot table, and every other process mirrors the snapshots of the timelines it is asked for into its
+own TimelineStore, so that feeds and live feeds are served from whichever process gets the request"""
+
+import bisect
+import hashlib
+import logging
+import threading
+import time
+from collections.abc import Iterable
+from datetime import datetime, timedelta, timezone
+
+import sqlalchemy.exc
+from flask import Flask
+
+from feed_amalgamator.helpers.db_interface import dbi, IngestionWorker, PartitionLease, TimelineSnapshot, UserServer
+from feed_amalgamator.helpers.stream_ingestion import StreamIngestionService
+from feed_amalgamator.helpers.timeline_codec import decode_timeline, encode_timeline
+from feed_amalgamator.helpers.timeline_store import TimelineStore
+
+SNAPSHOT_QUERY_CHUNK_SIZE = 500  # Keeps IN clauses below the bound parameter limits of the databases
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.sha256(value.encode("utf-8")).digest()[:8], "big")
+
+
+def partition_of(server_domain: str, num_partitions: int) -> int:
+    """:return: The partition the timelines of a server domain belong to"""
+    return _hash(server_domain.casefold()) % num_partitions
+
+
+def token_digest(access_token: str) -> str:
+    return hashlib.sha256(access_token.encode("utf-8")).hexdigest()
+
+
+class ConsistentHashRing:
+    """Assigns partitions to workers, so that adding or removing a worker only moves about 1/N of them"""
+
+    def __init__(self, worker_ids: Iterable[str], virtual_nodes: int):
+        """
+        :param worker_ids: Ids of the live workers
+        :param virtual_nodes: Points every worker has on the ring. More points spread partitions more evenly
+        """
+        self._ring = sorted((_hash("{w}#{i}".format(w=worker_id, i=i)), worker_id)
+                            for worker_id in set(worker_ids) for i in range(virtual_nodes))
+        self._hashes = [point for point, _ in self._ring]
+
+    def owner(self, partition: int) -> str | None:
+        """:return: Id of the worker the partition is assigned to, or None if there are no workers"""
+        if not self._ring:
+            return None
+        index = bisect.bisect(self._hashes, _hash("partition-{p}".format(p=partition))) % len(self._ring)
+        return self._ring[index][1]
+
+
+class LeaseCoordinator:
+    """Membership and partition leases of one worker, kept in the database"""
+
+    def __init__(self, worker_id: str, num_partitions: int, virtual_nodes: int, lease_ttl: float):
+        """
+        :param worker_id: Unique id of this worker, eg. host name and process id
+        :param num_partitions: Partitions the server domains are split into. Must be the same for all workers
+        :param virtual_nodes: Points every worker has on the consistent hash ring
+        :param lease_ttl: Seconds a lease (and a worker's membership) lasts unless renewed. heartbeat must be called
+        well within this time
+        """
+        self.worker_id = worker_id
+        self.num_partitions = num_partitions
+        self.virtual_nodes = virtual_nodes
+        self.lease_ttl = lease_ttl
+
+    def heartbeat(self) -> frozenset[int]:
+        """
+        Renews this worker's membership, gives up the partitions now assigned to other workers and takes the ones
+        assigned to it, as soon as their previous owner gave them up or their lease expired. Must be called within
+        an app context
+
+        :return: The partitions this worker holds the lease of
+        """
+        now = datetime.now(timezone.utc)
+        expires_at = now + timedelta(seconds=self.lease_ttl)
+        worker = dbi.session.get(IngestionWorker, self.worker_id)
+        if worker is None:
+            dbi.session.add(IngestionWorker(worker_id=self.worker_id, heartbeat_at=now))
+        else:
+            worker.heartbeat_at = now
+        # Workers that have been gone for long are forgotten. Recently gone ones are just left off the ring
+        IngestionWorker.query.filter(IngestionWorker.heartbeat_at < now - 10 * timedelta(seconds=self.lease_ttl)) \
+            .delete(synchronize_session=False)
+        dbi.session.commit()
+
+        live_workers = [worker_id for (worker_id,) in dbi.session.query(IngestionWorker.worker_id).filter(
+            IngestionWorker.heartbeat_at > now - timedelta(seconds=self.lease_ttl))]
+        ring = ConsistentHashRing(live_workers, self.virtual_nodes)
+        assigned = [partition for partition in range(self.num_partitions) if ring.owner(partition) == self.worker_id]
+
+        # Partitions now assigned to others are given up right away, so that they do not wait for the lease to expire
+        PartitionLease.query.filter(PartitionLease.worker_id == self.worker_id,
+                                    PartitionLease.partition.notin_(assigned)).delete(synchronize_session=False)
+        PartitionLease.query.filter(PartitionLease.worker_id == self.worker_id,
+                                    PartitionLease.partition.in_(assigned)).update(
+            {PartitionLease.expires_at: expires_at}, synchronize_session=False)
+        dbi.session.commit()
+
+        lease_holders = dict(dbi.session.query(PartitionLease.partition, PartitionLease.worker_id).filter(
+            PartitionLease.partition.in_(assigned)).all())
+        for partition in assigned:
+            if lease_holders.get(partition) == self.worker_id:
+                continue
+            if partition in lease_holders:
+                # Taken over only once expired. The condition makes the takeover atomic between workers
+                PartitionLease.query.filter(PartitionLease.partition == partition, PartitionLease.expires_at < now) \
+                    .update({PartitionLease.worker_id: self.worker_id, PartitionLease.expires_at: expires_at},
+                            synchronize_session=False)
+                dbi.session.commit()
+                continue
+            try:
+                dbi.session.add(PartitionLease(partition=partition, worker_id=self.worker_id, expires_at=expires_at))
+                dbi.session.commit()
+            except sqlalchemy.exc.IntegrityError:
+                dbi.session.rollback()  # Another worker took it first, and will give it up on its next heartbeat
+
+        return frozenset(partition for (partition,) in dbi.session.query(PartitionLease.partition).filter(
+            PartitionLease.worker_id == self.worker_id, PartitionLease.expires_at > now))
+
+    def leave(self):
+        """Gives up all partitions and leaves the ring, eg. on shutdown. Must be called within an app context"""
+        PartitionLease.query.filter_by(worker_id=self.worker_id).delete(synchronize_session=False)
+        IngestionWorker.query.filter_by(worker_id=self.worker_id).delete(synchronize_session=False)
+        dbi.session.commit()
+
+
+class ShardedIngestion:
+    """Streams the timelines of the partitions this worker holds, publishes them, and mirrors the published
+    timelines of the other workers that this process is asked for"""
+
+    def __init__(self, logger: logging.Logger, coordinator: LeaseCoordinator,
+                 stream_ingestion: StreamIngestionService, timeline_store: TimelineStore, num_posts_to_publish: int,
+                 rebalance_interval: float, sync_interval: float, snapshot_ttl: float, follow_ttl: float):
+        """
+        :param logger: Logger for ownership changes and errors
+        :param coordinator: Leases of this worker
+        :param stream_ingestion: Streams the timelines of this worker's partitions
+        :param timeline_store: Where streamed timelines are read from, and mirrored timelines are written to
+        :param num_posts_to_publish: Newest posts of a timeline that are published
+        :param rebalance_interval: Seconds between heartbeats. Must be well below the lease ttl
+        :param sync_interval: Seconds between publishing changed timelines and mirroring published ones
+        :param snapshot_ttl: Seconds a published timeline is trusted to be live without being renewed
+        :param follow_ttl: Seconds a timeline of another worker is mirrored after it was last asked for
+        """
+        self.logger = logger
+        self.coordinator = coordinator
+        self.stream_ingestion = stream_ingestion
+        self.timeline_store = timeline_store
+        self.num_posts_to_publish = num_posts_to_publish
+        self.rebalance_interval = rebalance_interval
+        self.sync_interval = sync_interval
+        self.snapshot_ttl = snapshot_ttl
+        self.follow_ttl = follow_ttl
+        self._owned = frozenset()
+        self._followed = {}
+        self._mirrored = {}
+        self._published = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self, app: Flask):
+        """Starts the background thread taking part in ingestion"""
+        self.timeline_store.on_miss = self.follow
+        self._thread = threading.Thread(target=self._run, args=(app,), daemon=True, name="sharded-ingestion")
+        self._thread.start()
+
+    def stop(self, app: Flask):
+        """Stops ingesting, and hands this worker's partitions over to the other workers"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.stream_ingestion.stop_all()
+        with app.app_context():
+            self.coordinator.leave()
+
+    def owns(self, server_domain: str) -> bool:
+        return partition_of(server_domain, self.coordinator.num_partitions) in self._owned
+
+    def ensure(self, server_domain: str, access_token: str):
+        """Makes sure a timeline is ingested: streamed if this worker owns it, mirrored from its owner if not"""
+        if self.owns(server_domain):
+            self.stream_ingestion.subscribe(server_domain, access_token)
+        else:
+            self.follow((server_domain, access_token))
+
+    def follow(self, key: tuple[str, str]):
+        """Mirrors the timeline from now on, unless this worker ingests it itself"""
+        if not self.owns(key[0]):
+            with self._lock:
+                self._followed[key] = time.monotonic()
+
+    def _run(self, app: Flask):
+        next_rebalance = 0.0
+        while not self._stop_event.is_set():
+            with app.app_context():
+                try:
+                    if time.monotonic() >= next_rebalance:
+                        self._rebalance()
+                        next_rebalance = time.monotonic() + self.rebalance_interval
+                    self._publish()
+                    self._mirror()
+                except Exception as err:
+                    # The next round tries again. Leases run out before anything is ingested twice for long
+                    dbi.session.rollback()
+                    self.logger.exception("Unexpected error {e} in sharded ingestion".format(e=err))
+            self._stop_event.wait(self.sync_interval)
+
+    def _rebalance(self):
+        owned = self.coordinator.heartbeat()
+        if owned != self._owned:
+            self.logger.info("Ingestion worker {w} now owns {n} partitions".format(w=self.coordinator.worker_id,
+                                                                                n=len(owned)))
+        self._owned = owned
+        assigned_keys = {(server, token) for server, token in dbi.session.query(UserServer.server, UserServer.token)
+                         if self.owns(server)}
+        for server_domain, access_token in self.stream_ingestion.subscribed_keys() - assigned_keys:
+            self.stream_ingestion.unsubscribe(server_domain, access_token)
+            self._published.pop((server_domain, access_token), None)
+        for server_domain, access_token in assigned_keys:
+            self.stream_ingestion.subscribe(server_domain, access_token)  # No-op for timelines already streamed
+        TimelineSnapshot.query.filter(
+            TimelineSnapshot.live_until < datetime.now(timezone.utc) - timedelta(days=1)).delete(
+            synchronize_session=False)
+        dbi.session.commit()
+
+    def _publish(self):
+        """Writes the timelines streamed by this worker that changed, and renews the others"""
+        dirty = self.timeline_store.pop_dirty()
+        now = datetime.now(timezone.utc)
+        live_until = now + timedelta(seconds=self.snapshot_ttl)
+        renew_before = time.monotonic() - self.snapshot_ttl / 3
+        to_renew = []
+        for key in self.stream_ingestion.subscribed_keys():
+            if not self.timeline_store.is_live(key):
+                continue
+            if key in dirty or key not in self._published:
+                server_domain, access_token = key
+                digest = token_digest(access_token)
+                snapshot = TimelineSnapshot.query.filter_by(server=server_domain, token_digest=digest).first()
+                if snapshot is None:
+                    snapshot = TimelineSnapshot(server=server_domain, token_digest=digest)
+                    dbi.session.add(snapshot)
+                posts = self.timeline_store.get_live(key, self.num_posts_to_publish) or []
+                snapshot.posts = encode_timeline(posts, compress=True)
+                snapshot.updated_at = now
+                snapshot.live_until = live_until
+                self._published[key] = time.monotonic()
+            elif self._published[key] < renew_before:
+                to_renew.append(token_digest(key[1]))
+                self._published[key] = time.monotonic()
+        for start in range(0, len(to_renew), SNAPSHOT_QUERY_CHUNK_SIZE):
+            TimelineSnapshot.query.filter(TimelineSnapshot.token_digest.in_(
+                to_renew[start:start + SNAPSHOT_QUERY_CHUNK_SIZE])).update(
+                {TimelineSnapshot.live_until: live_until}, synchronize_session=False)
+        dbi.session.commit()
+
+    def _mirror(self):
+        """Copies the published timelines this process was asked for into its TimelineStore"""
+        now = time.monotonic()
+        subscribed_keys = self.timeline_store.subscribed_keys()
+        with self._lock:
+            for key, followed_at in list(self._followed.items()):
+                if now - followed_at > self.follow_ttl and key not in subscribed_keys:
+                    del self._followed[key]
+                    self._mirrored.pop(key, None)
+                    self.timeline_store.discard(key)
+            keys = [key for key in set(self._followed) | subscribed_keys if not self.owns(key[0])]
+
+        digests = {(server, token_digest(token)): (server, token) for server, token in keys}
+        fresh_snapshots = {}
+        digest_list = list({digest for _, digest in digests})
+        for start in range(0, len(digest_list), SNAPSHOT_QUERY_CHUNK_SIZE):
+            for snapshot in TimelineSnapshot.query.filter(
+                    TimelineSnapshot.token_digest.in_(digest_list[start:start + SNAPSHOT_QUERY_CHUNK_SIZE]),
+                    TimelineSnapshot.live_until > datetime.now(timezone.utc)):
+                key = digests.get((snapshot.server, snapshot.token_digest))
+                if key is not None:
+                    fresh_snapshots[key] = (snapshot.updated_at, snapshot.posts)
+        dbi.session.rollback()  # Ends the read transaction, so the next round sees newer snapshots
+
+        for key in keys:
+            if key not in fresh_snapshots:
+                # Fetches poll the server until the owner publishes the timeline again
+                self.timeline_store.set_live(key, False)
+                continue
+            updated_at, posts = fresh_snapshots[key]
+            if self._mirrored.get(key) != updated_at:
+                self.timeline_store.replace(key, decode_timeline(posts))
+                self._mirrored[key] = updated_at
+            self.timeline_store.set_live(key, True)
@@ -0,0 +1,108 @@
+"""In-memory layer of the instance metadata cache.
+
+Verifying a user provided domain means asking the instance about itself, which is slow and, for an instance that
+stalls, unbounded. The outcome of every verification is kept here (and in the instance_metadata table, which
+survives restarts and is shared between workers) so that a domain is only verified again once its entry expires.
+Domains that failed verification are cached too, for a shorter time"""
+
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+
+class InstanceInfo:
+    """Outcome of verifying a single domain"""
+
+    __slots__ = ("domain", "canonical_domain", "version", "streaming_url", "rate_limit", "error_message",
+                 "checked_at")
+
+    def __init__(self, domain, canonical_domain, version, streaming_url, rate_limit, error_message, checked_at):
+        self.domain = domain
+        """The domain, as provided by the user (after cleaning)"""
+        self.canonical_domain = canonical_domain
+        """The domain the instance reports for itself. None if the domain is not a valid instance"""
+        self.version = version
+        self.streaming_url = streaming_url
+        self.rate_limit = rate_limit
+        """Requests allowed per rate limit window, as advertised by the instance's X-RateLimit-Limit header"""
+        self.error_message = error_message
+        """Why verification failed. None for valid instances"""
+        self.checked_at = checked_at
+        """Timezone aware datetime of the verification"""
+
+    @property
+    def is_valid(self) -> bool:
+        return self.canonical_domain is not None
+
+    def __repr__(self):
+        return "InstanceInfo(domain={d!r}, canonical_domain={c!r})".format(d=self.domain, c=self.canonical_domain)
+
+
+class InstanceMetadataCache:
+    """Thread-safe, size-bounded cache of InstanceInfo objects, keyed by (case-insensitive) domain"""
+
+    def __init__(self, ttl: float, negative_ttl: float, max_entries: int):
+        """
+        :param ttl: Seconds a valid instance is trusted before it is verified again
+        :param negative_ttl: Seconds an invalid domain is remembered as such
+        :param max_entries: Maximum number of domains kept. The least recently used ones are evicted first
+        """
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def is_fresh(self, info: InstanceInfo) -> bool:
+        """Whether a verification outcome (eg. one read back from the database) can still be used"""
+        return self._remaining_ttl(info) > 0
+
+    def _remaining_ttl(self, info: InstanceInfo) -> float:
+        ttl = self.ttl if info.is_valid else self.negative_ttl
+        checked_at = info.checked_at
+        if checked_at.tzinfo is None:
+            # Some database backends drop the timezone. Everything is stored in UTC
+            checked_at = checked_at.replace(tzinfo=timezone.utc)
+        return ttl - (datetime.now(timezone.utc) - checked_at).total_seconds()
+
+    def get(self, domain: str) -> InstanceInfo | None:
+        """
+        :param domain: The cleaned, user provided domain
+        :return: The cached outcome for the domain, or None if there is none or it expired
+        """
+        key = domain.lower()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            info, expires_at = entry
+            if time.monotonic() >= expires_at:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return info
+
+    def put(self, info: InstanceInfo):
+        """Caches a verification outcome until it expires. Outcomes that already expired are not cached.
+        Valid instances can also be looked up by the domain they report for themselves"""
+        remaining = self._remaining_ttl(info)
+        if remaining <= 0:
+            return
+        keys = {info.domain.lower()}
+        if info.is_valid:
+            keys.add(info.canonical_domain.lower())
+        with self._lock:
+            for key in keys:
+                self._entries[key] = (info, time.monotonic() + remaining)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
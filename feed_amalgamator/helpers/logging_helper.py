@@ -18,19 +18,24 @@ class LoggingHelper:
         :param log_level: Wanted level of logs, logging.error etc.
         :param log_file_loc: Where the log output file should be stored
         :param logger_name: The name of the logger object
-        :return: Returns a logger object
+        :return: Returns a logger object. Generating the same logger again does not add its handlers again, so that
+        every line is only logged once
         """
         wanted_logger = logging.getLogger(logger_name)
 
-        stdout_handler = logging.StreamHandler(sys.stdout)
-        stdout_handler.setFormatter(ecs_logging.StdlibFormatter())
-
-        LoggingHelper.create_directory(log_file_loc)
-        file_handler = logging.FileHandler(filename=log_file_loc)
-        file_handler.setFormatter(ecs_logging.StdlibFormatter())
-
-        wanted_logger.addHandler(stdout_handler)
-        wanted_logger.addHandler(file_handler)
+        if not any(type(handler) is logging.StreamHandler and handler.stream is sys.stdout
+                   for handler in wanted_logger.handlers):
+            stdout_handler = logging.StreamHandler(sys.stdout)
+            stdout_handler.setFormatter(ecs_logging.StdlibFormatter())
+            wanted_logger.addHandler(stdout_handler)
+
+        file_name = os.path.abspath(log_file_loc)
+        if not any(isinstance(handler, logging.FileHandler) and handler.baseFilename == file_name
+                   for handler in wanted_logger.handlers):
+            LoggingHelper.create_directory(log_file_loc)
+            file_handler = logging.FileHandler(filename=log_file_loc)
+            file_handler.setFormatter(ecs_logging.StdlibFormatter())
+            wanted_logger.addHandler(file_handler)
 
         wanted_logger.setLevel(log_level)
         return wanted_logger
@@ -1,17 +1,26 @@
 """This interface provides an abstraction (ports/adapter model) to insulate internal code from external API changes.
 
-Any module interacting with the Mastodon API post-oauth (for data collection) should do so strictly through this layer"""
+Any module interacting with the Mastodon API post-oauth (for data collection) should do so strictly through this layer
 
-import logging
+Mastodon.py is imported on first use rather than with this module, as it takes long to import and is not needed to
+start the app"""
 
-import mastodon.errors
-from mastodon import MastodonAPIError, Mastodon
+import functools
+import logging
+from collections.abc import Callable
+from http import HTTPStatus
+from typing import TYPE_CHECKING
 
 from feed_amalgamator.helpers.custom_exceptions import (
     MastodonConnError,
     InvalidCredentialsError,
     ServiceUnavailableError
 )
+from feed_amalgamator.helpers.post_view import PostView
+from feed_amalgamator.helpers.request_profiling import profiled_span
+
+if TYPE_CHECKING:
+    import mastodon.utility
 
 
 class MastodonDataInterface:
@@ -39,6 +48,8 @@ class MastodonDataInterface:
         :param user_access_token: The user access token generated from the auth procedure
         :return: None, but side effect of setting user_client
         """
+        import mastodon.errors
+        from mastodon import Mastodon, MastodonAPIError
         try:
             self.logger.info("Starting user api client")
             client = Mastodon(access_token=user_access_token, api_base_url=user_domain)
@@ -56,16 +67,37 @@ class MastodonDataInterface:
             self.logger.error(conn_error_msg)
             raise MastodonConnError(conn_error_msg)
 
+    def start_public_api_client(self, domain: str):
+        """
+        Starts a client without an access token, for the timelines an instance shows to everyone (local, public
+        and hashtag timelines). Whether the instance shows them to logged-out clients is only known once one of
+        them is fetched
+
+        :param domain: Domain of the instance (eg. mstdn.social)
+        :return: None, but side effect of setting user_client
+        """
+        from mastodon import Mastodon, MastodonAPIError
+        try:
+            self.logger.info("Starting public api client")
+            self.user_client = Mastodon(api_base_url=domain)
+        except (ConnectionError, MastodonAPIError) as err:
+            conn_error_msg = "Encountered error {e} in start_public_api_client".format(e=err)
+            self.logger.error(conn_error_msg)
+            raise MastodonConnError(conn_error_msg)
+
     # === Functions to get data from here on out =====
-    def get_timeline_data(self, timeline_name: str, num_posts_to_get: int, num_tries=3) -> list[dict]:
+    @profiled_span("get_timeline_data")
+    def get_timeline_data(self, timeline_name: str, num_posts_to_get: int, num_tries=3) -> list[PostView]:
         """
         Extracts data from the wanted timeline
 
         :param timeline_name: Name of the timeline to get data from
         :param num_posts_to_get: Number of posts to obtain from the timeline
         :param num_tries: Number of tries to get the data before giving up
-        :return: List of dictionaries containing the obtained data
+        :return: List of PostViews containing the obtained data
         """
+        import mastodon.errors
+        from mastodon import MastodonAPIError
         assert self.user_client is not None, "User client has not been started"
         for i in range(num_tries):
             try:
@@ -75,17 +107,108 @@ class MastodonDataInterface:
                 self.logger.info("Successfully obtained timeline data")
                 return standardized_timeline
             except (ConnectionError, MastodonAPIError) as err:
+                # Instances that only show a timeline to logged-in users answer 422 to clients without a token
+                if isinstance(err, mastodon.errors.MastodonUnauthorizedError) or \
+                        (len(err.args) > 1 and err.args[1] == HTTPStatus.UNPROCESSABLE_ENTITY):
+                    # Trying again would not help
+                    raise InvalidCredentialsError({
+                        "redirect_path": "feed/home.html",
+                        "message": "Not allowed to get timeline {t}".format(t=timeline_name)})
                 self.logger.error("Encountered error {e} in start_user_api_client." "Retrying".format(e=err))
         raise ServiceUnavailableError({
             "redirect_page": "feed/home.html",
             "message": "Failed to get timeline data after trying {n} times".format(n=num_tries)})
 
-    def _standardize_api_objects(self, raw_timeline: mastodon.utility.AttribAccessList) -> list[dict]:
+    def stream_user_timeline(self, on_connected: Callable[[], None], on_update: Callable[[PostView], None],
+                             on_delete: Callable[[int], None], on_status_update: Callable[[PostView], None],
+                             should_stop: Callable[[], bool], read_timeout: float):
+        """
+        Streams events for the user's home timeline, blocking until the stream ends.
+        Statuses are standardized before being passed to the callbacks.
+
+        :param on_connected: Called once, when the server starts sending (events or heartbeats)
+        :param on_update: Called with every new status
+        :param on_delete: Called with the id of every deleted status
+        :param on_status_update: Called with every edited status
+        :param should_stop: Polled on every event and heartbeat. The stream is closed once it returns True
+        :param read_timeout: Seconds without any data (not even a heartbeat) before the stream is considered dead
+        :return: None, once the stream was stopped or closed by the server
+        """
+        import mastodon.errors
+        from mastodon import MastodonAPIError
+        assert self.user_client is not None, "User client has not been started"
+        listener = _timeline_stream_listener_class()(self, on_connected, on_update, on_delete, on_status_update,
+                                                     should_stop)
+        try:
+            self.logger.info("Starting to stream timeline data")
+            self.user_client.stream_user(listener, run_async=False, timeout=read_timeout)
+        except _StreamStopped:
+            self.logger.info("Stopped streaming timeline data")
+        except (ConnectionError, mastodon.errors.MastodonNetworkError, mastodon.errors.MastodonMalformedEventError,
+                MastodonAPIError) as err:
+            conn_error_msg = "Encountered error {e} in stream_user_timeline".format(e=err)
+            self.logger.error(conn_error_msg)
+            raise MastodonConnError(conn_error_msg)
+
+    def _standardize_api_objects(self, raw_timeline: "mastodon.utility.AttribAccessList") -> list[PostView]:
         """
         Standardizes third party objects into a list to reduce coupling with third party APIs
 
         :param raw_timeline: Raw timeline object generated by the third party API of type mastodon.utility
-        :return: Standardized list of dictionaries of information contained in the API object
+        :return: Standardized list of PostViews holding the information the feed renders
         """
-        # Simple conversion for now, but will come in very handy if there is a breaking API change
-        return [dict(item) for item in raw_timeline]
+        # Reblog unwrapping and date formatting happen here, once, instead of in the template
+        return [PostView.from_status(item) for item in raw_timeline]
+
+
+class _StreamStopped(Exception):
+    """Raised from inside the listener to break out of a blocking stream"""
+
+
+class _TimelineStreamCallbacks:
+    """Translates Mastodon.py stream callbacks into standardized objects for the callbacks of stream_user_timeline.
+    Mixed into Mastodon.py's StreamListener by _timeline_stream_listener_class"""
+
+    def __init__(self, data_api: MastodonDataInterface, on_connected, on_update, on_delete, on_status_update,
+                 should_stop):
+        super().__init__()
+        self.data_api = data_api
+        self.on_connected = on_connected
+        self.update_callback = on_update
+        self.delete_callback = on_delete
+        self.status_update_callback = on_status_update
+        self.should_stop = should_stop
+        self.is_connected = False
+
+    def _check_in(self):
+        if self.should_stop():
+            raise _StreamStopped()
+        if not self.is_connected:
+            self.is_connected = True
+            self.on_connected()
+
+    def handle_heartbeat(self):
+        self._check_in()
+
+    def on_update(self, status):
+        self._check_in()
+        self.update_callback(self.data_api._standardize_api_objects([status])[0])
+
+    def on_delete(self, status_id):
+        self._check_in()
+        self.delete_callback(status_id)
+
+    def on_status_update(self, status):
+        self._check_in()
+        self.status_update_callback(self.data_api._standardize_api_objects([status])[0])
+
+    def on_unknown_event(self, name, unknown_event=None):
+        # Notifications, announcements etc. are not part of the timeline
+        self._check_in()
+
+
+@functools.cache
+def _timeline_stream_listener_class() -> type:
+    """The stream listener class, built on first use so that Mastodon.py is only imported once it is needed"""
+    from mastodon import StreamListener
+    return type("_TimelineStreamListener", (_TimelineStreamCallbacks, StreamListener), {})
@@ -1,25 +1,33 @@
 """This interface provides an abstraction (ports/adapter model) to insulate internal code from external API changes.
 
-Any module interacting with the Mastodon API for Oauth purposes should do so strictly through this layer"""
+Any module interacting with the Mastodon API for Oauth purposes should do so strictly through this layer
+
+Mastodon.py and requests are imported on first use rather than with this module, as they take long to import and most
+requests never go through the OAuth flow"""
 
 import logging
 import json
-import mastodon.errors
-import requests
+import threading
+from datetime import datetime, timezone
+
 from urllib.parse import urlparse
 from http import HTTPStatus
 
 import sqlalchemy.exc
-from mastodon import Mastodon, MastodonAPIError  # pip install Mastodon.py
+from flask import has_app_context
 
+from feed_amalgamator.constants.common_constants import INSTANCE_METADATA_TTL, INSTANCE_NEGATIVE_TTL, \
+    INSTANCE_CACHE_SIZE, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT
 from feed_amalgamator.constants.error_messages import INVALID_MASTODON_DOMAIN_MSG, INVALID_JSON_RESPONSE_MSG, \
-    SERVICE_UNAVAILABLE_MSG, REDIRECT_ADD_SERVER
+    SERVICE_UNAVAILABLE_MSG, REDIRECT_ADD_SERVER, INSTANCE_TIMEOUT_MSG
 from feed_amalgamator.helpers.custom_exceptions import (
     MastodonConnError,
     InvalidApiInputError,
     ServiceUnavailableError,
 )
-from feed_amalgamator.helpers.db_interface import dbi, ApplicationTokens
+from feed_amalgamator.helpers.app_token_registry import AppCredentials, AppTokenRegistry
+from feed_amalgamator.helpers.db_interface import dbi, ApplicationTokens, InstanceMetadata
+from feed_amalgamator.helpers.instance_metadata_cache import InstanceInfo, InstanceMetadataCache
 
 
 class MastodonOAuthInterface:
@@ -29,17 +37,36 @@ class MastodonOAuthInterface:
     API calls for data processing AFTER Oauth is under the responsibility of MastodonDataInterface
     """
 
-    def __init__(self, logger: logging.Logger, redirect_uri: str):
+    def __init__(self, logger: logging.Logger, redirect_uri: str, instance_cache: InstanceMetadataCache | None = None,
+                 app_token_registry: AppTokenRegistry | None = None):
         """We pass in a logger instead of creating a new one
         As we want logs to be logged to the program calling the interface
         rather than have separate logs for the interface layer specifically"""
         self.logger = logger
-        """This is the client used to authenticate users. Generated using our app's down details"""
-        self.app_client = None
+        """The client used to authenticate users, generated using our app's own details, is started for every
+        user. As the interface is shared by all requests, it is kept per thread, and callers should rather pass the
+        client start_app_api_client returned them"""
+        self._thread_state = threading.local()
         """Hard coded required scopes for the app to work. Revisit if the scope changes"""
         self.REQUIRED_SCOPES = ["read", "write", "push"]
         """The redirect URI required by the API to generate certain urls"""
         self.REDIRECT_URI = redirect_uri
+        """In-memory layer of the cache of domain verification outcomes. Backed by the instance_metadata table"""
+        self.instance_cache = instance_cache if instance_cache is not None else \
+            InstanceMetadataCache(INSTANCE_METADATA_TTL, INSTANCE_NEGATIVE_TTL, INSTANCE_CACHE_SIZE)
+        """Read-through cache of the app credentials on each server. Also makes first registrations single-flight"""
+        self.app_token_registry = app_token_registry if app_token_registry is not None else AppTokenRegistry()
+        """Connect and read timeouts of every plain https request, so a stalled instance cannot hang a worker"""
+        self.HTTP_TIMEOUT = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+
+    @property
+    def app_client(self):
+        """The client last started by start_app_api_client on the calling thread, or None"""
+        return getattr(self._thread_state, "app_client", None)
+
+    @app_client.setter
+    def app_client(self, client):
+        self._thread_state.app_client = client
 
     def _generate_headers_for_api_call(self):
         """Generates standardized headers to be fed into a HTTP request. A lack of these headers
@@ -53,33 +80,121 @@ class MastodonOAuthInterface:
     # ===== Functions to verify the domain provided by the user =====
     def verify_user_provided_domain(self, user_domain: str) -> (bool, str):
         """
-        Ensures that the user provided domain is a legitimate mastodon server
+        Ensures that the user provided domain is a legitimate mastodon server.
+        Outcomes are cached, so the instance is only asked again once the cached outcome expires
 
         :param user_domain: Server of the account provided by the user
-        :return: True (if server is a legitimate mastodon domain), False otherwise
+        :return: (True, the domain as reported by the instance) if the server is a legitimate mastodon domain,
+        (False, an error message) otherwise
         """
+        import requests
+
         wanted_domain = self._clean_user_provided_domain(user_domain)
 
+        instance_info = self._get_cached_instance_info(wanted_domain)
+        if instance_info is None:
+            try:
+                instance_info = self._fetch_instance_info(wanted_domain)
+            except requests.exceptions.Timeout:
+                # The instance may just be overloaded, so this is not cached as a verdict on the domain
+                self.logger.error("Timed out verifying domain {d}".format(d=wanted_domain))
+                return False, "{msg_base}:{d}".format(msg_base=INSTANCE_TIMEOUT_MSG, d=wanted_domain)
+            self._cache_instance_info(instance_info)
+
+        if instance_info.is_valid:
+            return True, instance_info.canonical_domain
+        return False, instance_info.error_message  # Failed. Could be due to connection errors or wrong domain provided
+
+    def _fetch_instance_info(self, wanted_domain: str) -> InstanceInfo:
+        """
+        Asks the instance about itself. Raises requests.exceptions.Timeout if it does not answer in time
+
+        :param wanted_domain: Cleaned user provided domain
+        :return: The outcome of the verification
+        """
+        import requests
+
         # Hardcoded endpoint for generally getting an instance's info
         endpoint_to_test = "https://{d}/api/v2/instance".format(d=wanted_domain)
         # As this is before any api client is created, we will use a simple https request
-        error_message = None
+        error_message = "{msg_base}:{d}".format(msg_base=INVALID_MASTODON_DOMAIN_MSG, d=wanted_domain)
+        checked_at = datetime.now(timezone.utc)
         try:
             headers = self._generate_headers_for_api_call()
-            response = requests.get(endpoint_to_test, headers=headers)
+            response = requests.get(endpoint_to_test, headers=headers, timeout=self.HTTP_TIMEOUT)
             if response.status_code == HTTPStatus.OK:
-                wanted_domain = json.loads(response.content)["domain"]
-                return True, wanted_domain  # Obtain the cleansed content
+                instance = json.loads(response.content)
+                rate_limit = response.headers.get("X-RateLimit-Limit")
+                return InstanceInfo(
+                    domain=wanted_domain,
+                    canonical_domain=instance["domain"],  # Obtain the cleansed content
+                    version=instance.get("version"),
+                    streaming_url=instance.get("configuration", {}).get("urls", {}).get("streaming"),
+                    rate_limit=int(rate_limit) if rate_limit is not None and rate_limit.isdigit() else None,
+                    error_message=None,
+                    checked_at=checked_at,
+                )
+        except requests.exceptions.Timeout:
+            raise  # A connect timeout is a ConnectionError as well, but is not proof of an invalid domain
         except requests.exceptions.ConnectionError:
             # If the user domain is invalid, it is indistinguishable from a connection error (cannot resolve
             # the domain of the redirected url)
-            error_message = "{msg_base}:{d}".format(msg_base=INVALID_MASTODON_DOMAIN_MSG,
-                                                    d=wanted_domain)
-        except json.JSONDecodeError:
+            pass
+        except (json.JSONDecodeError, AttributeError, KeyError, TypeError):
             error_message = "{msg_base}:{d}".format(msg_base=INVALID_JSON_RESPONSE_MSG,
                                                     d=wanted_domain)
+        return InstanceInfo(domain=wanted_domain, canonical_domain=None, version=None, streaming_url=None,
+                            rate_limit=None, error_message=error_message, checked_at=checked_at)
+
+    def _get_cached_instance_info(self, wanted_domain: str) -> InstanceInfo | None:
+        """
+        Looks up a still valid verification outcome, first in memory and then in the database
 
-        return False, error_message  # Failed. Could be due to connection errors or wrong domain provided
+        :param wanted_domain: Cleaned user provided domain
+        :return: The outcome, or None if the domain has to be verified (again)
+        """
+        instance_info = self.instance_cache.get(wanted_domain)
+        if instance_info is not None or not has_app_context():
+            # The database layer is skipped when used outside the app, eg. from scripts
+            return instance_info
+
+        record = InstanceMetadata.query.filter_by(domain=wanted_domain.lower()).first()
+        if record is None:
+            return None
+        instance_info = InstanceInfo(domain=wanted_domain, canonical_domain=record.canonical_domain,
+                                     version=record.version, streaming_url=record.streaming_url,
+                                     rate_limit=record.rate_limit, error_message=record.error_message,
+                                     checked_at=record.checked_at)
+        if not self.instance_cache.is_fresh(instance_info):
+            return None
+        self.instance_cache.put(instance_info)
+        return instance_info
+
+    def _cache_instance_info(self, instance_info: InstanceInfo):
+        """Stores a verification outcome in memory and in the database. Failing to store it in the database is
+        logged, but does not fail the verification"""
+        self.instance_cache.put(instance_info)
+        if not has_app_context():
+            return
+
+        try:
+            domain = instance_info.domain.lower()
+            record = InstanceMetadata.query.filter_by(domain=domain).first()
+            if record is None:
+                record = InstanceMetadata(domain=domain)
+                dbi.session.add(record)
+            record.canonical_domain = instance_info.canonical_domain
+            record.version = instance_info.version
+            record.streaming_url = instance_info.streaming_url
+            record.rate_limit = instance_info.rate_limit
+            record.error_message = instance_info.error_message
+            record.checked_at = instance_info.checked_at
+            dbi.session.commit()
+        except sqlalchemy.exc.SQLAlchemyError as err:
+            # Most likely another worker verified the same domain concurrently
+            dbi.session.rollback()
+            self.logger.error("Encountered {e} caching the metadata of domain {d}".format(e=err,
+                                                                                          d=instance_info.domain))
 
     def _clean_user_provided_domain(self, user_provided_domain: str) -> str:
         """
@@ -100,7 +215,7 @@ class MastodonOAuthInterface:
 
     # ===== Functions that help to generate user access tokens ======
 
-    def start_app_api_client(self, user_domain: str, client_id: str, client_secret: str, access_token: str):
+    def start_app_api_client(self, user_domain: str, client_id: str, client_secret: str, access_token: str | None):
         """
         Function to start the app client (client used by our app to authenticate users).
         This generated app client will be used to process user authorization requests
@@ -108,38 +223,59 @@ class MastodonOAuthInterface:
         Is not automatically called by init as we may not wish to start a client every time
         :param user_domain: Mastodon.io, mstdn.io and the like; essentially, which server the user's
         account is located on
-        :return: None, but there is a side effect of setting self.app_client
+        :param access_token: The app's access token. Not needed for the OAuth flow, so it may be None
+        :return: The client. Also set as self.app_client for the calling thread
         """
+        from mastodon import Mastodon, MastodonAPIError, MastodonVersionError  # pip install Mastodon.py
+
+        # The client asks the server for its version on start, unless it is told. Verification usually just did
+        instance_info = self.instance_cache.get(user_domain)
+        mastodon_version = instance_info.version if instance_info is not None else None
         try:
-            client = Mastodon(
-                client_id=client_id,
-                client_secret=client_secret,
-                access_token=access_token,
-                api_base_url=user_domain,
-            )
+            try:
+                client = Mastodon(
+                    client_id=client_id,
+                    client_secret=client_secret,
+                    access_token=access_token,
+                    api_base_url=user_domain,
+                    mastodon_version=mastodon_version,
+                )
+            except MastodonVersionError:
+                # The cached version string could not be parsed, so let the client ask for it instead
+                client = Mastodon(
+                    client_id=client_id,
+                    client_secret=client_secret,
+                    access_token=access_token,
+                    api_base_url=user_domain,
+                )
             # Be careful: Wrong information used to start this client will not cause
             # the code to fail. Failure will only occur when the client is used later on
             self.app_client = client
+            return client
         except (ConnectionError, MastodonAPIError) as err:
             self.logger.error("Encountered {e} when trying to start app_client".format(e=err))
             raise ServiceUnavailableError({"message": "Mastodon API client failed to start",
                                            "redirect_path": REDIRECT_ADD_SERVER})
 
-
-    def generate_redirect_url(self, num_tries=3) -> str:
+    def generate_redirect_url(self, num_tries=3, app_client=None) -> str:
         """
         Generates an url that the user will be redirected to in order to complete Mastodon's Oauth procedure
 
         :param num_tries: Number of tries to generate a redirect url before giving up. Default value of 3
+        :param app_client: The client start_app_api_client started for the user's domain. Defaults to the one
+        last started on the calling thread
         :return: The redirect url as a string or None (upon connection failure)
         """
-        assert self.app_client is not None, "App client has not been initialized"
+        from mastodon import MastodonAPIError
+
+        app_client = app_client if app_client is not None else self.app_client
+        assert app_client is not None, "App client has not been initialized"
 
         for i in range(num_tries):
             try:
                 # It redirects the user to copy and paste an authorization code
                 # Note that it does NOT check if the url generated is valid
-                url = self.app_client.auth_request_url(redirect_uris=self.REDIRECT_URI, scopes=self.REQUIRED_SCOPES)
+                url = app_client.auth_request_url(redirect_uris=self.REDIRECT_URI, scopes=self.REQUIRED_SCOPES)
                 return url
             except MastodonAPIError as err:
                 self.logger.error(
@@ -150,26 +286,31 @@ class MastodonOAuthInterface:
         raise ServiceUnavailableError({"message": "Failed to generate url error after trying {n} times. Throwing error"
                                       .format(n=num_tries), "redirect_path": REDIRECT_ADD_SERVER})
 
-    def generate_user_access_token(self, user_auth_code: str, num_tries=3) -> str:
+    def generate_user_access_token(self, user_auth_code: str, num_tries=3, app_client=None) -> str:
         """
         Uses the user's auth code to generate an access token that will serve as a way for our app to log
         in on the user's behalf
 
         :param user_auth_code: Provided by the user after going through the Mastodon OAuth Process
         :param num_tries: Number of times to repeat in case of failure before throwing exception
+        :param app_client: The client start_app_api_client started for the user's domain. Defaults to the one
+        last started on the calling thread
         :return: The user access token (as a str) that will allow our app to act on the user's behalf
         """
-        assert self.app_client is not None, "App client has not been initialized"
+        from mastodon import MastodonAPIError, MastodonIllegalArgumentError
+
+        app_client = app_client if app_client is not None else self.app_client
+        assert app_client is not None, "App client has not been initialized"
 
         for i in range(num_tries):
             try:
-                users_access_token = self.app_client.log_in(
+                users_access_token = app_client.log_in(
                     code=user_auth_code,
                     redirect_uri=self.REDIRECT_URI,
                     scopes=self.REQUIRED_SCOPES,
                 )
                 return users_access_token
-            except mastodon.errors.MastodonIllegalArgumentError as e:
+            except MastodonIllegalArgumentError as e:
                 illegal_arg_error_msg = (
                     "Encountered error {e} trying to generate user access token. User "
                     "authorization code provided is likely invalid. Aborting".format(e=e)
@@ -187,6 +328,63 @@ class MastodonOAuthInterface:
 
     # ===== Functions that add information about a new client in a new domain into the db =====
 
+    def get_app_credentials(self, domain_name: str) -> AppCredentials:
+        """
+        Gets the credentials of our app on a domain, registering the app on the domain first if needed.
+        Concurrent calls for the same new domain result in a single registration
+
+        :param domain_name: The (verified) domain
+        :return: The credentials
+        """
+        return self.app_token_registry.get_or_register(domain_name, self._load_app_credentials,
+                                                       self._register_app_credentials)
+
+    def find_app_credentials(self, user_domain: str) -> (str, AppCredentials | None):
+        """
+        Looks up the credentials of our app on a domain as provided by the user, without ever registering it.
+        As it does not need the domain to be verified first, it can run alongside verification
+
+        :param user_domain: Domain as provided by the user
+        :return: (the cleaned domain, its credentials or None if the app is not registered on it)
+        """
+        wanted_domain = self._clean_user_provided_domain(user_domain)
+        return wanted_domain, self.app_token_registry.lookup(wanted_domain, self._load_app_credentials)
+
+    def preload_caches(self) -> int:
+        """
+        Loads the app credentials and the still fresh verification outcomes of every known domain into memory, so
+        that adding a server does not wait on the database for them. Needs an app context
+
+        :return: The number of domains loaded
+        """
+        app_tokens = ApplicationTokens.query.all()
+        for app_token in app_tokens:
+            self.app_token_registry.update(app_token.server, AppCredentials(app_token.client_id,
+                                                                            app_token.client_secret,
+                                                                            app_token.access_token))
+        loaded = len(app_tokens)
+        for record in InstanceMetadata.query.all():
+            instance_info = InstanceInfo(domain=record.domain, canonical_domain=record.canonical_domain,
+                                         version=record.version, streaming_url=record.streaming_url,
+                                         rate_limit=record.rate_limit, error_message=record.error_message,
+                                         checked_at=record.checked_at)
+            if self.instance_cache.is_fresh(instance_info):
+                self.instance_cache.put(instance_info)
+                loaded += 1
+        return loaded
+
+    def _load_app_credentials(self, domain_name: str) -> AppCredentials | None:
+        app_token_obj = self.check_if_domain_exists_in_database(domain_name)
+        if app_token_obj is None:
+            return None
+        self.logger.info("App token for domain found in database")
+        return AppCredentials(app_token_obj.client_id, app_token_obj.client_secret, app_token_obj.access_token)
+
+    def _register_app_credentials(self, domain_name: str) -> AppCredentials:
+        client_id, client_secret, access_token = self.add_domain_to_database(domain_name)
+        self.logger.info("New domain added to the database")
+        return AppCredentials(client_id, client_secret, access_token)
+
     def check_if_domain_exists_in_database(self, domain_name):
         """
         Check if domain is already added in database with access token
@@ -202,20 +400,34 @@ class MastodonOAuthInterface:
 
     def add_domain_to_database(self, domain_name: str):
         """
-        Add new domain to database. Fetch client id, client secret and access token and store it in database
+        Add new domain to database. Fetch client id and client secret and store them in database.
+        No access token is requested for the app, as the OAuth flow does not need one
 
-        :param domain_name: Add domain_name to database, with its client id, client secret and access token
+        :param domain_name: Add domain_name to database, with its client id and client secret
+        :return: client id, client secret, and the access token (None unless another process stored the domain with
+        one)
         """
         try:
             self.logger.info("Adding domain {d} to database".format(d=domain_name))
             client_id, client_secret = self._create_new_mastodon_client(domain_name)
-            access_token = self._request_auth_token_from_mastodon(client_id, client_secret, domain_name)
+            access_token = None
             app_token = ApplicationTokens(server=domain_name, client_id=client_id, client_secret=client_secret,
                                           access_token=access_token, redirect_uri=self.REDIRECT_URI)
             dbi.session.add(app_token)
             dbi.session.commit()
             self.logger.info("Completed adding domain {d} to database".format(d=domain_name))
             return client_id, client_secret, access_token
+        except sqlalchemy.exc.IntegrityError:
+            # Another process registered on the same domain concurrently. Its row wins, and the client we just
+            # created goes unused
+            dbi.session.rollback()
+            app_token_obj = self.check_if_domain_exists_in_database(domain_name)
+            if app_token_obj is None:
+                # Not a lost race, but a row the schema rejects, eg. one not yet migrated with `flask init-db`
+                self.logger.error("Could not add domain {d} to the database".format(d=domain_name))
+                raise
+            self.logger.info("Domain {d} was added to the database concurrently".format(d=domain_name))
+            return app_token_obj.client_id, app_token_obj.client_secret, app_token_obj.access_token
         except sqlalchemy.exc.SQLAlchemyError:
             raise ServiceUnavailableError({
                 "redirect_path": "feed/add_sever.html",
@@ -226,6 +438,8 @@ class MastodonOAuthInterface:
         """Function that registers a new client (bot) with Mastodon
 
         :param domain_name: Domain to create the client for"""
+        import requests
+
         self.logger.info("Creating new Mastodon client with domain {d}".format(d=domain_name))
         api_url = "https://" + domain_name + "/api/v1/apps"
 
@@ -237,7 +451,7 @@ class MastodonOAuthInterface:
         response = None
         try:
             headers = self._generate_headers_for_api_call()
-            response = requests.post(api_url, data=payload, headers=headers)
+            response = requests.post(api_url, data=payload, headers=headers, timeout=self.HTTP_TIMEOUT)
             response.raise_for_status()  # Raises an HTTPError if the HTTP request returned an unsuccessful status code
             response_dict = json.loads(response.text)
             client_id = response_dict["client_id"]
@@ -253,40 +467,3 @@ class MastodonOAuthInterface:
                 "redirect_path": "feed/add_sever.html",
                 "message": SERVICE_UNAVAILABLE_MSG
             })
-
-    def _request_auth_token_from_mastodon(self, client_id: str, client_secret: str, domain_name: str):
-        """
-        A created client/bot needs an auth token to make most API calls. This requests such a token
-        from Mastodon
-
-        :param client_id: Id of the client
-        :param client_secret: Secret of the client
-        :param domain_name: Domain to request the auth token from
-        """
-        token_url = "https://" + domain_name + "/oauth/token"
-
-        payload_token = {
-            "client_id": client_id,
-            "client_secret": client_secret,
-            "redirect_uri": self.REDIRECT_URI,
-            "grant_type": "client_credentials"
-        }
-        response = None
-        try:
-            self.logger.info("Requesting auth token from domain {d}".format(d=domain_name))
-            headers = self._generate_headers_for_api_call()
-            response = requests.post(token_url, data=payload_token, headers=headers)
-            response.raise_for_status()  # Raises an HTTPError if the HTTP request returned an unsuccessful status code
-            response_dict_token = json.loads(response.text)
-            access_token = response_dict_token['access_token']
-            self.logger.info("Successfully requested auth token from domain {d}".format(d=domain_name))
-            return access_token
-        except requests.exceptions.RequestException as e:
-            # Handle exceptions that might occur during the request
-            self.logger.error("Encountered error {e} trying to obtain auth token from Mastodon".format(e=e))
-            if response is not None:
-                self.logger.error("Response status is: {r}".format(r=response.status_code))
-            raise ServiceUnavailableError({
-                "redirect_path": "feed/add_sever.html",
-                "message": SERVICE_UNAVAILABLE_MSG
-            })
@@ -0,0 +1,339 @@
+"""Proxy for the avatars and images shown in the feed.
+
+Without it, every page view makes the browser pull full-resolution images from as many hosts as there are servers
+and authors in the feed. The proxy fetches each image once, shrinks it to the size the feed shows it at, and keeps
+the result in a size-bounded, content-addressed cache on disk. Proxied urls are signed, so the proxy cannot be used
+to fetch arbitrary urls, and never change for the same image and size, so browsers may cache them for good.
+
+The urls signed are those the servers return, so the proxy only fetches http and https urls whose host resolves to
+public addresses, and checks every redirect the same way. A hostile server thus cannot make it fetch from the
+internal network the app runs in, eg. from 127.0.0.1, 10.0.0.0/8 or the cloud metadata address 169.254.169.254.
+Hosts are resolved once per connection, which then goes to the very address that was checked, so a host answering
+with another address by the time of the connection (DNS rebinding) does not get around the check either. Proxies
+set in the environment are ignored, as they would make the connection in the proxy's place.
+
+Resizing needs Pillow. Without it, images are cached and served at their original size"""
+
+import hashlib
+import io
+import ipaddress
+import logging
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from urllib.parse import urljoin, urlparse
+
+from itsdangerous import BadSignature, URLSafeSerializer
+
+from feed_amalgamator.constants.common_constants import HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, MEDIA_MAX_REDIRECTS
+
+PROXIED_CONTENT_TYPES = {
+    "image/jpeg": ".jpg",
+    "image/png": ".png",
+    "image/gif": ".gif",
+    "image/webp": ".webp",
+}
+"""Content types the proxy serves, and the extension their files are cached with. SVG is deliberately left out, as
+it can carry scripts"""
+CHUNK_SIZE = 64 * 1024
+
+
+class MediaFetchError(Exception):
+    """Raised when a remote image cannot be proxied: the host failed or is not public, or it is not an image, or it is
+    too large"""
+
+
+class MediaCache:
+    """Thread-safe, size-bounded LRU cache of files on disk, keyed by a hex digest.
+
+    The index of cached files is rebuilt from the directory on start up, using modification times as the order
+    of last use, so the cache survives restarts"""
+
+    def __init__(self, root: Path, max_bytes: int):
+        """
+        :param root: Directory the files are kept in. Created if needed
+        :param max_bytes: Total size of the cached files. The least recently used ones are evicted first
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._index = OrderedDict()  # Digest to (path, size), least recently used first
+        self._lock = threading.Lock()
+        self.root.mkdir(parents=True, exist_ok=True)
+        cached_files = [(path.stat(), path) for path in self.root.glob("*/*") if not path.name.endswith(".tmp")]
+        for stat, path in sorted(cached_files, key=lambda stat_path: stat_path[0].st_mtime):
+            self._index[path.stem] = (path, stat.st_size)
+            self.total_bytes += stat.st_size
+
+    def get(self, digest: str) -> Path | None:
+        """
+        :param digest: Key of the file
+        :return: Path of the cached file, or None if it is not (or no longer) cached
+        """
+        with self._lock:
+            entry = self._index.get(digest)
+            if entry is None:
+                return None
+            self._index.move_to_end(digest)
+        path = entry[0]
+        try:
+            os.utime(path)  # Keeps the order of use across restarts
+        except FileNotFoundError:
+            with self._lock:
+                self._index.pop(digest, None)
+            return None
+        return path
+
+    def put(self, digest: str, data: bytes, extension: str) -> Path:
+        """
+        Stores a file, evicting the least recently used ones if the cache is full
+
+        :param digest: Key of the file
+        :param data: Contents of the file
+        :param extension: Extension of the file, from which its content type is served
+        :return: Path of the cached file
+        """
+        path = self.root / digest[:2] / (digest + extension)
+        path.parent.mkdir(exist_ok=True)
+        # Written to a temporary file first, so no request ever serves a partially written file
+        temporary_path = path.with_name("{n}.{t}.tmp".format(n=path.name, t=threading.get_ident()))
+        temporary_path.write_bytes(data)
+        os.replace(temporary_path, path)
+
+        evicted = []
+        with self._lock:
+            previous = self._index.pop(digest, None)
+            if previous is not None:
+                self.total_bytes -= previous[1]
+            self._index[digest] = (path, len(data))
+            self.total_bytes += len(data)
+            while self.total_bytes > self.max_bytes and len(self._index) > 1:
+                _, (evicted_path, evicted_size) = self._index.popitem(last=False)
+                self.total_bytes -= evicted_size
+                evicted.append(evicted_path)
+        for evicted_path in evicted:
+            evicted_path.unlink(missing_ok=True)
+        return path
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._index)
+
+
+def resize_image(data: bytes, width: int) -> bytes:
+    """
+    Shrinks an image to the given width, keeping its aspect ratio and format
+
+    :param data: The encoded image
+    :param width: Width to shrink to, in pixels
+    :return: The resized image. The original is returned if it is not wider than that, is animated, cannot be
+    decoded, or Pillow is not installed
+    """
+    try:
+        from PIL import Image  # Optional dependency, only needed for resizing
+    except ImportError:
+        return data
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            if image.width <= width or getattr(image, "n_frames", 1) > 1:
+                return data
+            image_format = image.format
+            image.thumbnail((width, round(image.height * width / image.width)))
+            resized = io.BytesIO()
+            image.save(resized, format=image_format, optimize=True)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return data
+    resized_data = resized.getvalue()
+    return resized_data if len(resized_data) < len(data) else data
+
+
+def resolve_public_address(host: str, port: int) -> str:
+    """
+    :param host: Host name or address to connect to
+    :param port: Port to connect to
+    :return: The address to connect to
+    :raises MediaFetchError: If the host cannot be resolved, or any of its addresses is not public
+    """
+    try:
+        addresses = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except (OSError, ValueError) as err:  # Unresolvable host, or invalid port
+        raise MediaFetchError("Failed to resolve {h}: {e}".format(h=host, e=err)) from err
+    for _, _, _, _, socket_address in addresses:
+        address = ipaddress.ip_address(socket_address[0])
+        if isinstance(address, ipaddress.IPv6Address) and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+        if not address.is_global or address.is_multicast:
+            raise MediaFetchError("{h} resolves to {a}, which is not a public address".format(h=host, a=address))
+    return addresses[0][4][0]
+
+
+def _fetch_session(allow_private_addresses: bool):
+    """
+    :param allow_private_addresses: If False, connections are only made to public addresses
+    :return: The requests session the proxy fetches with. Built on first use, as requests takes long to import
+    """
+    import requests
+    from urllib3.connection import HTTPConnection, HTTPSConnection
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+    class PublicAddressConnection:
+        """Connects to the address resolve_public_address checked. The Host header, the TLS server name and the
+        certificate check still go by the host name, which urllib3 keeps apart from the address it connects to"""
+
+        def _new_conn(self):
+            self._dns_host = resolve_public_address(self._dns_host, self.port)
+            return super()._new_conn()
+
+    class PublicHTTPConnection(PublicAddressConnection, HTTPConnection):
+        pass
+
+    class PublicHTTPSConnection(PublicAddressConnection, HTTPSConnection):
+        pass
+
+    class PublicHTTPConnectionPool(HTTPConnectionPool):
+        ConnectionCls = PublicHTTPConnection
+
+    class PublicHTTPSConnectionPool(HTTPSConnectionPool):
+        ConnectionCls = PublicHTTPSConnection
+
+    class PublicAddressAdapter(requests.adapters.HTTPAdapter):
+        def init_poolmanager(self, *args, **kwargs):
+            super().init_poolmanager(*args, **kwargs)
+            self.poolmanager.pool_classes_by_scheme = {"http": PublicHTTPConnectionPool,
+                                                       "https": PublicHTTPSConnectionPool}
+
+    session = requests.Session()
+    session.trust_env = False
+    if not allow_private_addresses:
+        adapter = PublicAddressAdapter()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+    return session
+
+
+class MediaProxy:
+    """Signs proxied media urls, and fetches, resizes and caches the media they point to"""
+
+    def __init__(self, logger: logging.Logger, cache: MediaCache, secret_key: str, max_fetch_bytes: int,
+                 allow_private_addresses: bool = False):
+        """
+        :param logger: Failed fetches are logged here
+        :param cache: Where fetched and resized images are kept
+        :param secret_key: Key proxied urls are signed with
+        :param max_fetch_bytes: Remote images larger than this are not proxied
+        :param allow_private_addresses: If True, images are also fetched from hosts with private, loopback and
+        link-local addresses. Only meant for local test servers
+        """
+        self.logger = logger
+        self.cache = cache
+        self.max_fetch_bytes = max_fetch_bytes
+        self.allow_private_addresses = allow_private_addresses
+        self.fetches = 0
+        self._serializer = URLSafeSerializer(secret_key, salt="media-proxy")
+        self._fetch_locks = {}
+        self._fetch_locks_lock = threading.Lock()
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    def sign(self, url: str, width: int) -> str:
+        """
+        :param url: Url of the remote image
+        :param width: Width the image is shown at, in pixels
+        :return: Token for the proxy route. The same url and width always give the same token
+        """
+        return self._serializer.dumps([url, width])
+
+    def unsign(self, token: str) -> tuple[str, int] | None:
+        """
+        :return: The (url, width) signed into the token, or None if it was not signed by this proxy
+        """
+        try:
+            url, width = self._serializer.loads(token)
+        except (BadSignature, ValueError, TypeError):
+            return None
+        return url, width
+
+    def get(self, url: str, width: int) -> Path:
+        """
+        Gets an image from the cache, fetching and resizing it first if needed. Concurrent requests for the same
+        image wait for a single fetch
+
+        :param url: Url of the remote image
+        :param width: Width to shrink the image to, in pixels
+        :return: Path of the cached image
+        """
+        digest = hashlib.sha256("{w}:{u}".format(w=width, u=url).encode("utf-8")).hexdigest()
+        path = self.cache.get(digest)
+        if path is not None:
+            return path
+
+        with self._fetch_locks_lock:
+            fetch_lock = self._fetch_locks.setdefault(digest, threading.Lock())
+        try:
+            with fetch_lock:
+                path = self.cache.get(digest)  # Fetched by another request while waiting for the lock
+                if path is not None:
+                    return path
+                data, content_type = self._fetch(url)
+                return self.cache.put(digest, resize_image(data, width), PROXIED_CONTENT_TYPES[content_type])
+        finally:
+            with self._fetch_locks_lock:
+                self._fetch_locks.pop(digest, None)
+
+    def check_fetchable(self, url: str):
+        """
+        :param url: Url of a remote image, or of a redirect on the way to it
+        :raises MediaFetchError: If the url is not http or https. Its addresses are checked once it is connected to
+        """
+        parsed = urlparse(url)
+        if parsed.scheme not in ("http", "https") or not parsed.hostname:
+            raise MediaFetchError("{u} is not an http or https url".format(u=url))
+
+    def _get_session(self):
+        with self._session_lock:
+            if self._session is None:
+                self._session = _fetch_session(self.allow_private_addresses)
+            return self._session
+
+    def _fetch(self, url: str) -> tuple[bytes, str]:
+        """
+        :return: The image, and its content type
+        """
+        import requests  # Imported on first use, as it takes long to import and is not needed to start the app
+
+        session = self._get_session()
+        self.fetches += 1
+        started_at = time.perf_counter()
+        fetched_url = url
+        try:
+            # Redirects are followed one by one, as each may point somewhere the proxy must not fetch from
+            for _ in range(MEDIA_MAX_REDIRECTS + 1):
+                self.check_fetchable(fetched_url)
+                response = session.get(fetched_url, stream=True, allow_redirects=False,
+                                       timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+                if not response.is_redirect:
+                    break
+                response.close()
+                fetched_url = urljoin(fetched_url, response.headers["Location"])
+            else:
+                raise MediaFetchError("{u} redirects more than {n} times".format(u=url, n=MEDIA_MAX_REDIRECTS))
+            with response:
+                response.raise_for_status()
+                content_type = response.headers.get("Content-Type", "").split(";")[0].strip().lower()
+                if content_type not in PROXIED_CONTENT_TYPES:
+                    raise MediaFetchError("{u} is not a proxied image, but {c}".format(u=url, c=content_type))
+                chunks = []
+                size = 0
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > self.max_fetch_bytes:
+                        raise MediaFetchError("{u} is larger than {m} bytes".format(u=url, m=self.max_fetch_bytes))
+                    chunks.append(chunk)
+        except requests.exceptions.RequestException as err:
+            raise MediaFetchError("Failed to fetch {u}: {e}".format(u=url, e=err)) from err
+        self.logger.info("Fetched {u} ({s} bytes) in {t:.0f}ms".format(u=url, s=size,
+                                                                       t=1000 * (time.perf_counter() - started_at)))
+        return b"".join(chunks), content_type
@@ -0,0 +1,110 @@
+"""Password hashing off the request threads.
+
+Hashing a password is slow on purpose, so a burst of logins would otherwise keep every request thread of a worker
+busy and starve the feed requests it also serves. Hashes are instead computed on a small, bounded pool. Requests
+queue for a free slot for a limited time only, after which they are turned away rather than piling up"""
+
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+def _timed_call(func, *args):
+    """Runs on the pool. Also reports when the call started, so that the time spent queued can be measured. Wall
+    clock time is used, as the call may run in another process"""
+    return time.time(), func(*args)
+
+
+class HashingOverloadedError(Exception):
+    """Raised when no hashing slot became free in time"""
+
+
+class HashingMetrics:
+    """Counters describing how long hashing requests wait and run. Read by the benchmarks and for logging"""
+
+    def __init__(self):
+        self.completed = 0
+        self.rejected = 0
+        self.total_queue_time = 0.0
+        self.max_queue_time = 0.0
+        self.total_hash_time = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, queue_time: float, hash_time: float):
+        with self._lock:
+            self.completed += 1
+            self.total_queue_time += queue_time
+            self.max_queue_time = max(self.max_queue_time, queue_time)
+            self.total_hash_time += hash_time
+
+    def record_rejection(self):
+        with self._lock:
+            self.rejected += 1
+
+    def summary(self) -> dict:
+        with self._lock:
+            completed = max(self.completed, 1)
+            return {
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "mean_queue_ms": 1000 * self.total_queue_time / completed,
+                "max_queue_ms": 1000 * self.max_queue_time,
+                "mean_hash_ms": 1000 * self.total_hash_time / completed,
+            }
+
+
+class PasswordHashingService:
+    """Hashes and checks passwords on a bounded thread or process pool"""
+
+    def __init__(self, method: str, max_workers: int, max_pending: int, queue_timeout: float,
+                 use_processes: bool = False):
+        """
+        :param method: Werkzeug hashing method new hashes are made with, eg. "scrypt" or "pbkdf2:sha256:600000".
+        Stored hashes made with other parameters are rehashed on the next successful login
+        :param max_workers: Hashes computed at once
+        :param max_pending: Hashing requests admitted at once, running or queued. Further requests wait for a slot
+        :param queue_timeout: Seconds a request waits for a slot before HashingOverloadedError is raised
+        :param use_processes: Hash in worker processes instead of threads. Hashing mostly releases the GIL, so
+        threads are usually enough
+        """
+        self.method = method
+        self.queue_timeout = queue_timeout
+        self.metrics = HashingMetrics()
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor: Executor = ProcessPoolExecutor(max_workers=max_workers) if use_processes else \
+            ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="password-hashing")
+        self._method_prefix = None
+
+    def _run(self, func, *args):
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            self.metrics.record_rejection()
+            raise HashingOverloadedError("No password hashing slot became free within {t}s".format(
+                t=self.queue_timeout))
+        try:
+            submitted_at = time.time()
+            started_at, result = self._executor.submit(_timed_call, func, *args).result()
+            finished_at = time.time()
+            self.metrics.record(max(started_at - submitted_at, 0.0), finished_at - started_at)
+            return result
+        finally:
+            self._slots.release()
+
+    def hash_password(self, password: str) -> str:
+        return self._run(generate_password_hash, password, self.method)
+
+    def check_password(self, password_hash: str, password: str) -> bool:
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash: str) -> bool:
+        """
+        Whether a stored hash was made with other parameters than the configured ones, eg. by an older release
+
+        :param password_hash: Hash as stored in the database, formatted as method$salt$hash
+        """
+        if self._method_prefix is None:
+            # Methods may leave parameters at their defaults (eg. "scrypt"), so the full method string is taken
+            # from an actual hash. Computed once, on first use
+            self._method_prefix = self.hash_password("").split("$", 1)[0]
+        return password_hash.split("$", 1)[0] != self._method_prefix
@@ -0,0 +1,164 @@
+"""Compact view-models for posts shown in the feed.
+
+Raw Mastodon statuses carry far more than the feed renders (nested emojis, cards, mentions, ...). Posts are
+projected onto these objects once, when the timeline is standardized, so that the template only reads plain
+attributes and no per-post work (reblog unwrapping, date formatting) is left for render time.
+
+Authors are interned: all posts by the same author refer to a single AccountView, however many timelines and servers
+they were fetched from, instead of each holding its own copy of the account"""
+
+import threading
+import weakref
+from collections.abc import Mapping
+from datetime import datetime
+from typing import NamedTuple
+
+from feed_amalgamator.constants.common_constants import POST_DATE_FORMAT, RENDERED_MEDIA_TYPES
+
+
+class MediaView(NamedTuple):
+    """A media attachment of a post. Only attachments the template knows how to render are kept"""
+
+    type: str
+    url: str
+    description: str | None
+
+
+class AccountView:
+    """The author of a post. Created through intern_account only, so that equal accounts are the same object"""
+
+    __slots__ = ("display_name", "acct", "avatar", "__weakref__")
+
+    def __init__(self, display_name: str, acct: str, avatar: str):
+        self.display_name = display_name
+        self.acct = acct
+        self.avatar = avatar
+
+    def __eq__(self, other):
+        if not isinstance(other, AccountView):
+            return NotImplemented
+        return (self.display_name, self.acct, self.avatar) == (other.display_name, other.acct, other.avatar)
+
+    def __hash__(self):
+        return hash((self.display_name, self.acct, self.avatar))
+
+    def __repr__(self):
+        return "AccountView(acct={a!r})".format(a=self.acct)
+
+
+_interned_accounts = weakref.WeakValueDictionary()
+"""(acct, display name, avatar) -> AccountView. Accounts no post refers to any more are dropped by themselves"""
+_interned_accounts_lock = threading.Lock()
+
+
+def intern_account(display_name: str, acct: str, avatar: str) -> AccountView:
+    """
+    :return: The AccountView shared by all posts of the account. An account that changed its display name or avatar
+    gets a new one, while posts fetched before the change keep the old one
+    """
+    key = (acct, display_name, avatar)
+    with _interned_accounts_lock:
+        account = _interned_accounts.get(key)
+        if account is None:
+            account = _interned_accounts[key] = AccountView(display_name, acct, avatar)
+    return account
+
+
+def interned_account_count() -> int:
+    """Number of distinct accounts posts currently refer to"""
+    with _interned_accounts_lock:
+        return len(_interned_accounts)
+
+
+class PostView:
+    """The fields of a single status that the feed page renders.
+
+    For boosts, the boosted status is unwrapped: every field describes the boosted status, and boosted_by
+    holds the display name of the account that boosted it"""
+
+    __slots__ = ("id", "uri", "original_server", "boosted_by", "account", "created_at", "created_at_display",
+                 "edited_at", "visibility", "reblogs_count", "favourites_count", "content", "media")
+
+    def __init__(self, id, uri, original_server, boosted_by, account, created_at, created_at_display, edited_at,
+                 visibility, reblogs_count, favourites_count, content, media):
+        self.id = id
+        self.uri = uri
+        self.original_server = original_server
+        self.boosted_by = boosted_by
+        self.account = account
+        self.created_at = created_at
+        self.created_at_display = created_at_display
+        self.edited_at = edited_at
+        self.visibility = visibility
+        self.reblogs_count = reblogs_count
+        self.favourites_count = favourites_count
+        self.content = content
+        self.media = media
+
+    @classmethod
+    def from_status(cls, status: Mapping, original_server: str | None = None) -> "PostView":
+        """
+        Projects a status, as returned by the Mastodon API, onto a PostView
+
+        :param status: The status. Nested objects (account, reblog, ...) are expected to be mappings too
+        :param original_server: The server the status was retrieved from, if already known
+        :return: The PostView for the status
+        """
+        boosted_by = None
+        shown = status
+        if status.get("reblog") is not None:
+            boosted_by = status["account"]["display_name"]
+            shown = status["reblog"]
+        account = shown["account"]
+        media = tuple(MediaView(m["type"], m["url"], m.get("description"))
+                      for m in shown.get("media_attachments") or [] if m["type"] in RENDERED_MEDIA_TYPES)
+        created_at = shown["created_at"]
+        return cls(
+            id=status["id"],
+            uri=status.get("uri"),
+            original_server=original_server,
+            boosted_by=boosted_by,
+            account=intern_account(account["display_name"], account["acct"], account["avatar"]),
+            created_at=created_at,
+            created_at_display=created_at.strftime(POST_DATE_FORMAT),
+            edited_at=shown.get("edited_at"),
+            visibility=shown["visibility"],
+            reblogs_count=shown["reblogs_count"],
+            favourites_count=shown["favourites_count"],
+            content=shown["content"],
+            media=media,
+        )
+
+    def to_dict(self) -> dict:
+        """Converts the post into JSON-serializable primitives, for the JSON feed api. The author's fields are
+        flattened into the post"""
+        post_dict = {field: getattr(self, field) for field in self.__slots__}
+        del post_dict["account"]
+        post_dict["display_name"] = self.account.display_name
+        post_dict["acct"] = self.account.acct
+        post_dict["avatar"] = self.account.avatar
+        post_dict["created_at"] = self.created_at.isoformat()
+        if self.edited_at is not None:
+            post_dict["edited_at"] = self.edited_at.isoformat()
+        post_dict["media"] = [media._asdict() for media in self.media]
+        return post_dict
+
+    @classmethod
+    def from_dict(cls, post_dict: Mapping) -> "PostView":
+        """Restores a post from the output of to_dict"""
+        fields = dict(post_dict)
+        fields["account"] = intern_account(fields.pop("display_name"), fields.pop("acct"), fields.pop("avatar"))
+        fields["created_at"] = datetime.fromisoformat(fields["created_at"])
+        if fields["edited_at"] is not None:
+            fields["edited_at"] = datetime.fromisoformat(fields["edited_at"])
+        fields["media"] = tuple(MediaView(**media) for media in fields["media"])
+        return cls(**fields)
+
+    def __eq__(self, other):
+        if not isinstance(other, PostView):
+            return NotImplemented
+        return all(getattr(self, field) == getattr(other, field) for field in self.__slots__)
+
+    def __repr__(self):
+        return "PostView(id={i!r}, acct={a!r}, original_server={s!r})".format(i=self.id, a=self.account.acct,
+                                                                            s=self.original_server)
@@ -0,0 +1,360 @@
+"""Opt-in profiling of single requests, to see why a feed is slow where it is slow.
+
+A request is profiled when it carries the admin profiling token in its PROFILE_TOKEN_HEADER, or when it is picked by
+the sampling rate. Its handling is recorded with cProfile, from the moment the request reaches the app until its body
+is sent, including the work done for it on other threads (eg. the timeline fetches of TimelineFetcher). The time
+spent in spans (every get_timeline_data call, filter_sort_feed, template rendering) is recorded along with it.
+
+Profiles are written to a bounded ring of files on disk, and can be listed and downloaded with the same token. The
+downloaded files are pstats dumps, eg. for `python -m pstats` or snakeviz. Requests that are not profiled only pay
+for a context variable lookup per span.
+
+Until Python 3.12, a cProfile profiler records the thread that enabled it, so every thread working on a request gets
+a profiler of its own, and any number of requests can be profiled at once. From Python 3.12, cProfile is built on
+sys.monitoring: a profiler records every thread, and only one can be enabled at a time. There, a single request is
+profiled at a time, and requests picked while another one is being profiled are served without being profiled"""
+
+import contextvars
+import cProfile
+import functools
+import hmac
+import json
+import os
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+from collections.abc import Callable
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+
+from flask import Flask, abort, jsonify, request, send_file, session, template_rendered, before_render_template
+from werkzeug.wsgi import ClosingIterator
+
+from feed_amalgamator.constants.common_constants import PROFILING_TOKEN_SETTING, PROFILING_SAMPLE_RATE_SETTING, \
+    PROFILE_DIR_SETTING, PROFILE_RING_SIZE, PROFILE_TOKEN_HEADER, PROFILE_ID_HEADER, USER_ID_FIELD
+
+PROFILE_ID_PATTERN = re.compile(r"\d+-\d+-\d+")
+PROFILES_PATH = "/profiles"
+
+_current_profile = contextvars.ContextVar("request_profile", default=None)
+_profile_counter = iter(range(1, 2 ** 63))
+
+PROFILER_PER_THREAD = sys.version_info < (3, 12)
+"""Whether a cProfile profiler records only the thread that enabled it, rather than all of them"""
+_single_profile_lock = threading.Lock()
+"""Held by the request being profiled, where a single profiler can be enabled at a time"""
+
+
+class RequestProfile:
+    """The cProfile recordings and spans of a single request. Thread-safe"""
+
+    def __init__(self, method: str, path: str):
+        self.profile_id = "{t}-{p}-{n}".format(t=time.time_ns(), p=os.getpid(), n=next(_profile_counter))
+        self.method = method
+        self.path = path
+        self.status = None
+        self.user_id = None
+        self.started_at = datetime.now(timezone.utc)
+        self._started = time.perf_counter()
+        self._request_profiler = cProfile.Profile()
+        self._profilers = [self._request_profiler]
+        self._spans = {}
+        self._template_starts = []
+        self._lock = threading.Lock()
+
+    def start(self) -> bool:
+        """Starts recording the calling thread, which handles the request
+        :return: Whether recording started. If not, another profiler is enabled, and stop must not be called"""
+        if not PROFILER_PER_THREAD and not _single_profile_lock.acquire(blocking=False):
+            return False
+        try:
+            self._request_profiler.enable()
+        except ValueError:
+            # From Python 3.12, a profiler the app did not enable, eg. of `python -m cProfile`
+            if not PROFILER_PER_THREAD:
+                _single_profile_lock.release()
+            return False
+        return True
+
+    def stop(self) -> float:
+        """Stops recording the request's thread. Must be called from the thread that called start
+        :return: Seconds since the profile was created"""
+        self._request_profiler.disable()
+        if not PROFILER_PER_THREAD:
+            _single_profile_lock.release()
+        return time.perf_counter() - self._started
+
+    def run_on_worker(self, func: Callable, *args, **kwargs):
+        """Runs func on the calling thread as part of this request, recording it with a profiler of its own where
+        profilers record a single thread. Otherwise, the request's profiler records it already"""
+        if not PROFILER_PER_THREAD:
+            previous = _current_profile.set(self)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _current_profile.reset(previous)
+        profiler = cProfile.Profile()
+        with self._lock:
+            self._profilers.append(profiler)
+        previous = _current_profile.set(self)
+        profiler.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.disable()
+            _current_profile.reset(previous)
+
+    def add_span(self, name: str, seconds: float):
+        with self._lock:
+            count, total = self._spans.get(name, (0, 0.0))
+            self._spans[name] = (count + 1, total + seconds)
+
+    def start_template(self):
+        with self._lock:
+            self._template_starts.append(time.perf_counter())
+
+    def end_template(self, template_name: str):
+        """Adds a span for the rendering of a template, which started at the last call of start_template"""
+        with self._lock:
+            if not self._template_starts:
+                return
+            started = self._template_starts.pop()
+        self.add_span("render_template {n}".format(n=template_name), time.perf_counter() - started)
+
+    def stats(self) -> pstats.Stats | None:
+        """The recordings of all threads, merged. None if nothing was recorded"""
+        stats = None
+        with self._lock:
+            profilers = list(self._profilers)
+        for profiler in profilers:
+            try:
+                if stats is None:
+                    stats = pstats.Stats(profiler)
+                else:
+                    stats.add(profiler)
+            except TypeError:
+                continue  # Profilers that did not record a single call cannot be turned into stats
+        return stats
+
+    def metadata(self, duration: float) -> dict:
+        with self._lock:
+            spans = {name: {"count": count, "total_ms": round(total * 1000, 3)}
+                     for name, (count, total) in self._spans.items()}
+        return {
+            "id": self.profile_id,
+            "method": self.method,
+            "path": self.path,
+            "status": self.status,
+            "user_id": self.user_id,
+            "started_at": self.started_at.isoformat(),
+            "duration_ms": round(duration * 1000, 3),
+            "spans": spans,
+        }
+
+
+@contextmanager
+def span(name: str):
+    """Adds the time spent in the block to the profile of the current request, if it is profiled"""
+    profile = _current_profile.get()
+    if profile is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add_span(name, time.perf_counter() - started)
+
+
+def profiled_span(name: str):
+    """Decorator adding the time spent in every call of a function to the profile of the current request"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _current_profile.get() is None:
+                return func(*args, **kwargs)
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def bind_to_request(func: Callable) -> Callable:
+    """
+    :param func: Function about to be handed to another thread, eg. submitted to an executor
+    :return: func, recorded as part of the current request's profile when it runs, if the request is profiled
+    """
+    profile = _current_profile.get()
+    if profile is None:
+        return func
+    return functools.partial(profile.run_on_worker, func)
+
+
+class ProfileRing:
+    """The newest profiles, as a pstats dump and a JSON summary each in a directory. Several processes may share
+    the directory. Thread-safe"""
+
+    def __init__(self, directory: Path, max_profiles: int):
+        """
+        :param directory: Where profiles are kept. Created if needed
+        :param max_profiles: Profiles kept. The oldest ones are deleted to make room for new ones
+        """
+        self.directory = directory
+        self.max_profiles = max_profiles
+        self._lock = threading.Lock()
+
+    def save(self, stats: pstats.Stats | None, metadata: dict):
+        """Writes a profile, and deletes the oldest ones beyond max_profiles"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        profile_id = metadata["id"]
+        if stats is not None:
+            stats.dump_stats(self.directory / (profile_id + ".prof"))
+        # The summary is written last, and atomically, so that listed profiles are complete
+        temp_path = self.directory / (profile_id + ".json.tmp")
+        temp_path.write_text(json.dumps(metadata))
+        os.replace(temp_path, self.directory / (profile_id + ".json"))
+        with self._lock:
+            for old_id in self._ids()[:-self.max_profiles]:
+                for suffix in (".json", ".prof"):
+                    (self.directory / (old_id + suffix)).unlink(missing_ok=True)
+
+    def _ids(self) -> list[str]:
+        """Ids of the saved profiles, oldest first"""
+        if not self.directory.is_dir():
+            return []
+        ids = [path.name[:-len(".json")] for path in self.directory.glob("*.json")]
+        return sorted(ids, key=lambda profile_id: tuple(map(int, profile_id.split("-"))))
+
+    def list(self) -> list[dict]:
+        """:return: Summaries of the saved profiles, newest first"""
+        summaries = []
+        for profile_id in reversed(self._ids()):
+            try:
+                summaries.append(json.loads((self.directory / (profile_id + ".json")).read_text()))
+            except (OSError, ValueError):
+                continue  # Deleted by another process in the meantime
+        return summaries
+
+    def stats_path(self, profile_id: str) -> Path | None:
+        """:return: The pstats dump of a profile, or None if there is no such profile"""
+        if not PROFILE_ID_PATTERN.fullmatch(profile_id):
+            return None
+        path = self.directory / (profile_id + ".prof")
+        return path if path.is_file() else None
+
+
+class ProfilingMiddleware:
+    """WSGI middleware profiling the requests picked by the admin token or the sampling rate"""
+
+    def __init__(self, wsgi_app, ring: ProfileRing, token: str | None, sample_rate: float):
+        """
+        :param wsgi_app: The app's WSGI app
+        :param ring: Where profiles are saved
+        :param token: Requests carrying this token in PROFILE_TOKEN_HEADER are profiled. None to only sample
+        :param sample_rate: Share of all requests that are profiled, between 0 and 1
+        """
+        self.wsgi_app = wsgi_app
+        self.ring = ring
+        self.token = token
+        self.sample_rate = sample_rate
+
+    def _should_profile(self, environ: dict) -> bool:
+        if environ.get("PATH_INFO", "").startswith(PROFILES_PATH):
+            return False  # Looking at profiles would push the profiles of interest out of the ring
+        if self.token and is_admin_token(environ.get("HTTP_" + PROFILE_TOKEN_HEADER.upper().replace("-", "_")),
+                                         self.token):
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def __call__(self, environ: dict, start_response):
+        if not self._should_profile(environ):
+            return self.wsgi_app(environ, start_response)
+        profile = RequestProfile(environ.get("REQUEST_METHOD", ""), environ.get("PATH_INFO", ""))
+        if not profile.start():
+            return self.wsgi_app(environ, start_response)
+
+        def profiled_start_response(status: str, headers: list, exc_info=None):
+            profile.status = int(status.split(" ", 1)[0])
+            headers.append((PROFILE_ID_HEADER, profile.profile_id))
+            return start_response(status, headers, exc_info)
+
+        previous = _current_profile.set(profile)
+        try:
+            body = self.wsgi_app(environ, profiled_start_response)
+        except BaseException:
+            self._finish(profile, previous)
+            raise
+        # Streamed bodies are generated while they are sent, so the profile ends once the server closes the body
+        return ClosingIterator(body, lambda: self._finish(profile, previous))
+
+    def _finish(self, profile: RequestProfile, previous: contextvars.Token):
+        duration = profile.stop()
+        try:
+            _current_profile.reset(previous)
+        except ValueError:
+            _current_profile.set(None)  # Closed from another context than the one the request started in
+        self.ring.save(profile.stats(), profile.metadata(duration))
+
+
+def is_admin_token(provided: str | None, token: str) -> bool:
+    return provided is not None and hmac.compare_digest(provided.encode("utf-8"), token.encode("utf-8"))
+
+
+def install_request_profiling(app: Flask):
+    """
+    Profiles requests, if the PROFILING_TOKEN or PROFILING_SAMPLE_RATE app setting is set, and adds the routes
+    listing and downloading profiles
+
+    :param app: The app, with its blueprints registered
+    """
+    token = app.config.get(PROFILING_TOKEN_SETTING)
+    sample_rate = float(app.config.get(PROFILING_SAMPLE_RATE_SETTING) or 0.0)
+    if not token and sample_rate <= 0:
+        return
+    ring = ProfileRing(Path(app.config.get(PROFILE_DIR_SETTING) or Path(app.instance_path, "profiles")),
+                       PROFILE_RING_SIZE)
+    app.wsgi_app = ProfilingMiddleware(app.wsgi_app, ring, token, sample_rate)
+
+    def on_render_start(sender, template, context, **extra):
+        profile = _current_profile.get()
+        if profile is not None:
+            profile.start_template()
+
+    def on_rendered(sender, template, context, **extra):
+        profile = _current_profile.get()
+        if profile is not None:
+            profile.end_template(template.name)
+
+    before_render_template.connect(on_render_start, app, weak=False)
+    template_rendered.connect(on_rendered, app, weak=False)
+
+    @app.after_request
+    def note_profiled_user(response):
+        profile = _current_profile.get()
+        if profile is not None:
+            profile.user_id = session.get(USER_ID_FIELD)
+        return response
+
+    def require_admin_token():
+        # Without the token, the routes do not exist as far as anyone can tell
+        if not token or not is_admin_token(request.headers.get(PROFILE_TOKEN_HEADER), token):
+            abort(404)
+
+    def list_profiles():
+        require_admin_token()
+        return jsonify({"profiles": ring.list()})
+
+    def download_profile(profile_id: str):
+        require_admin_token()
+        path = ring.stats_path(profile_id)
+        if path is None:
+            abort(404)
+        return send_file(path, mimetype="application/octet-stream", as_attachment=True,
+                         download_name=profile_id + ".prof")
+
+    app.add_url_rule(PROFILES_PATH, "list_profiles", list_profiles)
+    app.add_url_rule(PROFILES_PATH + "/<profile_id>", "download_profile", download_profile)
@@ -0,0 +1,183 @@
+"""Compression and cache headers for the responses of the app.
+
+Feed pages and the JSON feed carry the full content of every post, and compress well. They are compressed with
+brotli (when the brotli package is installed) or gzip, whichever the browser accepts. Static assets are linked to
+with a fingerprint of their contents, so that browsers may keep them for good: a changed asset gets a new url.
+
+Streamed responses (the streamed feed page and the live feed) are left alone, as compressing them would hold back
+their chunks until a compressor block fills up"""
+
+import functools
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+from flask import Flask, Request, Response, request
+
+from feed_amalgamator.constants.common_constants import COMPRESSION_MIN_SIZE, GZIP_LEVEL, BROTLI_QUALITY, \
+    STATIC_CACHE_MAX_AGE, STATIC_FINGERPRINT_ARG, COMPRESSED_STATIC_CACHE_SIZE
+
+COMPRESSIBLE_MIMETYPES = frozenset(["text/html", "text/css", "text/plain", "text/javascript", "application/json",
+                                    "application/javascript", "image/svg+xml"])
+
+
+@functools.cache
+def _load_brotli():
+    """The brotli module, or None if it is not installed. Optional dependency, only needed for brotli encoding"""
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def choose_encoding(request: Request) -> str | None:
+    """
+    :param request: The request being answered
+    :return: "br" or "gzip", the preferred encoding the browser accepts, or None if it accepts neither
+    """
+    accept_encodings = request.accept_encodings
+    if _load_brotli() is not None and accept_encodings.quality("br") > 0:
+        return "br"
+    if accept_encodings.quality("gzip") > 0:
+        return "gzip"
+    return None
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return _load_brotli().compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+class StaticFingerprints:
+    """Content hashes of the files in a static folder, computed once per version of a file"""
+
+    def __init__(self, static_folder: str):
+        """
+        :param static_folder: The folder static files are served from
+        """
+        self.static_folder = Path(static_folder)
+        self._fingerprints = {}
+        self._lock = threading.Lock()
+
+    def get(self, filename: str) -> str | None:
+        """
+        :param filename: Path of the file, relative to the static folder
+        :return: A short hash of the file's contents, or None if there is no such file
+        """
+        path = self.static_folder / filename
+        if not path.is_file():
+            return None
+        modified_at = path.stat().st_mtime_ns
+        with self._lock:
+            cached = self._fingerprints.get(filename)
+        if cached is not None and cached[0] == modified_at:
+            return cached[1]
+        fingerprint = hashlib.sha256(path.read_bytes()).hexdigest()[:12]
+        with self._lock:
+            self._fingerprints[filename] = (modified_at, fingerprint)
+        return fingerprint
+
+
+class CompressedStaticCache:
+    """Thread-safe, size-bounded LRU cache of compressed static files, so each version of a file is compressed
+    once rather than on every request"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._bodies = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_compress(self, key: tuple, data_func, encoding: str) -> bytes:
+        """
+        :param key: Identifies the version of the file, eg. its ETag
+        :param data_func: Reads the uncompressed file. Only called when the file is not cached
+        :param encoding: "br" or "gzip"
+        """
+        key = key + (encoding,)
+        with self._lock:
+            body = self._bodies.get(key)
+            if body is not None:
+                self._bodies.move_to_end(key)
+                return body
+        body = compress(data_func(), encoding)
+        with self._lock:
+            self._bodies[key] = body
+            while len(self._bodies) > self.max_entries:
+                self._bodies.popitem(last=False)
+        return body
+
+
+def compress_response(response: Response, compressed_static_cache: CompressedStaticCache) -> Response:
+    """
+    Compresses a response if it is worth it and the browser accepts it
+
+    :param response: The response about to be sent
+    :param compressed_static_cache: Cache for compressed static files
+    :return: The response, compressed or not
+    """
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES or (response.is_streamed and not response.direct_passthrough):
+        return response
+    response.vary.add("Accept-Encoding")
+    if response.status_code != 200 or "Content-Encoding" in response.headers or request.method == "HEAD":
+        return response
+    if response.content_length is not None and response.content_length < COMPRESSION_MIN_SIZE:
+        return response
+    encoding = choose_encoding(request)
+    if encoding is None:
+        return response
+
+    etag, _ = response.get_etag()
+    original_body = response.response
+    if request.endpoint == "static" and etag is not None:
+        def read_file():
+            response.direct_passthrough = False
+            return response.get_data()
+        body = compressed_static_cache.get_or_compress((request.path, etag), read_file, encoding)
+    else:
+        response.direct_passthrough = False
+        data = response.get_data()
+        if len(data) < COMPRESSION_MIN_SIZE:
+            return response
+        body = compress(data, encoding)
+    response.set_data(body)
+    if hasattr(original_body, "close"):
+        original_body.close()  # The file of a static response, whether it was read or not
+    response.headers["Content-Encoding"] = encoding
+    response.headers.pop("Accept-Ranges", None)  # Ranges would be of the compressed body
+    if etag is not None:
+        # The compressed body is another representation of the same content. Weak ETags say exactly that, and
+        # conditional requests compare them weakly
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def install_response_optimization(app: Flask):
+    """
+    Fingerprints static urls, and compresses and sets cache headers on responses
+
+    :param app: The app, with its blueprints registered
+    """
+    fingerprints = StaticFingerprints(app.static_folder)
+    compressed_static_cache = CompressedStaticCache(COMPRESSED_STATIC_CACHE_SIZE)
+
+    @app.url_defaults
+    def add_static_fingerprint(endpoint: str, values: dict):
+        if endpoint == "static" and STATIC_FINGERPRINT_ARG not in values:
+            fingerprint = fingerprints.get(values.get("filename", ""))
+            if fingerprint is not None:
+                values[STATIC_FINGERPRINT_ARG] = fingerprint
+
+    @app.after_request
+    def optimize_response(response: Response) -> Response:
+        if request.endpoint == "static" and response.status_code in (200, 304) \
+                and request.args.get(STATIC_FINGERPRINT_ARG):
+            # The url changes with the file, so whatever it points to never changes
+            response.cache_control.public = True
+            response.cache_control.max_age = STATIC_CACHE_MAX_AGE
+            response.cache_control.immutable = True
+            response.cache_control.no_cache = None
+        return compress_response(response, compressed_static_cache)
@@ -0,0 +1,80 @@
+"""Changes to tables that already exist, which create_all leaves as they are.
+
+Run by `flask init-db` once the missing tables are created. Every migration checks the live schema first, so running
+them again, or on a database created from the current models, changes nothing"""
+
+import logging
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Engine
+
+from feed_amalgamator.helpers.db_interface import ApplicationTokens
+
+APP_TOKENS_SERVER_INDEX = "uq_application_tokens_server"
+
+
+def _has_unique_server(engine: Engine) -> bool:
+    inspector = inspect(engine)
+    table_name = ApplicationTokens.__tablename__
+    unique_columns = [constraint["column_names"] for constraint in inspector.get_unique_constraints(table_name)]
+    unique_columns += [index["column_names"] for index in inspector.get_indexes(table_name) if index["unique"]]
+    return ["server"] in unique_columns
+
+
+def _has_nullable_access_token(engine: Engine) -> bool:
+    columns = inspect(engine).get_columns(ApplicationTokens.__tablename__)
+    return next(column["nullable"] for column in columns if column["name"] == "access_token")
+
+
+def migrate_application_tokens(engine: Engine, logger: logging.Logger) -> list[str]:
+    """
+    Makes the server of application_tokens unique, which catches concurrent registrations on the same server, and
+    its access token nullable, as it is only requested once needed. Duplicate rows of a server, which the missing
+    constraint let in, are removed first, keeping the oldest
+
+    :param engine: The engine of dbi
+    :param logger: Every change made is logged here
+    :return: Descriptions of the changes made
+    :raises RuntimeError: If the access token cannot be made nullable on this kind of database
+    """
+    if not inspect(engine).has_table(ApplicationTokens.__tablename__):
+        return []
+    needs_unique_server = not _has_unique_server(engine)
+    needs_nullable_access_token = not _has_nullable_access_token(engine)
+    column_type = ApplicationTokens.__table__.c.access_token.type.compile(dialect=engine.dialect)
+    changes = []
+    with engine.begin() as connection:
+        if needs_unique_server:
+            removed = connection.execute(text(
+                "DELETE FROM application_tokens WHERE id NOT IN "
+                "(SELECT MIN(id) FROM application_tokens GROUP BY server)")).rowcount
+            changes.append("Made application_tokens.server unique, removing {n} duplicate rows".format(n=removed))
+        if needs_nullable_access_token:
+            changes.append("Made application_tokens.access_token nullable")
+
+        if needs_nullable_access_token and engine.dialect.name == "sqlite":
+            # SQLite cannot change a column, so the table is rebuilt from the model, which makes the server unique too
+            connection.execute(text("ALTER TABLE application_tokens RENAME TO application_tokens_old"))
+            ApplicationTokens.__table__.create(connection)
+            connection.execute(text(
+                "INSERT INTO application_tokens (id, server, client_id, client_secret, access_token, redirect_uri) "
+                "SELECT id, server, client_id, client_secret, access_token, redirect_uri FROM application_tokens_old"))
+            connection.execute(text("DROP TABLE application_tokens_old"))
+        else:
+            if needs_unique_server:
+                connection.execute(text("CREATE UNIQUE INDEX {i} ON application_tokens (server)".format(
+                    i=APP_TOKENS_SERVER_INDEX)))
+            if needs_nullable_access_token:
+                if engine.dialect.name == "mssql":
+                    alter = "ALTER COLUMN access_token {t} NULL".format(t=column_type)
+                elif engine.dialect.name == "postgresql":
+                    alter = "ALTER COLUMN access_token DROP NOT NULL"
+                elif engine.dialect.name in ("mysql", "mariadb"):
+                    alter = "MODIFY access_token {t} NULL".format(t=column_type)
+                else:
+                    raise RuntimeError("Cannot make application_tokens.access_token nullable on {d}, "
+                                       "migrate it manually".format(d=engine.dialect.name))
+                connection.execute(text("ALTER TABLE application_tokens " + alter))
+    for change in changes:
+        logger.info(change)
+    return changes
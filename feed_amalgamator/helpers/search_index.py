@@ -0,0 +1,249 @@
+"""Local full-text index of the posts users have been shown, for searching across all of their servers.
+
+Searching every server through its own API is slow, and limited to what each instance indexes. Instead, posts are
+added to a SQLite FTS5 index as they are fetched for the feed, and searched locally. The index lives in its own
+SQLite file, independent of the app's database, so it works the same whichever database the app uses.
+
+Posts are indexed once per version (a new edit is indexed again), on a single background writer, so fetching the
+feed never waits for the index. Every post is tagged in the index with the (server, access token) timelines it was
+fetched for, and searches are restricted to the user's timelines by FTS5 itself. Users only ever find posts from
+their own timelines, and the restriction costs no more than one more search term"""
+
+import hashlib
+import html
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from feed_amalgamator.helpers.post_view import PostView
+from feed_amalgamator.helpers.timeline_codec import decode_timeline, encode_timeline
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS posts (
+    id INTEGER PRIMARY KEY,
+    server TEXT NOT NULL,
+    uri TEXT NOT NULL,
+    status_id INTEGER NOT NULL,
+    edited_at TEXT,
+    timelines TEXT NOT NULL,
+    data BLOB NOT NULL,
+    UNIQUE (server, uri)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(content, author, tags, timelines,
+                                                        tokenize = 'unicode61 remove_diacritics 2');
+"""
+RANK_WEIGHTS = (1.0, 2.0, 4.0, 0.0)
+"""bm25 weights of the content, author, tags and timelines columns. A match on a tag or author says more than one in
+passing. The timelines only restrict the search"""
+TAG_PATTERN = re.compile(r"#(\w+)")
+BLOCK_TAG_PATTERN = re.compile(r"<(?:br|/?p|/?div|/?li|/?blockquote)\b[^>]*>", re.IGNORECASE)
+HTML_TAG_PATTERN = re.compile(r"<[^>]+>")
+QUERY_TERM_PATTERN = re.compile(r"\w+")
+
+
+def strip_html(content: str) -> str:
+    """Reduces the HTML content of a status to its text. Only block tags separate words: hashtags and links are
+    made of several inline tags, eg. #<span>tag</span>"""
+    text = HTML_TAG_PATTERN.sub("", BLOCK_TAG_PATTERN.sub(" ", content))
+    return " ".join(html.unescape(text).split())
+
+
+def _decode_post(data: bytes, server_domain: str) -> PostView:
+    """Restores an indexed post, stored in timeline_codec's format"""
+    post = decode_timeline(data)[0]
+    post.original_server = server_domain
+    return post
+
+
+def build_match_query(query: str) -> str | None:
+    """
+    Turns what a user typed into an FTS5 query matching posts that contain all of its words. The words are quoted,
+    so that no input is taken as FTS5 syntax. The last word also matches as a prefix, as it may not be finished
+
+    :param query: What the user searched for
+    :return: The FTS5 query, or None if there are no words to search for
+    """
+    terms = QUERY_TERM_PATTERN.findall(query)
+    if not terms:
+        return None
+    quoted_terms = ['"{t}"'.format(t=term) for term in terms]
+    quoted_terms[-1] += "*"
+    return "{content author tags} : (" + " ".join(quoted_terms) + ")"
+
+
+def timeline_id(server_domain: str, access_token: str) -> str:
+    """Identifies a (server, access token) timeline in the index, without storing the access token. Made of a single
+    FTS5 token"""
+    digest = hashlib.sha256("{s}\n{t}".format(s=server_domain, t=access_token).encode("utf-8")).hexdigest()
+    return "t" + digest[:32]
+
+
+class SearchIndex:
+    """Full-text index of fetched posts. Opened by create_app. Until then, posts are not indexed"""
+
+    def __init__(self, max_posts: int, seen_cache_size: int, rank_candidates: int):
+        """
+        :param max_posts: Posts kept in the index. The ones indexed first are pruned first
+        :param rank_candidates: Only the newest this many matches of a search are ranked. Ranking every post that
+        contains a common word would take long, and older posts are less likely to be looked for
+        :param seen_cache_size: Post versions remembered as already indexed, so they are not written again on the
+        next load of the same feed
+        """
+        self.max_posts = max_posts
+        self.seen_cache_size = seen_cache_size
+        self.rank_candidates = rank_candidates
+        self.path = None
+        self._local = threading.local()
+        self._seen = OrderedDict()
+        self._seen_lock = threading.Lock()
+        self._writes_since_prune = 0
+        # SQLite has a single writer anyway. Writing from one thread keeps writes from waiting on each other
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="search-index")
+
+    def open(self, path: Path):
+        """Creates the index at the given path, if needed, and starts indexing. Opening the same path again does
+        nothing"""
+        if self.path == path:
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(path)
+        connection.execute("PRAGMA journal_mode=WAL")  # Lets searches run while posts are being indexed
+        connection.executescript(SCHEMA)
+        connection.close()
+        with self._seen_lock:
+            self._seen.clear()
+        self.path = path
+
+    def _connect(self) -> sqlite3.Connection:
+        """Connection of the calling thread. SQLite connections must not be shared between threads"""
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.path != self.path:
+            connection = sqlite3.connect(self.path, timeout=5.0)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.path = self.path
+        return connection
+
+    # ===== Indexing =====
+
+    def add(self, server_domain: str, access_token: str, posts: Iterable[PostView]):
+        """
+        Queues posts of a timeline for indexing. Posts already indexed in the same version are skipped
+
+        :param server_domain: Server the posts were fetched from
+        :param access_token: Access token they were fetched with. Only users with this timeline may find them
+        :param posts: The posts
+        """
+        if self.path is None:
+            return
+        timeline = timeline_id(server_domain, access_token)
+        new_posts = []
+        with self._seen_lock:
+            for post in posts:
+                if post.uri is None:
+                    continue
+                seen_key = (timeline, post.uri, post.edited_at)
+                if seen_key in self._seen:
+                    self._seen.move_to_end(seen_key)
+                    continue
+                self._seen[seen_key] = None
+                new_posts.append(post)
+            while len(self._seen) > self.seen_cache_size:
+                self._seen.popitem(last=False)
+        if new_posts:
+            self._writer.submit(self._write, server_domain, timeline, new_posts)
+
+    def _write(self, server_domain: str, timeline: str, posts: list[PostView]):
+        connection = self._connect()
+        with connection:
+            for post in posts:
+                edited_at = None if post.edited_at is None else post.edited_at.isoformat()
+                row = connection.execute("SELECT id, edited_at, timelines FROM posts WHERE server = ? AND uri = ?",
+                                         (server_domain, post.uri)).fetchone()
+                if row is not None and row[1] == edited_at and timeline in row[2].split():
+                    continue  # Already indexed as is, eg. before a restart
+                timelines = timeline if row is None else " ".join(sorted(set(row[2].split()) | {timeline}))
+                data = encode_timeline([post])
+                if row is None:
+                    post_id = connection.execute(
+                        "INSERT INTO posts (server, uri, status_id, edited_at, timelines, data) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        (server_domain, post.uri, post.id, edited_at, timelines, data)).lastrowid
+                else:
+                    post_id = row[0]
+                    connection.execute("UPDATE posts SET edited_at = ?, timelines = ?, data = ? WHERE id = ?",
+                                       (edited_at, timelines, data, post_id))
+                    connection.execute("DELETE FROM posts_fts WHERE rowid = ?", (post_id,))
+                content = strip_html(post.content)
+                connection.execute(
+                    "INSERT INTO posts_fts (rowid, content, author, tags, timelines) VALUES (?, ?, ?, ?, ?)",
+                    (post_id, content, "{n} {a}".format(n=post.account.display_name, a=post.account.acct),
+                     " ".join(TAG_PATTERN.findall(content)), timelines))
+        self._writes_since_prune += len(posts)
+        if self._writes_since_prune >= max(self.max_posts // 100, 1):
+            self._writes_since_prune = 0
+            self._prune(connection)
+
+    def _prune(self, connection: sqlite3.Connection):
+        """Removes the posts indexed first, beyond max_posts. Ids only grow, so they order posts by indexing time"""
+        row = connection.execute("SELECT id FROM posts ORDER BY id DESC LIMIT 1 OFFSET ?",
+                                 (self.max_posts,)).fetchone()
+        if row is None:
+            return
+        with connection:
+            connection.execute("DELETE FROM posts WHERE id <= ?", (row[0],))
+            connection.execute("DELETE FROM posts_fts WHERE rowid <= ?", (row[0],))
+
+    def flush(self):
+        """Waits until all queued posts are indexed"""
+        self._writer.submit(lambda: None).result()
+
+    def clear(self):
+        """Removes all posts from the index"""
+        if self.path is None:
+            return
+        self.flush()
+        with self._seen_lock:
+            self._seen.clear()
+        connection = self._connect()
+        with connection:
+            for table in ("posts", "posts_fts"):
+                connection.execute("DELETE FROM {t}".format(t=table))
+
+    # ===== Searching =====
+
+    def search(self, server_tokens: Iterable[tuple[str, str]], query: str, page: int,
+               page_size: int) -> tuple[list[PostView], bool]:
+        """
+        Searches the posts of the given timelines, best matches first, and the newest first among equal matches
+
+        :param server_tokens: (server domain, access token) pairs of the user's servers
+        :param query: What the user searched for
+        :param page: Page of the results, starting at 1
+        :param page_size: Posts per page
+        :return: The posts on the page, and whether there are more pages
+        """
+        match_query = build_match_query(query)
+        timelines = [timeline_id(server, token) for server, token in server_tokens]
+        if self.path is None or match_query is None or not timelines:
+            return [], False
+        match_query += " AND timelines : ({t})".format(t=" OR ".join(timelines))
+        connection = self._connect()
+        # Matches in rowid order come straight from the index, so finding the oldest candidate is cheap
+        oldest_candidate = connection.execute(
+            "SELECT rowid FROM posts_fts WHERE posts_fts MATCH ? ORDER BY rowid DESC LIMIT 1 OFFSET ?",
+            (match_query, self.rank_candidates - 1)).fetchone()
+        # One extra post is asked for, to know whether there is another page
+        rows = connection.execute("""
+            SELECT posts.data, posts.server FROM posts_fts JOIN posts ON posts.id = posts_fts.rowid
+            WHERE posts_fts MATCH ? AND posts_fts.rowid >= ?
+            ORDER BY bm25(posts_fts, ?, ?, ?, ?), posts.status_id DESC
+            LIMIT ? OFFSET ?
+        """, (match_query, 0 if oldest_candidate is None else oldest_candidate[0], *RANK_WEIGHTS, page_size + 1,
+              (page - 1) * page_size)).fetchall()
+        posts = [_decode_post(data, server_domain) for data, server_domain in rows[:page_size]]
+        return posts, len(rows) > page_size
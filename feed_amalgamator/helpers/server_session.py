@@ -0,0 +1,206 @@
+"""Optional server-side sessions.
+
+With Flask's default sessions, all session data travels in a signed cookie with every request. Server-side sessions
+keep the data in a store and only put a signed, random session id in the cookie. The store also holds state derived
+from the database on behalf of a user (eg. their server list), so that it is not derived again on every request.
+
+Two stores are provided: a local, in-process one (for a single worker) and one backed by Redis, or any server
+speaking its protocol, shared between workers. The redis package is only needed for the latter"""
+
+import configparser
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Flask, Request, Response
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import BadSignature, Signer
+from werkzeug.datastructures import CallbackDict
+
+from feed_amalgamator.constants.common_constants import USER_ID_FIELD, SESSION_BACKEND, SESSION_STORE_SIZE, \
+    DERIVED_STATE_TTL
+
+
+class LocalSessionStore:
+    """Thread-safe, size-bounded, in-process key-value store with expiry"""
+
+    def __init__(self, max_entries: int):
+        """
+        :param max_entries: Maximum number of keys kept. The least recently used ones are evicted first
+        """
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if time.monotonic() >= expires_at:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str, ttl: int):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class RedisSessionStore:
+    """Key-value store backed by Redis (or a compatible server), shared by all workers"""
+
+    def __init__(self, client):
+        """
+        :param client: A redis.Redis client, or anything with the same get, setex and delete methods
+        """
+        self.client = client
+
+    @classmethod
+    def from_url(cls, url: str) -> "RedisSessionStore":
+        import redis  # Optional dependency, only needed when sessions are stored in Redis
+        return cls(redis.Redis.from_url(url))
+
+    def get(self, key: str) -> str | None:
+        value = self.client.get(key)
+        return value.decode("utf-8") if isinstance(value, bytes) else value
+
+    def set(self, key: str, value: str, ttl: int):
+        self.client.setex(key, ttl, value)
+
+    def delete(self, key: str):
+        self.client.delete(key)
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """Session whose data lives in a store. Only its id is sent to the browser"""
+
+    def __init__(self, initial=None, sid: str | None = None, is_new: bool = True):
+        def on_update(session):
+            session.modified = True
+            session.accessed = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = is_new
+        self.modified = False
+        self.accessed = False
+        self.loaded_user_id = self.get(USER_ID_FIELD)
+        """User the session belonged to when it was loaded. A session that changes hands gets a new id"""
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """Stores sessions, and state derived on behalf of users, in a LocalSessionStore or RedisSessionStore"""
+
+    serializer = TaggedJSONSerializer()
+    session_class = ServerSideSession
+    SESSION_PREFIX = "session:"
+    DERIVED_STATE_PREFIX = "derived:"
+
+    def __init__(self, store, derived_state_ttl: int):
+        """
+        :param store: Where session data is kept
+        :param derived_state_ttl: Seconds derived state is kept, as a backstop to explicit invalidation
+        """
+        self.store = store
+        self.derived_state_ttl = derived_state_ttl
+
+    def _get_signer(self, app: Flask) -> Signer:
+        return Signer(app.secret_key, salt="server-side-session")
+
+    def open_session(self, app: Flask, request: Request) -> ServerSideSession:
+        signed_sid = request.cookies.get(self.get_cookie_name(app))
+        if signed_sid:
+            try:
+                sid = self._get_signer(app).unsign(signed_sid).decode("utf-8")
+            except BadSignature:
+                sid = None
+            if sid is not None:
+                data = self.store.get(self.SESSION_PREFIX + sid)
+                if data is not None:
+                    return self.session_class(self.serializer.loads(data), sid=sid, is_new=False)
+        return self.session_class(sid=secrets.token_urlsafe(32))
+
+    def save_session(self, app: Flask, session: ServerSideSession, response: Response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.accessed:
+            response.vary.add("Cookie")
+
+        if not session:
+            if session.modified:
+                self.store.delete(self.SESSION_PREFIX + session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+                response.vary.add("Cookie")
+            return
+
+        if session.get(USER_ID_FIELD) != session.loaded_user_id and not session.new:
+            # Logging in (or out) issues a new session id, so that an id planted before login is worthless
+            self.store.delete(self.SESSION_PREFIX + session.sid)
+            session.sid = secrets.token_urlsafe(32)
+            session.modified = True
+
+        if not (session.modified or self.should_set_cookie(app, session)):
+            return
+        lifetime = int(app.permanent_session_lifetime.total_seconds())
+        self.store.set(self.SESSION_PREFIX + session.sid, self.serializer.dumps(dict(session)), lifetime)
+        response.set_cookie(
+            name,
+            self._get_signer(app).sign(session.sid).decode("utf-8"),
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+        response.vary.add("Cookie")
+
+    # ===== State derived from the database on behalf of a user =====
+
+    def get_derived_state(self, name: str):
+        """
+        :param name: Name of the state, including whose it is (eg. "servers:<user id>")
+        :return: The state, or None if there is none (anymore)
+        """
+        data = self.store.get(self.DERIVED_STATE_PREFIX + name)
+        return None if data is None else self.serializer.loads(data)
+
+    def set_derived_state(self, name: str, value):
+        """Stores derived state. It must be JSON serializable, and must be invalidated whenever it changes"""
+        self.store.set(self.DERIVED_STATE_PREFIX + name, self.serializer.dumps(value), self.derived_state_ttl)
+
+    def invalidate_derived_state(self, name: str):
+        self.store.delete(self.DERIVED_STATE_PREFIX + name)
+
+
+def build_session_interface(parser: configparser.ConfigParser) -> ServerSideSessionInterface | None:
+    """
+    Builds the session interface from the optional SESSION settings
+
+    :param parser: The app settings
+    :return: The interface, or None if sessions are kept in Flask's default cookie
+    """
+    backend = parser.get("SESSION", "BACKEND", fallback=SESSION_BACKEND)
+    if backend == "cookie":
+        return None
+    elif backend == "local":
+        store = LocalSessionStore(parser.getint("SESSION", "MAX_SESSIONS", fallback=SESSION_STORE_SIZE))
+    elif backend == "redis":
+        store = RedisSessionStore.from_url(parser["SESSION"]["REDIS_URL"])
+    else:
+        raise ValueError("Unknown session backend {b}, expected cookie, local or redis".format(b=backend))
+    return ServerSideSessionInterface(store, parser.getint("SESSION", "DERIVED_STATE_TTL",
+                                                           fallback=DERIVED_STATE_TTL))
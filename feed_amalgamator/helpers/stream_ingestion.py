@@ -0,0 +1,121 @@
+"""Push-based ingestion of home timelines through the Mastodon streaming API.
+
+One long-lived stream is kept per (server, access token). Every (re)connection first catches up by polling the
+timeline once, after which new, edited and deleted statuses are applied to the TimelineStore as they are pushed.
+Dropped streams are reconnected with exponential backoff"""
+
+import logging
+import random
+import threading
+
+from feed_amalgamator.constants.common_constants import HOME_TIMELINE_NAME
+from feed_amalgamator.helpers.custom_exceptions import (
+    MastodonConnError,
+    InvalidCredentialsError,
+    ServiceUnavailableError
+)
+from feed_amalgamator.helpers.mastodon_data_interface import MastodonDataInterface
+from feed_amalgamator.helpers.timeline_store import TimelineStore
+
+
+class StreamIngestionService:
+    """Keeps one streaming connection (on its own thread) per subscribed (server, access token)"""
+
+    def __init__(self, logger: logging.Logger, timeline_store: TimelineStore, num_posts_to_get: int,
+                 initial_backoff: float, max_backoff: float, read_timeout: float):
+        """
+        :param logger: Logger passed on to the data interfaces
+        :param timeline_store: Where ingested posts are written to
+        :param num_posts_to_get: Number of posts polled to catch up on every (re)connection
+        :param initial_backoff: Seconds to wait before the first reconnection attempt
+        :param max_backoff: Cap on the wait between reconnection attempts, which doubles after every failure
+        :param read_timeout: Seconds without any data (not even a heartbeat) before a stream is considered dead
+        """
+        self.logger = logger
+        self.timeline_store = timeline_store
+        self.num_posts_to_get = num_posts_to_get
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.read_timeout = read_timeout
+        self._stop_events = {}
+        self._threads = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, server_domain: str, access_token: str):
+        """Starts streaming a timeline. Does nothing if it is already being streamed"""
+        key = (server_domain, access_token)
+        with self._lock:
+            if key in self._threads and self._threads[key].is_alive():
+                return
+            stop_event = threading.Event()
+            thread = threading.Thread(target=self._run, args=(key, stop_event), daemon=True,
+                                      name="stream-ingestion-{s}".format(s=server_domain))
+            self._stop_events[key] = stop_event
+            self._threads[key] = thread
+        thread.start()
+
+    def unsubscribe(self, server_domain: str, access_token: str):
+        """Stops streaming a timeline and forgets its posts"""
+        key = (server_domain, access_token)
+        with self._lock:
+            stop_event = self._stop_events.pop(key, None)
+            self._threads.pop(key, None)
+        if stop_event is not None:
+            stop_event.set()
+        self.timeline_store.discard(key)
+
+    def stop_all(self):
+        with self._lock:
+            keys = list(self._stop_events)
+        for server_domain, access_token in keys:
+            self.unsubscribe(server_domain, access_token)
+
+    def subscribed_keys(self) -> set[tuple[str, str]]:
+        """:return: (server domain, access token) of every timeline being streamed"""
+        with self._lock:
+            return set(self._stop_events)
+
+    def is_subscribed(self, server_domain: str, access_token: str) -> bool:
+        with self._lock:
+            return (server_domain, access_token) in self._stop_events
+
+    def _run(self, key: tuple[str, str], stop_event: threading.Event):
+        """Thread body: streams until unsubscribed, reconnecting with exponential backoff"""
+        server_domain, access_token = key
+        backoff = [self.initial_backoff]  # A list, so the on_connected callback can reset it
+
+        def on_connected():
+            # Catch up on anything posted while disconnected. Events that arrive during the poll are buffered by
+            # the connection and applied afterwards, and adding an already known post is harmless
+            self.timeline_store.replace(key, data_api.get_timeline_data(HOME_TIMELINE_NAME, self.num_posts_to_get))
+            self.timeline_store.set_live(key, True)
+            backoff[0] = self.initial_backoff
+            self.logger.info("Timeline stream for {s} is live".format(s=server_domain))
+
+        while not stop_event.is_set():
+            try:
+                data_api = MastodonDataInterface(self.logger)
+                data_api.start_user_api_client(user_domain=server_domain, user_access_token=access_token)
+                data_api.stream_user_timeline(
+                    on_connected=on_connected,
+                    on_update=lambda post: self.timeline_store.add(key, post),
+                    on_delete=lambda status_id: self.timeline_store.delete(key, status_id),
+                    on_status_update=lambda post: self.timeline_store.update(key, post),
+                    should_stop=stop_event.is_set,
+                    read_timeout=self.read_timeout,
+                )
+            except (MastodonConnError, ServiceUnavailableError, InvalidCredentialsError) as err:
+                self.logger.error("Timeline stream for {s} failed with {e}".format(s=server_domain, e=err))
+            except Exception as err:
+                # Never let a single bad stream kill its thread for good
+                self.logger.exception("Unexpected error {e} in timeline stream for {s}".format(e=err, s=server_domain))
+            finally:
+                # Polling takes over until the stream is back
+                self.timeline_store.set_live(key, False)
+
+            # Full jitter, so streams dropped by the same outage don't all reconnect at once
+            delay = random.uniform(0, backoff[0])
+            backoff[0] = min(backoff[0] * 2, self.max_backoff)
+            if not stop_event.is_set():
+                self.logger.info("Reconnecting timeline stream for {s} in {d:.1f}s".format(s=server_domain, d=delay))
+            stop_event.wait(delay)
@@ -0,0 +1,232 @@
+"""Compact, versioned binary encoding of timelines (lists of PostView), for timelines that are stored or cached.
+
+JSON of PostView.to_dict repeats every field name, account and server in every post, and restoring it parses two
+ISO dates per post. Instead, a payload keeps:
+
+- a string table, in which every distinct string (content, urls, servers, account fields, ...) is stored once,
+  joined by NUL characters so that it is split in a single call when decoded
+- a table of accounts, as (display name, acct, avatar) string references, so that an account posting several times
+  is stored once. Decoded accounts are interned like those of freshly fetched posts
+- a table of media attachments, as (type, url, description) string references
+- one row of fixed-width integers per post, referencing the tables above. Dates are microseconds since the epoch
+
+Payloads start with a 4 byte header: magic bytes, the format version and the compression. Compression uses zstd
+when the zstandard package is installed, and zlib otherwise"""
+
+import struct
+import zlib
+from collections.abc import Iterable
+from datetime import datetime, timedelta, timezone
+
+from feed_amalgamator.helpers.post_view import intern_account, MediaView, PostView
+
+MAGIC = b"PV"
+FORMAT_VERSION = 1
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_ZSTD = 2
+ZLIB_LEVEL = 1  # Higher levels barely shrink timelines further, but take several times longer
+ZSTD_LEVEL = 3
+
+NONE = -1
+"""Stands for None in string references"""
+NO_DATE = -2 ** 63
+"""Stands for None in dates"""
+_HEADER = struct.Struct("<2sBB")
+_COUNTS = struct.Struct("<BIIIII")  # Flags, then sizes of the string table, accounts, media, posts and post columns
+_POST_COLUMNS = 14
+_FLAG_STRING_IDS = 1  # Post ids are references into the string table, as not all of them are 64 bit integers
+_FLAG_NAIVE_DATES = 2  # Dates have no time zone
+_FLAG_LENGTH_PREFIXED = 4  # Some string contains NUL, so the table stores the length of every string
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_NAIVE_EPOCH = datetime(1970, 1, 1)
+
+
+def _zstd():
+    """The zstandard module, or None if it is not installed. Optional dependency, only needed for zstd"""
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+
+class _StringTable:
+    """Interns strings while encoding"""
+
+    def __init__(self):
+        self.strings = []
+        self._indexes = {}
+
+    def ref(self, string: str | None) -> int:
+        if string is None:
+            return NONE
+        index = self._indexes.get(string)
+        if index is None:
+            index = self._indexes[string] = len(self.strings)
+            self.strings.append(string)
+        return index
+
+
+def _to_micros(date: datetime | None, epoch: datetime) -> int:
+    if date is None:
+        return NO_DATE
+    delta = date - epoch
+    return (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds
+
+
+def _compress(body: bytes) -> tuple[int, bytes]:
+    zstandard = _zstd()
+    if zstandard is not None:
+        return COMPRESSION_ZSTD, zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+    return COMPRESSION_ZLIB, zlib.compress(body, ZLIB_LEVEL)
+
+
+def _decompress(compression: int, data: memoryview) -> bytes | memoryview:
+    if compression == COMPRESSION_NONE:
+        return data
+    if compression == COMPRESSION_ZLIB:
+        return zlib.decompress(data)
+    if compression == COMPRESSION_ZSTD:
+        zstandard = _zstd()
+        if zstandard is None:
+            raise ValueError("Timeline payload is compressed with zstd, but zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError("Unknown timeline payload compression {c}".format(c=compression))
+
+
+def encode_timeline(posts: Iterable[PostView], compress: bool = False) -> bytes:
+    """
+    Encodes posts into a compact binary payload
+
+    :param posts: The posts. Their dates must either all have a time zone, or none
+    :param compress: Whether to compress the payload. Worth it for payloads that are stored, rather than kept in
+    memory, as compression takes longer than the encoding itself
+    :return: The payload, to be decoded by decode_timeline
+    """
+    posts = list(posts)
+    strings = _StringTable()
+    accounts = {}
+    account_refs = []
+    media_refs = []
+    rows = []
+    flags = 0
+    if any(not isinstance(post.id, int) or not NO_DATE < post.id < 2 ** 63 for post in posts):
+        flags |= _FLAG_STRING_IDS
+    if posts and posts[0].created_at.tzinfo is None:
+        flags |= _FLAG_NAIVE_DATES
+    epoch = _NAIVE_EPOCH if flags & _FLAG_NAIVE_DATES else _EPOCH
+    for post in posts:
+        account = post.account
+        account_index = accounts.get(account)
+        if account_index is None:
+            account_index = accounts[account] = len(accounts)
+            account_refs.extend((strings.ref(account.display_name), strings.ref(account.acct),
+                                 strings.ref(account.avatar)))
+        rows.extend((
+            strings.ref(str(post.id)) if flags & _FLAG_STRING_IDS else post.id,
+            strings.ref(post.uri),
+            strings.ref(post.original_server),
+            strings.ref(post.boosted_by),
+            account_index,
+            _to_micros(post.created_at, epoch),
+            strings.ref(post.created_at_display),
+            _to_micros(post.edited_at, epoch),
+            strings.ref(post.visibility),
+            post.reblogs_count,
+            post.favourites_count,
+            strings.ref(post.content),
+            len(media_refs) // 3,
+            len(post.media),
+        ))
+        for media in post.media:
+            media_refs.extend((strings.ref(media.type), strings.ref(media.url), strings.ref(media.description)))
+
+    if any("\0" in string for string in strings.strings):
+        flags |= _FLAG_LENGTH_PREFIXED
+        encoded_strings = [string.encode("utf-8") for string in strings.strings]
+        string_table = struct.pack("<{n}I".format(n=len(encoded_strings)), *map(len, encoded_strings)) \
+            + b"".join(encoded_strings)
+    else:
+        string_table = "\0".join(strings.strings).encode("utf-8")
+    body = b"".join((
+        _COUNTS.pack(flags, len(strings.strings), len(accounts), len(media_refs) // 3, len(posts), _POST_COLUMNS),
+        struct.pack("<I", len(string_table)),
+        string_table,
+        struct.pack("<{n}i".format(n=len(account_refs)), *account_refs),
+        struct.pack("<{n}i".format(n=len(media_refs)), *media_refs),
+        struct.pack("<{n}q".format(n=len(rows)), *rows),
+    ))
+    compression = COMPRESSION_NONE
+    if compress:
+        compression, body = _compress(body)
+    return _HEADER.pack(MAGIC, FORMAT_VERSION, compression) + body
+
+
+def decode_timeline(payload: bytes) -> list[PostView]:
+    """
+    Restores the posts of a payload made by encode_timeline
+
+    :param payload: The payload
+    :return: The posts, in the order they were encoded
+    :raises ValueError: If the payload is not a timeline payload, or of a format version this code does not know
+    """
+    if len(payload) < _HEADER.size:
+        raise ValueError("Timeline payload is truncated")
+    magic, version, compression = _HEADER.unpack_from(payload)
+    if magic != MAGIC:
+        raise ValueError("Not a timeline payload")
+    if version != FORMAT_VERSION:
+        raise ValueError("Unsupported timeline payload version {v}".format(v=version))
+    body = _decompress(compression, memoryview(payload)[_HEADER.size:])
+
+    flags, num_strings, num_accounts, num_media, num_posts, num_columns = _COUNTS.unpack_from(body)
+    offset = _COUNTS.size
+    (string_table_size,) = struct.unpack_from("<I", body, offset)
+    offset += 4
+    string_table = bytes(body[offset:offset + string_table_size])
+    offset += string_table_size
+    if flags & _FLAG_LENGTH_PREFIXED:
+        lengths = struct.unpack_from("<{n}I".format(n=num_strings), string_table)
+        strings = []
+        position = 4 * num_strings
+        for length in lengths:
+            strings.append(string_table[position:position + length].decode("utf-8"))
+            position += length
+    else:
+        strings = string_table.decode("utf-8").split("\0") if num_strings else []
+    strings.append(None)  # So that NONE (-1) references look up None
+
+    account_refs = struct.unpack_from("<{n}i".format(n=3 * num_accounts), body, offset)
+    offset += 12 * num_accounts
+    accounts = [intern_account(strings[account_refs[i]], strings[account_refs[i + 1]], strings[account_refs[i + 2]])
+                for i in range(0, len(account_refs), 3)]
+    media_refs = struct.unpack_from("<{n}i".format(n=3 * num_media), body, offset)
+    offset += 12 * num_media
+    media = [MediaView(strings[media_refs[i]], strings[media_refs[i + 1]], strings[media_refs[i + 2]])
+             for i in range(0, len(media_refs), 3)]
+    rows = struct.unpack_from("<{n}q".format(n=num_columns * num_posts), body, offset)
+
+    epoch = _NAIVE_EPOCH if flags & _FLAG_NAIVE_DATES else _EPOCH
+    string_ids = flags & _FLAG_STRING_IDS
+    posts = []
+    for start in range(0, len(rows), num_columns):
+        # Rows are as wide as the payload says, which is _POST_COLUMNS in every payload of this format version
+        (status_id, uri, original_server, boosted_by, account, created_at, created_at_display, edited_at, visibility,
+         reblogs_count, favourites_count, content, media_start, media_count) = rows[start:start + _POST_COLUMNS]
+        posts.append(PostView(
+            strings[status_id] if string_ids else status_id,
+            strings[uri],
+            strings[original_server],
+            strings[boosted_by],
+            accounts[account],
+            epoch + timedelta(microseconds=created_at),
+            strings[created_at_display],
+            None if edited_at == NO_DATE else epoch + timedelta(microseconds=edited_at),
+            strings[visibility],
+            reblogs_count,
+            favourites_count,
+            strings[content],
+            tuple(media[media_start:media_start + media_count]),
+        ))
+    return posts
@@ -0,0 +1,172 @@
+"""Fetches the timelines of all of a user's servers concurrently.
+
+Each fetch has a MastodonDataInterface to itself, so concurrent requests (and concurrent servers within a request)
+never share a user client. Started clients are reused by later fetches through a UserClientPool. Home timelines
+that are kept live by streaming ingestion are read from the TimelineStore instead of being polled, and local, public
+and hashtag timelines are shared between users through a SharedTimelineCache. Fetched posts are handed to the
+SearchIndex, if there is one. Timelines can be prefetched into PrefetchedTimelines, for the first fetch of each to
+pick up"""
+
+import logging
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from feed_amalgamator.constants.common_constants import HOME_TIMELINE_NAME
+from feed_amalgamator.helpers.custom_exceptions import InvalidCredentialsError
+from feed_amalgamator.helpers.mastodon_data_interface import MastodonDataInterface
+from feed_amalgamator.helpers.post_view import PostView
+from feed_amalgamator.helpers.request_profiling import bind_to_request
+from feed_amalgamator.helpers.search_index import SearchIndex
+from feed_amalgamator.helpers.timeline_sources import SharedTimelineCache, is_shared_timeline
+from feed_amalgamator.helpers.timeline_prefetch import PrefetchedTimelines
+from feed_amalgamator.helpers.timeline_store import TimelineStore
+from feed_amalgamator.helpers.user_client_pool import UserClientPool
+
+
+class TimelineFetcher:
+    """Runs timeline fetches for (server, access token) pairs on a shared, bounded thread pool"""
+
+    def __init__(self, logger: logging.Logger, max_workers: int, timeline_store: TimelineStore | None = None,
+                 client_pool: UserClientPool | None = None, search_index: SearchIndex | None = None,
+                 shared_timelines: SharedTimelineCache | None = None, prefetched: PrefetchedTimelines | None = None):
+        """
+        :param logger: Logger passed on to the data interfaces, so fetches log to the calling page
+        :param max_workers: Maximum number of fetches in flight at once, across all requests
+        :param timeline_store: Store of streamed timelines to read from, if streaming ingestion is used
+        :param client_pool: Pool of started clients to reuse. Without one, a client is started for every fetch
+        :param search_index: Index to add fetched posts to, so that users can search them later
+        :param shared_timelines: Cache to share local, public and hashtag timelines between users through. Without
+        one, they are fetched for every user
+        :param prefetched: Where prefetch_sources keeps the timelines it prefetches. Without it, nothing is prefetched
+        """
+        self.logger = logger
+        self.timeline_store = timeline_store
+        self.client_pool = client_pool
+        self.search_index = search_index
+        self.shared_timelines = shared_timelines
+        self.prefetched = prefetched
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="timeline-fetch")
+
+    def fetch_timeline(self, server_domain: str, access_token: str, timeline_name: str,
+                       num_posts_to_get: int) -> list[PostView]:
+        """
+        Fetches a single timeline, tagging every post with the server it was retrieved from
+
+        :param server_domain: Domain of the server the account is on
+        :param access_token: The user's access token for that server
+        :param timeline_name: Name of the timeline to get data from
+        :param num_posts_to_get: Number of posts to obtain from the timeline
+        :return: The posts of the timeline
+        """
+        if self.prefetched is not None:
+            timeline = self.prefetched.take((server_domain, access_token, timeline_name, num_posts_to_get))
+            if timeline is not None:
+                return timeline
+        return self._fetch_timeline(server_domain, access_token, timeline_name, num_posts_to_get)
+
+    def _fetch_timeline(self, server_domain: str, access_token: str, timeline_name: str,
+                        num_posts_to_get: int) -> list[PostView]:
+        key = (server_domain, access_token)
+        if self.timeline_store is not None and timeline_name == HOME_TIMELINE_NAME:
+            live_timeline = self.timeline_store.get_live(key, num_posts_to_get)
+            if live_timeline is not None:
+                self._index(server_domain, access_token, live_timeline)
+                return live_timeline
+
+        if self.shared_timelines is not None and is_shared_timeline(timeline_name) \
+                and not self.shared_timelines.requires_login(server_domain):
+            try:
+                timeline = self.shared_timelines.get_or_fetch(
+                    (server_domain, timeline_name, num_posts_to_get),
+                    lambda: self._poll(server_domain, "", timeline_name, num_posts_to_get))
+            except InvalidCredentialsError:
+                self.logger.info("{s} only shows {t} to logged-in users".format(s=server_domain, t=timeline_name))
+                self.shared_timelines.set_requires_login(server_domain)
+            else:
+                self._index(server_domain, access_token, timeline)
+                return timeline
+
+        timeline = self._poll(server_domain, access_token, timeline_name, num_posts_to_get)
+        self._index(server_domain, access_token, timeline)
+        return timeline
+
+    def _poll(self, server_domain: str, access_token: str, timeline_name: str,
+              num_posts_to_get: int) -> list[PostView]:
+        """Fetches a timeline from the server. An empty access token fetches it logged out"""
+        key = (server_domain, access_token)
+        if self.client_pool is None:
+            data_api = self._start_client(server_domain, access_token)
+        else:
+            data_api = self.client_pool.checkout(key, lambda: self._start_client(server_domain, access_token))
+        timeline = data_api.get_timeline_data(timeline_name, num_posts_to_get)
+        if self.client_pool is not None:
+            self.client_pool.checkin(key, data_api)  # Only clients that just worked are reused
+        # Add server it was retrieved from to be accessed by frontend
+        for post in timeline:
+            post.original_server = server_domain
+        return timeline
+
+    def _index(self, server_domain: str, access_token: str, timeline: list[PostView]):
+        if self.search_index is not None:
+            self.search_index.add(server_domain, access_token, timeline)  # Only queued, so this does not block
+
+    def _start_client(self, server_domain: str, access_token: str) -> MastodonDataInterface:
+        data_api = MastodonDataInterface(self.logger)
+        if access_token:
+            data_api.start_user_api_client(user_domain=server_domain, user_access_token=access_token)
+        else:
+            data_api.start_public_api_client(server_domain)
+        return data_api
+
+    def prefetch_sources(self, sources: Iterable[tuple[str, str, str]], num_posts_to_get: int) -> int:
+        """
+        Starts fetching timelines in the background, for the next fetch of each to pick up. Failures are left for
+        that fetch to retry. Also starts the clients of the servers, as fetching does
+
+        :param sources: (server domain, access token, timeline name) of every timeline to prefetch
+        :param num_posts_to_get: Number of posts the next fetch will ask for
+        :return: The number of timelines being prefetched
+        """
+        if self.prefetched is None:
+            return 0
+        num_prefetches = 0
+        for server, token, timeline_name in sources:
+            prefetch = self._executor.submit(self._fetch_timeline, server, token, timeline_name, num_posts_to_get)
+            self.prefetched.put((server, token, timeline_name, num_posts_to_get), prefetch)
+            num_prefetches += 1
+        return num_prefetches
+
+    def fetch_sources_as_completed(
+            self, sources: Iterable[tuple[str, str, str]],
+            num_posts_to_get: int) -> Iterator[tuple[str, list[PostView] | None, Exception | None]]:
+        """
+        Fetches several timelines at once, from any of the servers
+
+        :param sources: (server domain, access token, timeline name) of every timeline to fetch
+        :param num_posts_to_get: Number of posts to obtain from each timeline
+        :return: Yields (server domain, posts, None) as each fetch completes, or (server domain, None, error)
+        for fetches that failed
+        """
+        fetch_timeline = bind_to_request(self.fetch_timeline)  # Part of the request's profile, if it is profiled
+        futures = {self._executor.submit(fetch_timeline, server, token, timeline_name, num_posts_to_get): server
+                   for server, token, timeline_name in sources}
+        for future in as_completed(futures):
+            error = future.exception()
+            if error is None:
+                yield futures[future], future.result(), None
+            else:
+                yield futures[future], None, error
+
+    def fetch_sources(self, sources: Iterable[tuple[str, str, str]], num_posts_to_get: int) -> list[PostView]:
+        """
+        Fetches several timelines at once, failing if any of them fails
+
+        :return: The posts from all timelines, unsorted
+        """
+        timelines = []
+        for _, timeline, error in self.fetch_sources_as_completed(sources, num_posts_to_get):
+            if error is not None:
+                raise error
+            timelines.extend(timeline)
+        return timelines
+
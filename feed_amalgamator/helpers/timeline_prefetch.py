@@ -0,0 +1,67 @@
+"""Timelines fetched ahead of the page that shows them, eg. a user's feed while they are redirected to it at login.
+
+A prefetched timeline is handed out once, to the first fetch of the same timeline, and only for a short while. Later
+loads of the feed fetch their timelines as usual, so prefetching never serves a timeline older than a fetch would.
+A fetch asking for a timeline that is still being prefetched waits for the prefetch instead of starting another"""
+
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from feed_amalgamator.helpers.post_view import PostView
+
+
+class PrefetchedTimelines:
+    """Thread-safe, size-bounded store of prefetched timelines, keyed by (server domain, access token, timeline name,
+    number of posts)"""
+
+    def __init__(self, max_entries: int, ttl: float):
+        """
+        :param max_entries: Prefetches kept. The oldest ones are dropped to make room for new ones
+        :param ttl: Seconds a prefetch is handed out for, from when it started
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._prefetches = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, key: tuple[str, str, str, int], prefetch: Future):
+        """
+        :param key: The timeline being prefetched
+        :param prefetch: Resolves to the posts of the timeline, or to the error fetching it
+        """
+        with self._lock:
+            self._prefetches[key] = (prefetch, time.monotonic())
+            self._prefetches.move_to_end(key)
+            while len(self._prefetches) > self.max_entries:
+                self._prefetches.popitem(last=False)
+
+    def take(self, key: tuple[str, str, str, int]) -> list[PostView] | None:
+        """
+        Hands out a prefetched timeline, waiting for its prefetch to complete if needed
+
+        :param key: The timeline
+        :return: Its posts, or None if it was not prefetched recently, or the prefetch failed
+        """
+        with self._lock:
+            entry = self._prefetches.pop(key, None)
+        if entry is None or time.monotonic() - entry[1] >= self.ttl:
+            with self._lock:
+                self.misses += 1
+            return None
+        prefetch = entry[0]
+        if prefetch.exception() is not None:
+            # The fetch that asked is retried as usual, and reports the error if it happens again
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return prefetch.result()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._prefetches)
@@ -0,0 +1,107 @@
+"""Timelines a feed can be made of, besides the home timelines of the user's servers.
+
+Local, public and hashtag timelines hold the same posts for every user of an instance. They are fetched once per
+instance, without any user's access token, and the posts are shared by all users who follow the same timeline for a
+short while. Instances that only show these timelines to logged-in users are remembered, and their timelines are
+fetched per user instead"""
+
+import re
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable
+from concurrent.futures import Future
+
+from feed_amalgamator.helpers.post_view import PostView
+
+TIMELINE_KINDS = ("home", "local", "public", "tag", "list")
+"""Kinds of timelines users can add. Tag and list timelines also need the hashtag or the id of the list"""
+HASHTAG_PATTERN = re.compile(r"\w+")
+LIST_ID_PATTERN = re.compile(r"\d+")
+
+
+def build_timeline_name(kind: str, value: str = "") -> str | None:
+    """
+    Builds the name the Mastodon API knows a timeline by, eg. tag/caturday or list/42
+
+    :param kind: One of TIMELINE_KINDS
+    :param value: The hashtag, with or without #, or the id of the list. Ignored by the other kinds
+    :return: The name of the timeline, or None if the value is not valid for the kind
+    """
+    value = value.strip().lstrip("#")
+    if kind == "tag":
+        # Hashtags are case-insensitive, so that everyone following a hashtag shares the same timeline
+        return "tag/" + value.casefold() if HASHTAG_PATTERN.fullmatch(value) else None
+    if kind == "list":
+        return "list/" + value if LIST_ID_PATTERN.fullmatch(value) else None
+    return kind if kind in TIMELINE_KINDS else None
+
+
+def is_shared_timeline(timeline_name: str) -> bool:
+    """Whether a timeline holds the same posts for every user of an instance"""
+    return timeline_name in ("local", "public") or timeline_name.startswith("tag/")
+
+
+class SharedTimelineCache:
+    """Thread-safe, size-bounded cache of recently fetched shared timelines, keyed by (server domain, timeline
+    name, number of posts). Concurrent requests for a timeline that is not cached wait for a single fetch"""
+
+    def __init__(self, max_entries: int, ttl: float, login_required_ttl: float):
+        """
+        :param max_entries: Timelines kept
+        :param ttl: Seconds a fetched timeline is served before it is fetched again
+        :param login_required_ttl: Seconds an instance that refused to show its timelines without logging in is
+        not asked again
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.login_required_ttl = login_required_ttl
+        self._timelines = OrderedDict()
+        self._in_flight = {}
+        self._login_required = {}
+        self._lock = threading.Lock()
+
+    def get_or_fetch(self, key: tuple[str, str, int], fetch: Callable[[], list[PostView]]) -> list[PostView]:
+        """
+        :param key: (server domain, timeline name, number of posts)
+        :param fetch: Fetches the timeline. Only called when it is neither cached nor being fetched already
+        :return: The posts of the timeline. They are shared, and must not be modified
+        """
+        now = time.monotonic()
+        with self._lock:
+            cached = self._timelines.get(key)
+            if cached is not None and now - cached[1] < self.ttl:
+                self._timelines.move_to_end(key)
+                return cached[0]
+            in_flight = self._in_flight.get(key)
+            is_fetching = in_flight is None
+            if is_fetching:
+                in_flight = self._in_flight[key] = Future()
+        if not is_fetching:
+            return in_flight.result()
+
+        try:
+            posts = fetch()
+        except BaseException as err:
+            with self._lock:
+                del self._in_flight[key]
+            in_flight.set_exception(err)
+            raise
+        with self._lock:
+            del self._in_flight[key]
+            self._timelines[key] = (posts, time.monotonic())
+            self._timelines.move_to_end(key)
+            while len(self._timelines) > self.max_entries:
+                self._timelines.popitem(last=False)
+        in_flight.set_result(posts)
+        return posts
+
+    def requires_login(self, server_domain: str) -> bool:
+        """Whether the instance recently refused to show its shared timelines without an access token"""
+        with self._lock:
+            refused_at = self._login_required.get(server_domain)
+        return refused_at is not None and time.monotonic() - refused_at < self.login_required_ttl
+
+    def set_requires_login(self, server_domain: str):
+        with self._lock:
+            self._login_required[server_domain] = time.monotonic()
@@ -0,0 +1,143 @@
+"""Local, in-memory store of the most recent posts of each (server, access token) timeline.
+
+Timelines are written by the streaming ingestion service as events are pushed by the servers. While a timeline
+is live (its stream is connected), reads are served from here instead of polling the server. New posts are also
+handed to the subscriptions of open feed pages, which push them to the browser"""
+
+import threading
+
+from feed_amalgamator.helpers.feed_updates import FeedSubscription
+from feed_amalgamator.helpers.post_view import PostView
+
+
+class TimelineStore:
+    """Thread-safe store of posts, keyed by (server domain, access token)"""
+
+    def __init__(self, max_posts_per_timeline: int):
+        """
+        :param max_posts_per_timeline: Only this many of the newest posts are kept for every timeline
+        """
+        self.max_posts_per_timeline = max_posts_per_timeline
+        self._timelines = {}
+        self._live = set()
+        self._subscriptions = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self.on_miss = None
+        """Called with the key of every read of a timeline that is not live, if set"""
+
+    def replace(self, key: tuple[str, str], posts: list[PostView]):
+        """Replaces a whole timeline, eg. with freshly polled posts"""
+        with self._lock:
+            previous = self._timelines.get(key)
+            self._timelines[key] = {}
+            self._dirty.add(key)
+            for post in posts:
+                self._put(key, post)
+            # Posts newer than anything seen before were missed while the stream was down, so they are new to
+            # open pages too. The very first poll of a timeline is what the pages already show
+            new_posts = []
+            if previous:
+                newest_seen = max(previous)
+                new_posts = sorted((post for post in posts if post.id > newest_seen), key=lambda post: post.id)
+            subscriptions = list(self._subscriptions.get(key, ())) if new_posts else []
+        for subscription in subscriptions:
+            for post in new_posts:
+                subscription.offer(post)
+
+    def add(self, key: tuple[str, str], post: PostView):
+        """Adds a new post to a timeline. Adding a post that is already there replaces it"""
+        with self._lock:
+            timeline = self._timelines.setdefault(key, {})
+            is_new = post.id not in timeline
+            self._put(key, post)
+            subscriptions = list(self._subscriptions.get(key, ())) if is_new else []
+        for subscription in subscriptions:
+            subscription.offer(post)
+
+    def update(self, key: tuple[str, str], post: PostView):
+        """Replaces an edited post. Posts that are not (or no longer) in the timeline are ignored"""
+        with self._lock:
+            timeline = self._timelines.get(key)
+            if timeline is not None and post.id in timeline:
+                self._put(key, post)
+
+    def delete(self, key: tuple[str, str], status_id):
+        """Removes a post from a timeline, if it is there"""
+        with self._lock:
+            timeline = self._timelines.get(key)
+            if timeline is not None and timeline.pop(status_id, None) is not None:
+                self._dirty.add(key)
+
+    def _put(self, key: tuple[str, str], post: PostView):
+        # Must be called while holding self._lock
+        post.original_server = key[0]
+        self._dirty.add(key)
+        timeline = self._timelines[key]
+        timeline[post.id] = post
+        if len(timeline) > self.max_posts_per_timeline:
+            timeline.pop(min(timeline))  # Status ids grow over time, so the smallest is the oldest
+
+    def set_live(self, key: tuple[str, str], is_live: bool):
+        """Marks whether a timeline is kept up-to-date by a connected stream"""
+        with self._lock:
+            if is_live:
+                self._live.add(key)
+            else:
+                self._live.discard(key)
+
+    def is_live(self, key: tuple[str, str]) -> bool:
+        with self._lock:
+            return key in self._live
+
+    def get_live(self, key: tuple[str, str], num_posts_to_get: int) -> list[PostView] | None:
+        """
+        Reads a timeline, but only if it is live
+
+        :param key: (server domain, access token) of the timeline
+        :param num_posts_to_get: Maximum number of posts to return
+        :return: The newest posts first, or None if the timeline is not live and should be polled instead
+        """
+        with self._lock:
+            is_live = key in self._live
+            if is_live:
+                timeline = self._timelines.get(key, {})
+                newest_ids = sorted(timeline, reverse=True)[:num_posts_to_get]
+                return [timeline[status_id] for status_id in newest_ids]
+        on_miss = self.on_miss
+        if on_miss is not None:
+            on_miss(key)
+        return None
+
+    def pop_dirty(self) -> set[tuple[str, str]]:
+        """:return: The timelines that changed since the last call"""
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        return dirty
+
+    def subscribed_keys(self) -> set[tuple[str, str]]:
+        """:return: The timelines open feed pages are waiting for new posts of"""
+        with self._lock:
+            return set(self._subscriptions)
+
+    def subscribe(self, subscription: FeedSubscription):
+        """Starts handing new posts of the subscription's timelines to it"""
+        with self._lock:
+            for key in subscription.keys:
+                self._subscriptions.setdefault(key, set()).add(subscription)
+
+    def unsubscribe(self, subscription: FeedSubscription):
+        with self._lock:
+            for key in subscription.keys:
+                key_subscriptions = self._subscriptions.get(key)
+                if key_subscriptions is not None:
+                    key_subscriptions.discard(subscription)
+                    if not key_subscriptions:
+                        del self._subscriptions[key]
+
+    def discard(self, key: tuple[str, str]):
+        """Forgets a timeline entirely, eg. after the user removed the server"""
+        with self._lock:
+            self._timelines.pop(key, None)
+            self._live.discard(key)
+            self._dirty.discard(key)
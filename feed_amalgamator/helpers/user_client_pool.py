@@ -0,0 +1,54 @@
+"""Reuse of started user API clients across feed loads.
+
+Starting a client costs round trips of its own (the server's version, and a sanity check of the access token), on
+top of the timeline fetch it is started for. Clients are therefore checked out of this pool and returned after a
+successful fetch. A client is only ever used by one fetch at a time"""
+
+import threading
+import time
+from collections.abc import Callable
+
+from feed_amalgamator.helpers.mastodon_data_interface import MastodonDataInterface
+
+
+class UserClientPool:
+    """Thread-safe pool of idle, started MastodonDataInterfaces keyed by (server domain, access token)"""
+
+    def __init__(self, max_idle_per_key: int, idle_ttl: float):
+        """
+        :param max_idle_per_key: Idle clients kept per key. Clients returned beyond that are dropped
+        :param idle_ttl: Seconds an idle client is kept. Older ones are dropped rather than reused, so that a
+        revoked access token is noticed by the sanity check of a freshly started client
+        """
+        self.max_idle_per_key = max_idle_per_key
+        self.idle_ttl = idle_ttl
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def checkout(self, key: tuple[str, str],
+                 start_client: Callable[[], MastodonDataInterface]) -> MastodonDataInterface:
+        """
+        :param key: (server domain, access token)
+        :param start_client: Starts a new client, if there is no idle one
+        :return: A client for the exclusive use of the caller, until checked back in
+        """
+        now = time.monotonic()
+        with self._lock:
+            idle_clients = self._idle.get(key, [])
+            while idle_clients:
+                data_api, returned_at = idle_clients.pop()
+                if now - returned_at < self.idle_ttl:
+                    return data_api
+        return start_client()
+
+    def checkin(self, key: tuple[str, str], data_api: MastodonDataInterface):
+        """Returns a client that is known to work. Clients that just failed should not be returned"""
+        with self._lock:
+            idle_clients = self._idle.setdefault(key, [])
+            if len(idle_clients) < self.max_idle_per_key:
+                idle_clients.append((data_api, time.monotonic()))
+
+    def discard(self, key: tuple[str, str]):
+        """Drops the idle clients of a key, eg. after the user removed the server"""
+        with self._lock:
+            self._idle.pop(key, None)
@@ -0,0 +1,99 @@
+"""Warm-up of the app, so that the first requests a worker serves are not the ones paying for its start.
+
+Imports that the app defers to first use are done, every template is compiled, connections are opened to fill the
+database pool and the app credentials and verification outcomes of known domains are loaded into memory.
+
+When the app is created once and then forked into workers (eg. gunicorn --preload), the warm-up is done once for all
+of them. Forked workers throw away the pooled connections they inherited, as a connection must not be shared between
+processes, and open their own on first use. Everything else is inherited as it is"""
+
+import importlib
+import logging
+import os
+import time
+import weakref
+
+from flask import Flask
+from sqlalchemy import Engine
+from sqlalchemy.pool import QueuePool
+
+from feed_amalgamator.helpers.db_interface import dbi
+from feed_amalgamator.helpers.mastodon_oauth_interface import MastodonOAuthInterface
+
+DEFERRED_MODULES = ("requests", "mastodon")
+"""Modules the app only imports on first use, as they take long to import"""
+
+_fork_safe_engines = weakref.WeakSet()
+
+
+def compile_templates(app: Flask) -> int:
+    """
+    :return: The number of templates compiled. They are kept in the app's template cache
+    """
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+
+def fill_connection_pool(engine: Engine) -> int:
+    """
+    Opens as many connections as the engine's pool keeps, and returns them to the pool
+
+    :return: The number of connections opened
+    """
+    num_connections = engine.pool.size() if isinstance(engine.pool, QueuePool) else 1
+    connections = []
+    try:
+        for _ in range(num_connections):
+            connections.append(engine.connect())
+    finally:
+        for connection in connections:
+            connection.close()
+    return len(connections)
+
+
+def dispose_engine_after_fork(engine: Engine):
+    """Makes processes forked from this one throw away the pooled connections of engine they inherit. Idempotent"""
+    if engine in _fork_safe_engines:
+        return
+    _fork_safe_engines.add(engine)
+    engine_ref = weakref.ref(engine)
+
+    def dispose_in_child():
+        child_engine = engine_ref()
+        if child_engine is not None:
+            # close=False, as closing them would close the parent's connections as well
+            child_engine.dispose(close=False)
+
+    os.register_at_fork(after_in_child=dispose_in_child)
+
+
+def warm_up(app: Flask, auth_api: MastodonOAuthInterface, logger: logging.Logger) -> dict:
+    """
+    Warms the app up. Failures are logged, as a cold app still works
+
+    :param app: The app, with its blueprints registered and its database set up
+    :param auth_api: The interface whose caches are loaded
+    :param logger: Where the outcome is logged
+    :return: Seconds spent per step
+    """
+    steps = {
+        "imports": lambda: [importlib.import_module(name) for name in DEFERRED_MODULES],
+        "templates": lambda: compile_templates(app),
+        "connection_pool": lambda: fill_connection_pool(dbi.engine),
+        "caches": auth_api.preload_caches,
+    }
+    timings = {}
+    with app.app_context():
+        dispose_engine_after_fork(dbi.engine)
+        for name, step in steps.items():
+            started = time.perf_counter()
+            try:
+                step()
+            except Exception as err:
+                logger.error("Encountered {e} warming up {s}".format(e=err, s=name))
+            timings[name] = time.perf_counter() - started
+    logger.info("Warmed up in {t:.0f}ms: {s}".format(t=1000 * sum(timings.values()), s=", ".join(
+        "{n} {t:.0f}ms".format(n=name, t=1000 * seconds) for name, seconds in timings.items())))
+    return timings
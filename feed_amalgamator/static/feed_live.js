@@ -0,0 +1,31 @@
+// Inserts new posts into the feed page as the server pushes them, instead of the user reloading the page
+// currentScript is only set while the script itself runs, so it is read before the page has loaded
+const liveUrl = document.currentScript.dataset.liveUrl
+
+document.addEventListener('DOMContentLoaded', () => {
+  const feed = document.querySelector('.feed-div')
+  if (!feed || !window.EventSource) {
+    return
+  }
+  const seenIds = new Set()
+  const events = new EventSource(liveUrl)
+
+  events.addEventListener('post', (event) => {
+    const post = JSON.parse(event.data)
+    const postKey = post.server + '/' + post.id
+    if (seenIds.has(postKey)) {
+      return
+    }
+    seenIds.add(postKey)
+    feed.insertAdjacentHTML('afterbegin', post.html)
+  })
+
+  // The page fell too far behind to be updated post by post
+  events.addEventListener('reload', () => {
+    events.close()
+    const notice = document.createElement('div')
+    notice.className = 'flash'
+    notice.innerHTML = 'There are new posts. <a href="">Reload</a> to see them.'
+    feed.parentNode.insertBefore(notice, feed)
+  })
+})
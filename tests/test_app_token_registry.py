@@ -0,0 +1,125 @@
+import configparser
+import logging
+import threading
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import sqlalchemy
+
+from feed_amalgamator import create_app, dbi
+from feed_amalgamator.helpers.app_token_registry import AppCredentials, AppTokenRegistry
+from feed_amalgamator.helpers.db_interface import ApplicationTokens
+from feed_amalgamator.helpers.logging_helper import LoggingHelper
+from feed_amalgamator.helpers.mastodon_oauth_interface import MastodonOAuthInterface
+
+
+class TestAppTokenRegistry(unittest.TestCase):
+    def test_concurrent_first_registration_is_single_flight(self):
+        registry = AppTokenRegistry()
+        registrations = []
+
+        def register(domain):
+            registrations.append(domain)
+            time.sleep(0.1)  # Keeps the registration in flight while the other threads arrive
+            return AppCredentials("id", "secret", "token")
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            registry.get_or_register("new.social", lambda domain: None, register))) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(["new.social"], registrations)
+        self.assertEqual([AppCredentials("id", "secret", "token")] * 8, results)
+
+    def test_lookups_do_not_share_in_flight_registrations(self):
+        registry = AppTokenRegistry()
+        loading = threading.Event()
+        registered = threading.Event()
+
+        def slow_load(domain):
+            loading.set()
+            registered.wait(5)  # Keeps the lookup going until the registration is done
+            return None
+
+        def register(domain):
+            registered.set()
+            return AppCredentials("id", "secret", None)
+
+        results = {}
+        lookup = threading.Thread(target=lambda: results.update(lookup=registry.lookup("new.social", slow_load)))
+        lookup.start()
+        loading.wait(5)
+        results["register"] = registry.get_or_register("new.social", lambda domain: None, register)
+        lookup.join()
+
+        self.assertEqual({"lookup": None, "register": AppCredentials("id", "secret", None)}, results)
+        self.assertEqual(AppCredentials("id", "secret", None), registry.lookup("new.social", lambda domain: None))
+
+    def test_failures_are_not_cached(self):
+        registry = AppTokenRegistry()
+
+        def failing_register(domain):
+            raise ConnectionError(domain)
+
+        self.assertRaises(ConnectionError, registry.get_or_register, "down.social", lambda domain: None,
+                          failing_register)
+        credentials = registry.get_or_register("down.social", lambda domain: AppCredentials("id", "secret", "token"),
+                                               failing_register)
+        self.assertEqual("id", credentials.client_id)
+        # Now read from memory, so neither callable is used anymore
+        self.assertEqual(credentials, registry.get_or_register("down.social", None, None))
+
+
+class TestAppCredentials(unittest.TestCase):
+    """App registration against mocked servers, so no real Mastodon instance is needed"""
+
+    def setUp(self) -> None:
+        test_config_loc = Path("configuration/test_mastodon_client_info.ini")
+        parser = configparser.ConfigParser()
+        parser.read(test_config_loc)
+        self.app = create_app(db_file_name=parser["TEST_SETTINGS"]["test_db_location"])
+        self.app.config.update({"TESTING": True})
+        with self.app.app_context():
+            dbi.drop_all()
+            dbi.create_all()
+
+        logger_name = "app_token_registry_test"
+        test_log_file = Path("{r}/{n}.log".format(r=parser["TEST_SETTINGS"]["test_log_root"], n=logger_name))
+        logger = LoggingHelper.generate_logger(logging.INFO, test_log_file, logger_name)
+        self.client = MastodonOAuthInterface(logger, parser["REDIRECT_URI"]["redirect_uri"])
+
+    def test_registers_once_per_domain(self):
+        create_client = mock.patch.object(self.client, "_create_new_mastodon_client", return_value=("id", "secret"))
+        with self.app.app_context(), create_client as create:
+            self.assertEqual(("new.social", None), self.client.find_app_credentials("https://new.social"))
+            # The app's access token is not needed for the OAuth flow, so it is not requested
+            self.assertEqual(AppCredentials("id", "secret", None), self.client.get_app_credentials("new.social"))
+            self.assertEqual(AppCredentials("id", "secret", None), self.client.get_app_credentials("new.social"))
+            self.assertEqual(("new.social", AppCredentials("id", "secret", None)),
+                             self.client.find_app_credentials("new.social"))
+            self.assertEqual(1, create.call_count)
+            self.assertIsNone(ApplicationTokens.query.filter_by(server="new.social").one().access_token)
+
+    def test_concurrent_registration_by_another_process(self):
+        with self.app.app_context():
+            # Stored by another process after this one found no credentials, but before it stored its own
+            dbi.session.add(ApplicationTokens(server="new.social", client_id="other-id", client_secret="other-secret",
+                                              access_token="other-token", redirect_uri=self.client.REDIRECT_URI))
+            dbi.session.commit()
+
+            with mock.patch.object(self.client, "_create_new_mastodon_client", return_value=("id", "secret")):
+                self.assertEqual(("other-id", "other-secret", "other-token"),
+                                 self.client.add_domain_to_database("new.social"))
+            self.assertEqual(1, ApplicationTokens.query.filter_by(server="new.social").count())
+
+    def test_rejected_rows_are_not_taken_for_concurrent_registrations(self):
+        rejected = sqlalchemy.exc.IntegrityError("INSERT", {}, Exception("NOT NULL constraint failed"))
+        with self.app.app_context(), \
+                mock.patch.object(self.client, "_create_new_mastodon_client", return_value=("id", "secret")), \
+                mock.patch.object(dbi.session, "commit", side_effect=rejected):
+            self.assertRaises(sqlalchemy.exc.IntegrityError, self.client.add_domain_to_database, "new.social")
@@ -123,3 +123,24 @@ class TestAuthPage(unittest.TestCase):
         pw_response = client.post(login_url, data={USERNAME_FIELD: TEST_USER, PASSWORD_FIELD: "meow"})
         decoded_pw_response = pw_response.data.decode("utf-8")
         self.assertIn(INVALID_PASSWORD_MSG, decoded_pw_response)
+
+    def test_legacy_hash_is_rehashed_on_log_in(self):
+        login_url = "{r}/login".format(r=self.page_root)
+        client = self.app.test_client()
+
+        TEST_USER = "Meowmaster"
+        TEST_PASSWORD = "Infinite4oid!"
+
+        with self.app.app_context():
+            # Made with parameters other than the configured ones, eg. by an older release
+            user = User(username=TEST_USER, password=generate_password_hash(TEST_PASSWORD, "pbkdf2:sha256:1000"))
+            dbi.session.add(user)
+            dbi.session.commit()
+
+        response = client.post(login_url, data={USERNAME_FIELD: TEST_USER, PASSWORD_FIELD: TEST_PASSWORD})
+        self.assertIn("feed/home", response.data.decode("utf-8"))
+
+        with self.app.app_context():
+            rehashed = User.query.filter_by(username=TEST_USER).one().password
+            self.assertFalse(rehashed.startswith("pbkdf2:sha256:1000$"))
+            self.assertTrue(check_password_hash(rehashed, TEST_PASSWORD))
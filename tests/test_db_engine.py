@@ -0,0 +1,57 @@
+import configparser
+import logging
+import tempfile
+import unittest
+from pathlib import Path
+
+import sqlalchemy
+from sqlalchemy import exc
+
+from feed_amalgamator.helpers.db_engine import build_engine_options, install_connection_settings
+from feed_amalgamator.helpers.logging_helper import LoggingHelper
+
+
+class TestDbEngine(unittest.TestCase):
+    def setUp(self) -> None:
+        logger_name = "db_engine_test"
+        self.logger = LoggingHelper.generate_logger(logging.INFO, Path("logs/test_logs/{n}.log".format(n=logger_name)),
+                                                    logger_name)
+        self.parser = configparser.ConfigParser()
+        self.parser.read_dict({"DATABASE": {"POOL_SIZE": "1", "MAX_OVERFLOW": "0", "POOL_TIMEOUT": "0.05",
+                                            "SQLITE_BUSY_TIMEOUT": "2.5"}})
+        self.db_dir = tempfile.TemporaryDirectory()
+        self.db_uri = "sqlite:///{p}".format(p=Path(self.db_dir.name) / "engine.sqlite")
+
+    def tearDown(self) -> None:
+        self.db_dir.cleanup()
+
+    def test_sqlite_connection_settings(self):
+        engine_options, _ = build_engine_options(self.parser, is_sqlite=True, metrics_logger=self.logger)
+        self.assertNotIn("pool_pre_ping", engine_options)
+        engine = sqlalchemy.create_engine(self.db_uri, **engine_options)
+        install_connection_settings(engine, self.parser)
+        with engine.connect() as connection:
+            self.assertEqual("wal", connection.exec_driver_sql("PRAGMA journal_mode").scalar())
+            self.assertEqual(2500, connection.exec_driver_sql("PRAGMA busy_timeout").scalar())
+        engine.dispose()
+
+    def test_production_pool_health_checks(self):
+        engine_options, _ = build_engine_options(self.parser, is_sqlite=False, metrics_logger=self.logger)
+        self.assertTrue(engine_options["pool_pre_ping"])
+        self.assertEqual(1800, engine_options["pool_recycle"])
+        self.assertEqual(1, engine_options["pool_size"])
+
+    def test_checkouts_are_measured(self):
+        engine_options, metrics = build_engine_options(self.parser, is_sqlite=True, metrics_logger=self.logger)
+        engine = sqlalchemy.create_engine(self.db_uri, **engine_options)
+        with engine.connect():
+            # The only connection is in use, so this times out
+            self.assertRaises(exc.TimeoutError, engine.connect)
+        with engine.connect():
+            pass
+        engine.dispose()
+
+        summary = metrics.summary()
+        self.assertEqual(2, summary["checkouts"])
+        self.assertEqual(1, summary["timeouts"])
+        self.assertEqual(1.0, summary["peak_saturation"])
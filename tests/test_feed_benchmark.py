@@ -0,0 +1,46 @@
+import unittest
+
+from benchmarks.fake_mastodon import FakeMastodonServer
+from benchmarks.feed_benchmark import (percentile, find_regressions, scenario_users_by_servers,
+                                       scenario_flaky_instance)
+
+
+class TestFeedBenchmark(unittest.TestCase):
+    """Tests the offline benchmark harness. Runs entirely against local fake Mastodon servers"""
+
+    def test_percentile(self):
+        samples = [float(n) for n in range(1, 101)]
+        self.assertEqual(50.0, percentile(samples, 50))
+        self.assertEqual(95.0, percentile(samples, 95))
+        self.assertEqual(99.0, percentile(samples, 99))
+        self.assertEqual(7.0, percentile([7.0], 99))
+        self.assertEqual(0.0, percentile([], 50))
+
+    def test_find_regressions(self):
+        baseline = {"a": {"p95_ms": 100.0, "throughput_rps": 10.0}}
+        self.assertEqual([], find_regressions({"a": {"p95_ms": 110.0, "throughput_rps": 9.0}}, baseline, 0.2))
+        self.assertEqual(2, len(find_regressions({"a": {"p95_ms": 150.0, "throughput_rps": 5.0}}, baseline, 0.2)))
+        self.assertEqual([], find_regressions({"b": {"p95_ms": 150.0, "throughput_rps": 5.0}}, baseline, 0.2))
+
+    def test_fake_server_timelines_are_stable(self):
+        with FakeMastodonServer(timeline_size=5) as server:
+            first = server.get_timeline("token", "home")
+            self.assertEqual(5, len(first))
+            self.assertEqual(first, server.get_timeline("token", "home"))
+
+            new_status = server.publish_status("token")
+            self.assertEqual(new_status, server.get_timeline("token", "home")[0])
+            self.assertNotEqual(first[0]["id"], server.get_timeline("other_token", "home")[0]["id"])
+
+    def test_users_by_servers_scenario(self):
+        result = scenario_users_by_servers(num_users=2, num_servers=2, rounds=2, latency=0.0, concurrency=1)[0]
+        summary = result.summary()
+        self.assertEqual(4, summary["requests"])
+        self.assertEqual(0, summary["errors"])
+        self.assertGreater(summary["throughput_rps"], 0)
+        self.assertLessEqual(summary["p50_ms"], summary["p99_ms"])
+
+    def test_flaky_instance_scenario(self):
+        result = scenario_flaky_instance(num_users=1, num_servers=2, rounds=3, latency=0.0, concurrency=1,
+                                         error_rate=1.0)[0]
+        self.assertEqual(3, result.summary()["errors"])
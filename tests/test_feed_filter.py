@@ -0,0 +1,126 @@
+import configparser
+import unittest
+from http import HTTPStatus
+from pathlib import Path
+
+from werkzeug.security import generate_password_hash
+
+from benchmarks.fake_mastodon import FakeMastodonServer
+from feed_amalgamator import create_app, dbi, feed
+from feed_amalgamator.constants.common_constants import USER_ID_FIELD
+from feed_amalgamator.constants.error_messages import FILTER_RULE_ALREADY_EXISTS_MSG
+from feed_amalgamator.helpers.db_interface import FilterRule, User, UserServer
+from feed_amalgamator.helpers.feed_filter import CompiledFilter, FilterCache, compile_words, normalize_rule
+from feed_amalgamator.helpers.post_view import PostView
+from tests.test_post_view import make_status
+
+
+def make_post(status_id: int, content: str, acct: str = "frieren", server: str = "mastodon.social") -> PostView:
+    status = make_status(status_id)
+    status["content"] = content
+    status["account"]["acct"] = acct
+    return PostView.from_status(status, server)
+
+
+class TestFeedFilter(unittest.TestCase):
+    def test_rules_are_normalized(self):
+        self.assertEqual("spoilers ahead", normalize_rule("word", "  Spoilers \n Ahead "))
+        self.assertEqual("himmel@hero.social", normalize_rule("account", "@Himmel@hero.social"))
+        self.assertEqual("demon.social", normalize_rule("domain", "https://Demon.social/about"))
+        self.assertEqual("", normalize_rule("domain", "@"))
+
+    def test_words_only_match_whole(self):
+        pattern = compile_words(["cat", "cats", "catalog", "#baking", "new york"])
+        self.assertIsNotNone(pattern.search("my cats are cute"))
+        self.assertIsNotNone(pattern.search("i love #baking!"))
+        self.assertIsNotNone(pattern.search("off to new york"))
+        self.assertIsNone(pattern.search("category theory"))
+        self.assertIsNone(pattern.search("new yorker"))
+        self.assertIsNone(compile_words([]))
+
+    def test_posts_are_muted(self):
+        user_filter = CompiledFilter([("word", "spoiler"), ("account", "himmel@hero.social"),
+                                      ("account", "heiter@mastodon.social"), ("domain", "demon.social")], 100)
+        posts = [
+            make_post(1, "<p>Nothing to see</p>"),
+            make_post(2, "<p>Big <b>SPOILER</b> ahead</p>"),
+            make_post(3, "<p>Hi</p>", acct="Himmel@hero.social"),
+            make_post(4, "<p>Hi</p>", acct="heiter"),  # Local to the server it was fetched from
+            make_post(5, "<p>Hi</p>", acct="aura@north.demon.social"),
+            make_post(6, "<p>Hi</p>", acct="heiter", server="http://127.0.0.1:8000"),
+        ]
+        self.assertEqual([1, 6], [post.id for post in user_filter.apply(posts)])
+        self.assertTrue(CompiledFilter([], 100).allows(posts[1]))
+
+    def test_verdicts_are_cached(self):
+        user_filter = CompiledFilter([("word", "spoiler")], 100)
+        post = make_post(1, "<p>spoiler</p>")
+        self.assertFalse(user_filter.allows(post))
+        post.content = "<p>No longer matches, but is the same version of the post</p>"
+        self.assertFalse(user_filter.allows(post))
+
+    def test_compiled_filters_are_cached_per_user(self):
+        cache = FilterCache(max_users=1, ttl=300.0, verdict_cache_size=100)
+        loads = []
+
+        def load_rules():
+            loads.append(1)
+            return [("word", "spoiler")]
+        first = cache.get(1, load_rules)
+        self.assertIs(first, cache.get(1, load_rules))
+        cache.invalidate(1)
+        self.assertIsNot(first, cache.get(1, load_rules))
+        cache.get(2, load_rules)  # Evicts user 1
+        cache.get(1, load_rules)
+        self.assertEqual(4, len(loads))
+        self.assertEqual(first.fingerprint, cache.get(1, load_rules).fingerprint)
+
+
+class TestFiltersPage(unittest.TestCase):
+    """Filters the feed of a local fake server, so no real Mastodon instance is needed"""
+
+    def setUp(self) -> None:
+        test_config_loc = Path("configuration/test_mastodon_client_info.ini")
+        parser = configparser.ConfigParser()
+        parser.read(test_config_loc)
+        self.app = create_app(db_file_name=parser["TEST_SETTINGS"]["test_db_location"])
+        self.app.config.update({"TESTING": True})
+        with self.app.app_context():
+            dbi.drop_all()
+            dbi.create_all()
+            dbi.session.add(User(username="Meowmaster", password=generate_password_hash("Infinite4oid!")))
+            dbi.session.commit()
+        feed.filter_cache.invalidate(1)
+        self.client = self.app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[USER_ID_FIELD] = 1
+
+    def test_muted_posts_are_left_out(self):
+        with FakeMastodonServer(name="filter.fake", timeline_size=8, reblog_ratio=0) as server:
+            with self.app.app_context():
+                dbi.session.add(UserServer(user_id=1, server=server.base_url, token="token"))
+                dbi.session.commit()
+            unfiltered = self.client.get("feed/api/home")
+            self.assertEqual(8, len(unfiltered.get_json()["posts"]))
+
+            # Posts 0 to 3 are by author0, and post 5 mentions a muted word
+            self.client.post("feed/filters", data={"kind": "account", "value": "@author0@filter.fake"})
+            self.client.post("feed/filters", data={"kind": "word", "value": "post 5"})
+            response = self.client.post("feed/filters", data={"kind": "word", "value": "Post  5"})
+            self.assertEqual(HTTPStatus.FOUND, response.status_code)
+            self.assertIn(FILTER_RULE_ALREADY_EXISTS_MSG, self.client.get("feed/filters").data.decode("utf-8"))
+
+            filtered = self.client.get("feed/api/home", headers={"If-None-Match": unfiltered.headers["ETag"]})
+            self.assertEqual(HTTPStatus.OK, filtered.status_code)  # The feed changed along with the rules
+            contents = [post["content"] for post in filtered.get_json()["posts"]]
+            self.assertEqual({"<p>Post {i} of home on filter.fake for token</p>".format(i=i) for i in (4, 6, 7)},
+                             set(contents))
+            page = self.client.get("feed/home").data.decode("utf-8")
+            self.assertNotIn("Post 5 of home", page)
+            self.assertIn("Post 4 of home", page)
+
+            with self.app.app_context():
+                rule_ids = [rule.filter_rule_id for rule in FilterRule.query.all()]
+            self.client.post("feed/filters", data={"filter_rules": rule_ids})
+            self.assertEqual(8, len(self.client.get("feed/api/home").get_json()["posts"]))
+        self.assertIn("Nothing is muted", self.client.get("feed/filters").data.decode("utf-8"))
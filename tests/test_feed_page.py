@@ -1,14 +1,18 @@
 import configparser
 import unittest
+from http import HTTPStatus
 from pathlib import Path
+from unittest import mock
 
 from werkzeug.security import generate_password_hash
 
-from feed_amalgamator import create_app, dbi
+from benchmarks.fake_mastodon import FakeMastodonServer
+from feed_amalgamator import create_app, dbi, feed
 from feed_amalgamator.constants.common_constants import USER_ID_FIELD, USER_DOMAIN_FIELD, SERVERS_FIELD
 from feed_amalgamator.constants.error_messages import NO_CONTENT_FOUND_MSG, INVALID_MASTODON_DOMAIN_MSG, \
-    INVALID_DELETE_SERVER_RECORD_MSG
+    INVALID_DELETE_SERVER_RECORD_MSG, FEED_SERVER_UNAVAILABLE_MSG
 from feed_amalgamator.helpers.db_interface import User, ApplicationTokens, UserServer
+from tests.test_stream_ingestion import wait_until
 
 
 class TestFeedPage(unittest.TestCase):
@@ -30,6 +34,9 @@ class TestFeedPage(unittest.TestCase):
         with self.app.app_context():
             dbi.drop_all()  # For a clean slate in the test db
             dbi.create_all()
+        # The in-memory layers of the db would otherwise outlive it
+        feed.auth_api.app_token_registry.clear()
+        feed.auth_api.instance_cache.clear()
 
         self.page_root = "feed"
         self.redirect_uri = parser["REDIRECT_URI"]["redirect_uri"]
@@ -73,6 +80,135 @@ class TestFeedPage(unittest.TestCase):
         self.assertIn(self.client_domain, decoded_resp)
         self.assertIn(self.alt_client_domain, decoded_resp)
 
+    def test_feed_amalgamation_with_fake_servers(self):
+        """Same as test_feed_amalgamation, but against local fake servers so it runs offline"""
+        client = self.app.test_client()
+        home_url = "{r}/home".format(r=self.page_root)
+
+        with FakeMastodonServer(name="one.fake", reblog_ratio=0.5) as server_one, \
+                FakeMastodonServer(name="two.fake", seed=1) as server_two:
+            with self.app.app_context():
+                user = User(username="Meowmaster", password=generate_password_hash("Infinite4oid!"))
+                dbi.session.add(user)
+                dbi.session.commit()
+                dbi.session.add(UserServer(user_id=1, server=server_one.base_url, token="token-one"))
+                dbi.session.add(UserServer(user_id=1, server=server_two.base_url, token="token-two"))
+                dbi.session.commit()
+
+            with client.session_transaction() as sess:
+                sess[USER_ID_FIELD] = 1
+
+            decoded_resp = client.get(home_url).data.decode("utf-8")
+            self.assertIn(server_one.base_url, decoded_resp)
+            self.assertIn(server_two.base_url, decoded_resp)
+
+        self.assertIn("for token-one", decoded_resp)
+        self.assertIn("for token-two", decoded_resp)
+        self.assertIn("boosted", decoded_resp)
+
+    def test_streamed_feed(self):
+        client = self.app.test_client()
+        home_url = "{r}/home?stream=1".format(r=self.page_root)
+
+        with FakeMastodonServer(name="one.fake") as server_one, \
+                FakeMastodonServer(name="down.fake", error_rate=1.0) as server_down:
+            with self.app.app_context():
+                user = User(username="Meowmaster", password=generate_password_hash("Infinite4oid!"))
+                dbi.session.add(user)
+                dbi.session.commit()
+                dbi.session.add(UserServer(user_id=1, server=server_one.base_url, token="token-one"))
+                dbi.session.add(UserServer(user_id=1, server=server_down.base_url, token="token-down"))
+                dbi.session.commit()
+
+            with client.session_transaction() as sess:
+                sess[USER_ID_FIELD] = 1
+
+            response = client.get(home_url)
+            self.assertTrue(response.is_streamed)
+            decoded_resp = response.get_data(as_text=True)
+            # A failing server no longer fails the whole page once streaming has started
+            self.assertIn("{m}: {s}".format(m=FEED_SERVER_UNAVAILABLE_MSG, s=server_down.base_url), decoded_resp)
+
+        self.assertIn("for token-one", decoded_resp)
+        self.assertNotIn("for token-down", decoded_resp)
+
+    def test_feed_api_conditional_get(self):
+        client = self.app.test_client()
+        api_url = "{r}/api/home".format(r=self.page_root)
+        self.assertEqual(HTTPStatus.UNAUTHORIZED, client.get(api_url).status_code)
+
+        with FakeMastodonServer(name="one.fake", timeline_size=5) as server_one:
+            with self.app.app_context():
+                user = User(username="Meowmaster", password=generate_password_hash("Infinite4oid!"))
+                dbi.session.add(user)
+                dbi.session.commit()
+                dbi.session.add(UserServer(user_id=1, server=server_one.base_url, token="token-one"))
+                dbi.session.commit()
+
+            with client.session_transaction() as sess:
+                sess[USER_ID_FIELD] = 1
+
+            response = client.get(api_url)
+            self.assertEqual(HTTPStatus.OK, response.status_code)
+            posts = response.get_json()["posts"]
+            self.assertEqual(5, len(posts))
+            self.assertEqual(sorted([p["favourites_count"] for p in posts], reverse=True),
+                             [p["favourites_count"] for p in posts])
+            etag = response.headers["ETag"]
+
+            not_modified = client.get(api_url, headers={"If-None-Match": etag})
+            self.assertEqual(HTTPStatus.NOT_MODIFIED, not_modified.status_code)
+            self.assertEqual(b"", not_modified.data)
+
+            server_one.publish_status("token-one")
+            modified = client.get(api_url, headers={"If-None-Match": etag})
+            self.assertEqual(HTTPStatus.OK, modified.status_code)
+            self.assertNotEqual(etag, modified.headers["ETag"])
+
+            # Favourited without any new status, which changes the ranking of the feed
+            etag = modified.headers["ETag"]
+            server_one.get_timeline("token-one", "home")[-1]["favourites_count"] += 1000
+            favourited = client.get(api_url, headers={"If-None-Match": etag})
+            self.assertEqual(HTTPStatus.OK, favourited.status_code)
+            self.assertEqual(server_one.get_timeline("token-one", "home")[-1]["id"],
+                             str(favourited.get_json()["posts"][0]["id"]))
+
+    def test_live_feed_updates(self):
+        client = self.app.test_client()
+        live_url = "{r}/live".format(r=self.page_root)
+        self.assertEqual(HTTPStatus.UNAUTHORIZED, client.get(live_url).status_code)
+
+        with FakeMastodonServer(name="one.fake", timeline_size=5, heartbeat_interval=0.05) as server_one:
+            with self.app.app_context():
+                user = User(username="Meowmaster", password=generate_password_hash("Infinite4oid!"))
+                dbi.session.add(user)
+                dbi.session.commit()
+                dbi.session.add(UserServer(user_id=1, server=server_one.base_url, token="token-one"))
+                dbi.session.commit()
+
+            with client.session_transaction() as sess:
+                sess[USER_ID_FIELD] = 1
+
+            # Nothing is ever pushed without streaming ingestion
+            self.assertEqual(HTTPStatus.NO_CONTENT, client.get(live_url).status_code)
+
+            self.app.config["STREAM_INGESTION"] = True
+            try:
+                response = client.get(live_url, buffered=False)
+                self.assertEqual("text/event-stream", response.mimetype)
+                events = iter(response.response)
+                self.assertTrue(next(events).startswith(b"retry:"))
+                self.assertTrue(wait_until(lambda: feed.timeline_store.is_live((server_one.base_url, "token-one"))))
+
+                new_status = server_one.publish_status("token-one", content="<p>Fresh off the press</p>")
+                event = next(events).decode("utf-8")
+                self.assertTrue(event.startswith("event: post\n"))
+                self.assertIn('"id": "{i}"'.format(i=new_status["id"]), event)
+                self.assertIn("Fresh off the press", event)
+                response.close()
+            finally:
+                feed.stream_ingestion.stop_all()
+
     def test_no_servers_added(self):
         """Proper error message should be found when the user has no servers added but visits the home page"""
         client = self.app.test_client()
@@ -128,6 +264,27 @@ class TestFeedPage(unittest.TestCase):
         self.assertIn("oauth/authorize", decoded_response)  # Ensure that users are redirected to the correct page
         self.assertIn(self.client_domain, decoded_response)
 
+    def test_add_server_redirect_url_for_new_domain(self):
+        """Adding a server on a domain we have no client for yet, against mocked Mastodon endpoints"""
+        client = self.app.test_client()
+        instance_response = mock.Mock(status_code=HTTPStatus.OK, headers={},
+                                      content=b'{"domain": "new.social", "version": "4.2.0"}')
+        apps_response = mock.Mock(status_code=HTTPStatus.OK, text='{"client_id": "id", "client_secret": "secret"}')
+        add_server_url = "{r}/add_server".format(r=self.page_root)
+        with mock.patch("requests.get", return_value=instance_response) as get, \
+                mock.patch("requests.post", return_value=apps_response) as post:
+            response = client.post(add_server_url, data={USER_DOMAIN_FIELD: "https://new.social"})
+
+        self.assertEqual(HTTPStatus.FOUND, response.status_code)
+        self.assertIn("https://new.social/oauth/authorize", response.headers["Location"])
+        self.assertIn("client_id=id", response.headers["Location"])
+        # Only verification and app registration are on the critical path. The client is started with the version
+        # found during verification, and the app's own access token is left for later
+        self.assertEqual(["https://new.social/api/v2/instance"], [c.args[0] for c in get.call_args_list])
+        self.assertEqual(["https://new.social/api/v1/apps"], [c.args[0] for c in post.call_args_list])
+        with self.app.app_context():
+            self.assertIsNone(ApplicationTokens.query.filter_by(server="new.social").one().access_token)
+
     def test_delete_server(self):
         TEST_USER = "Meowmaster"
         TEST_PASSWORD = "Infinite4oid!"
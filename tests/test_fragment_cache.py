@@ -0,0 +1,50 @@
+import unittest
+
+from feed_amalgamator.helpers.fragment_cache import FragmentCache
+from feed_amalgamator.helpers.post_view import PostView
+from tests.test_post_view import make_status
+
+
+class TestFragmentCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.rendered = []
+        self.cache = FragmentCache(max_entries=2, count_bucket_size=5)
+
+    def render(self, post):
+        self.rendered.append(post.id)
+        return "<article>{c}</article>".format(c=post.content)
+
+    def test_only_new_posts_are_rendered(self):
+        posts = [PostView.from_status(make_status(i), "mastodon.social") for i in range(2)]
+        first = self.cache.render_all(posts, self.render)
+        second = self.cache.render_all(posts, self.render)
+
+        self.assertEqual(first, second)
+        self.assertEqual([0, 1], self.rendered)
+        self.assertEqual(2, self.cache.hits)
+        self.assertIn("<p>Hello 0</p>", str(first[0]))  # Markup is not escaped again
+
+    def test_key_changes(self):
+        post = PostView.from_status(make_status(0, favourites_count=1), "mastodon.social")
+        self.cache.get_or_render(post, self.render)
+
+        post.favourites_count = 4  # Same bucket
+        self.cache.get_or_render(post, self.render)
+        self.assertEqual([0], self.rendered)
+
+        post.favourites_count = 5  # New bucket
+        self.cache.get_or_render(post, self.render)
+        post.original_server = "mastodon.world"
+        self.cache.get_or_render(post, self.render)
+        self.assertEqual([0, 0, 0], self.rendered)
+
+    def test_least_recently_used_is_evicted(self):
+        posts = [PostView.from_status(make_status(i)) for i in range(3)]
+        self.cache.render_all(posts[:2], self.render)
+        self.cache.get_or_render(posts[0], self.render)  # posts[1] is now the least recently used
+        self.cache.get_or_render(posts[2], self.render)
+        self.assertEqual(2, len(self.cache))
+
+        self.cache.get_or_render(posts[0], self.render)
+        self.cache.get_or_render(posts[1], self.render)
+        self.assertEqual([0, 1, 2, 1], self.rendered)
@@ -0,0 +1,140 @@
+import logging
+import multiprocessing
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+from flask import Flask
+
+from benchmarks.fake_mastodon import FakeMastodonServer
+from feed_amalgamator.helpers.db_interface import dbi, PartitionLease, UserServer
+from feed_amalgamator.helpers.ingestion_sharding import ConsistentHashRing, LeaseCoordinator, ShardedIngestion
+from feed_amalgamator.helpers.logging_helper import LoggingHelper
+from feed_amalgamator.helpers.stream_ingestion import StreamIngestionService
+from feed_amalgamator.helpers.timeline_store import TimelineStore
+from tests.test_stream_ingestion import wait_until
+
+NUM_PARTITIONS = 32
+VIRTUAL_NODES = 64
+
+
+def build_app(db_path: str) -> Flask:
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///{p}".format(p=db_path)
+    dbi.init_app(app)
+    with app.app_context():
+        dbi.create_all()
+    return app
+
+
+def run_worker(db_path: str, worker_id: str):
+    """Heartbeats as an ingestion worker until killed. Runs in its own process"""
+    app = build_app(db_path)
+    coordinator = LeaseCoordinator(worker_id, NUM_PARTITIONS, VIRTUAL_NODES, lease_ttl=1.0)
+    while True:
+        with app.app_context():
+            try:
+                coordinator.heartbeat()
+            except Exception:
+                dbi.session.rollback()  # Eg. the database is locked by another worker. Tried again next round
+        time.sleep(0.1)
+
+
+class TestConsistentHashRing(unittest.TestCase):
+    def test_partitions_are_spread_and_move_little(self):
+        ring = ConsistentHashRing(["a", "b", "c"], VIRTUAL_NODES)
+        owners = {partition: ring.owner(partition) for partition in range(1024)}
+        self.assertEqual({"a", "b", "c"}, set(owners.values()))
+        self.assertTrue(all(200 < list(owners.values()).count(worker) < 500 for worker in "abc"))
+
+        grown_ring = ConsistentHashRing(["a", "b", "c", "d"], VIRTUAL_NODES)
+        moved = [partition for partition in owners if grown_ring.owner(partition) != owners[partition]]
+        # Only the partitions the new worker takes over move
+        self.assertTrue(all(grown_ring.owner(partition) == "d" for partition in moved))
+        self.assertLess(len(moved), 1024 / 2)
+        self.assertIsNone(ConsistentHashRing([], VIRTUAL_NODES).owner(0))
+
+
+class TestShardedIngestion(unittest.TestCase):
+    """Shares a SQLite database between workers, standing in for the database shared between nodes"""
+
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.db_path = str(Path(self.temp_dir.name, "sharding.sqlite"))
+        self.app = build_app(self.db_path)
+
+    def tearDown(self) -> None:
+        with self.app.app_context():
+            dbi.session.remove()
+            dbi.engine.dispose()
+        self.temp_dir.cleanup()
+
+    def lease_holders(self) -> dict[int, str]:
+        with self.app.app_context():
+            return dict(dbi.session.query(PartitionLease.partition, PartitionLease.worker_id).all())
+
+    def leases_follow_ring(self, worker_ids: list[str]) -> bool:
+        ring = ConsistentHashRing(worker_ids, VIRTUAL_NODES)
+        return self.lease_holders() == {partition: ring.owner(partition) for partition in range(NUM_PARTITIONS)}
+
+    def test_partitions_are_rebalanced_between_processes(self):
+        context = multiprocessing.get_context("spawn")
+        worker_ids = ["worker-{i}".format(i=i) for i in range(3)]
+        processes = [context.Process(target=run_worker, args=(self.db_path, worker_id), daemon=True)
+                     for worker_id in worker_ids]
+        for process in processes:
+            process.start()
+        try:
+            # Every partition is leased to exactly one worker, the one the ring assigns it to
+            self.assertTrue(wait_until(lambda: self.leases_follow_ring(worker_ids), timeout=30.0))
+            self.assertEqual(set(worker_ids), set(self.lease_holders().values()))
+
+            processes[0].kill()  # Crashes without giving up its leases, which then have to expire
+            self.assertTrue(wait_until(lambda: self.leases_follow_ring(worker_ids[1:]), timeout=30.0))
+        finally:
+            for process in processes:
+                process.kill()
+                process.join()
+
+    def test_timelines_are_mirrored_from_their_owner(self):
+        logger_name = "ingestion_sharding_test"
+        logger = LoggingHelper.generate_logger(logging.INFO, Path("logs/test_logs/{n}.log".format(n=logger_name)),
+                                               logger_name)
+        workers = []
+        for worker_id in ("first", "second"):
+            store = TimelineStore(max_posts_per_timeline=50)
+            stream_ingestion = StreamIngestionService(logger, store, num_posts_to_get=20, initial_backoff=0.05,
+                                                      max_backoff=0.2, read_timeout=5)
+            # A single partition, so that one worker ingests every timeline and the other mirrors them
+            coordinator = LeaseCoordinator(worker_id, num_partitions=1, virtual_nodes=VIRTUAL_NODES, lease_ttl=5.0)
+            workers.append(ShardedIngestion(logger, coordinator, stream_ingestion, store, num_posts_to_publish=20,
+                                            rebalance_interval=0.2, sync_interval=0.05, snapshot_ttl=5.0,
+                                            follow_ttl=60.0))
+
+        with FakeMastodonServer(name="sharding.fake", timeline_size=5, heartbeat_interval=0.05) as server:
+            key = (server.base_url, "token")
+            with self.app.app_context():
+                dbi.session.add(UserServer(user_id=1, server=server.base_url, token="token"))
+                dbi.session.commit()
+            for worker in workers:
+                worker.start(self.app)
+            self.assertTrue(wait_until(lambda: any(worker.owns(server.base_url) for worker in workers)))
+            owner, follower = workers if workers[0].owns(server.base_url) else workers[::-1]
+            self.assertTrue(wait_until(lambda: owner.timeline_store.is_live(key)))
+            self.assertFalse(follower.stream_ingestion.is_subscribed(*key))
+
+            self.assertIsNone(follower.timeline_store.get_live(key, 20))  # Starts mirroring the timeline
+            self.assertTrue(wait_until(lambda: follower.timeline_store.get_live(key, 20) is not None))
+            self.assertEqual(5, len(follower.timeline_store.get_live(key, 20)))
+            new_status = server.publish_status("token")
+            self.assertTrue(wait_until(lambda: new_status["content"] in {
+                post.content for post in follower.timeline_store.get_live(key, 20) or []}))
+            self.assertEqual(server.base_url, follower.timeline_store.get_live(key, 1)[0].original_server)
+            self.assertEqual(1, server.request_counts["/api/v1/streaming/user"])
+
+            # The remaining worker takes over the timelines of a worker that leaves
+            owner.stop(self.app)
+            self.assertTrue(wait_until(lambda: follower.stream_ingestion.is_subscribed(*key)))
+            self.assertTrue(wait_until(lambda: follower.timeline_store.is_live(key)))
+            follower.stop(self.app)
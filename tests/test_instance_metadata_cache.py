@@ -0,0 +1,105 @@
+import configparser
+import logging
+import unittest
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from unittest import mock
+
+import requests
+
+from feed_amalgamator import create_app, dbi
+from feed_amalgamator.constants.error_messages import INVALID_MASTODON_DOMAIN_MSG, INSTANCE_TIMEOUT_MSG
+from feed_amalgamator.helpers.db_interface import InstanceMetadata
+from feed_amalgamator.helpers.instance_metadata_cache import InstanceInfo, InstanceMetadataCache
+from feed_amalgamator.helpers.logging_helper import LoggingHelper
+from feed_amalgamator.helpers.mastodon_oauth_interface import MastodonOAuthInterface
+
+
+def make_info(domain, canonical_domain, age_seconds=0) -> InstanceInfo:
+    checked_at = datetime.now(timezone.utc) - timedelta(seconds=age_seconds)
+    return InstanceInfo(domain=domain, canonical_domain=canonical_domain, version=None, streaming_url=None,
+                        rate_limit=None, error_message=None if canonical_domain else "invalid",
+                        checked_at=checked_at)
+
+
+def make_instance_response(domain) -> mock.Mock:
+    response = mock.Mock(status_code=200, headers={"X-RateLimit-Limit": "300"})
+    response.content = ('{"domain": "%s", "version": "4.2.0", '
+                        '"configuration": {"urls": {"streaming": "wss://%s"}}}' % (domain, domain)).encode("utf-8")
+    return response
+
+
+class TestInstanceMetadataCache(unittest.TestCase):
+    def test_ttls(self):
+        cache = InstanceMetadataCache(ttl=60, negative_ttl=10, max_entries=2)
+        cache.put(make_info("Mastodon.social", "mastodon.social"))
+        cache.put(make_info("mastodo.social", None, age_seconds=20))  # Invalid, and already expired
+        self.assertEqual("mastodon.social", cache.get("mastodon.SOCIAL").canonical_domain)
+        self.assertIsNone(cache.get("mastodo.social"))
+
+        self.assertTrue(cache.is_fresh(make_info("a.social", "a.social", age_seconds=30)))
+        self.assertFalse(cache.is_fresh(make_info("a.social", None, age_seconds=30)))
+
+    def test_evicts_least_recently_used(self):
+        cache = InstanceMetadataCache(ttl=60, negative_ttl=10, max_entries=2)
+        cache.put(make_info("a.social", "a.social"))
+        cache.put(make_info("b.social", "b.social"))
+        cache.get("a.social")
+        cache.put(make_info("c.social", "c.social"))
+        self.assertEqual(2, len(cache))
+        self.assertIsNone(cache.get("b.social"))
+        self.assertIsNotNone(cache.get("a.social"))
+
+
+class TestVerifyUserProvidedDomainCaching(unittest.TestCase):
+    """Verification against a mocked instance, so no real Mastodon instance is needed"""
+
+    def setUp(self) -> None:
+        test_config_loc = Path("configuration/test_mastodon_client_info.ini")
+        parser = configparser.ConfigParser()
+        parser.read(test_config_loc)
+        self.app = create_app(db_file_name=parser["TEST_SETTINGS"]["test_db_location"])
+        self.app.config.update({"TESTING": True})
+        with self.app.app_context():
+            dbi.drop_all()
+            dbi.create_all()
+
+        logger_name = "instance_metadata_test"
+        test_log_file = Path("{r}/{n}.log".format(r=parser["TEST_SETTINGS"]["test_log_root"], n=logger_name))
+        self.logger = LoggingHelper.generate_logger(logging.INFO, test_log_file, logger_name)
+        self.client = MastodonOAuthInterface(self.logger, parser["REDIRECT_URI"]["redirect_uri"])
+
+    def test_valid_domain_is_verified_once(self):
+        with self.app.app_context(), \
+                mock.patch("requests.get", return_value=make_instance_response("mastodon.social")) as get:
+            for user_domain in ["https://mastodon.social", "mastodon.social"]:
+                self.assertEqual((True, "mastodon.social"), self.client.verify_user_provided_domain(user_domain))
+            self.assertEqual(1, get.call_count)
+            self.assertEqual((3.05, 10.0), get.call_args.kwargs["timeout"])
+
+            record = InstanceMetadata.query.filter_by(domain="mastodon.social").one()
+            self.assertEqual("4.2.0", record.version)
+            self.assertEqual(300, record.rate_limit)
+            self.assertEqual("wss://mastodon.social", record.streaming_url)
+
+            # A new worker (with an empty in-memory layer) reads the outcome back from the database
+            other_worker = MastodonOAuthInterface(self.logger, self.client.REDIRECT_URI)
+            self.assertEqual((True, "mastodon.social"), other_worker.verify_user_provided_domain("mastodon.social"))
+            self.assertEqual(1, get.call_count)
+
+    def test_invalid_domain_is_negatively_cached(self):
+        with self.app.app_context(), \
+                mock.patch("requests.get", side_effect=requests.exceptions.ConnectionError) as get:
+            expected = (False, "{m}:mastodo.social".format(m=INVALID_MASTODON_DOMAIN_MSG))
+            self.assertEqual(expected, self.client.verify_user_provided_domain("mastodo.social"))
+            self.assertEqual(expected, self.client.verify_user_provided_domain("mastodo.social"))
+            self.assertEqual(1, get.call_count)
+
+    def test_timeouts_are_not_cached(self):
+        with self.app.app_context(), \
+                mock.patch("requests.get", side_effect=requests.exceptions.ConnectTimeout) as get:
+            expected = (False, "{m}:slow.social".format(m=INSTANCE_TIMEOUT_MSG))
+            self.assertEqual(expected, self.client.verify_user_provided_domain("slow.social"))
+            self.assertEqual(expected, self.client.verify_user_provided_domain("slow.social"))
+            self.assertEqual(2, get.call_count)
+            self.assertIsNone(InstanceMetadata.query.filter_by(domain="slow.social").first())
@@ -0,0 +1,38 @@
+import unittest
+
+from benchmarks.fake_mastodon import FakeMastodonServer
+from benchmarks.load_test import FeedLoadTest
+
+
+class TestLoadTest(unittest.TestCase):
+    """Drives the app with concurrent simulated users against local fake Mastodon servers"""
+
+    def setUp(self) -> None:
+        self.servers = [FakeMastodonServer(name="server{n}.fake".format(n=n), timeline_size=4, seed=n).start()
+                        for n in range(3)]
+        self.load_test = FeedLoadTest(self.servers, num_users=6, servers_per_user=2)
+
+    def tearDown(self) -> None:
+        for server in self.servers:
+            server.stop()
+
+    def test_concurrent_users_only_see_their_own_posts(self):
+        for concurrency in (1, 6):
+            result = self.load_test.run(concurrency, rounds=2)
+            self.assertEqual((12, 0), (len(result.latencies), result.errors))
+            self.assertEqual(0, result.num_violations, result.violations)
+
+    def test_concurrent_users_add_their_own_servers(self):
+        result = self.load_test.add_servers(concurrency=6)
+        self.assertEqual(0, result.errors, result.violations)
+        self.assertEqual(0, result.num_violations, result.violations)
+
+    def test_leaked_and_missing_posts_are_violations(self):
+        user_id, tokens = next(iter(self.load_test.user_tokens.items()))
+        token, server = next(iter(tokens.items()))
+        own_post = {"id": 1, "content": "<p>Post 0 of home on x for {t}</p>".format(t=token), "original_server": server}
+        self.assertEqual(len(tokens) - 1, len(self.load_test.check_isolation(user_id, [own_post])))
+        leaked_post = dict(own_post, content="<p>Post 0 of home on x for user99-server0</p>")
+        misattributed_post = dict(own_post, original_server="http://elsewhere")
+        self.assertEqual(len(tokens) + 2, len(self.load_test.check_isolation(user_id, [leaked_post,
+                                                                                     misattributed_post])))
@@ -1,8 +1,11 @@
 import unittest
 import logging
 import configparser
+import threading
 from pathlib import Path
 
+from benchmarks.fake_mastodon import FakeMastodonServer
+
 from feed_amalgamator.helpers.custom_exceptions import InvalidApiInputError
 from feed_amalgamator.helpers.logging_helper import LoggingHelper
 from feed_amalgamator.helpers.mastodon_oauth_interface import MastodonOAuthInterface
@@ -53,3 +56,23 @@ class TestOauthInterface(unittest.TestCase):
 
         # Testing a CORRECT auth code cannot be done automatically as it requires
         # a manual redirect to a page where a user has to log in. As such, we only test the wrong situation
+
+    def test_app_clients_are_kept_per_thread(self):
+        redirect_urls = {}
+        both_started = threading.Barrier(2)
+
+        def add_server(server: FakeMastodonServer):
+            self.client.start_app_api_client(server.base_url, "id", "secret", None)
+            both_started.wait()  # Neither thread may see the client of the other
+            redirect_urls[server.base_url] = self.client.generate_redirect_url()
+
+        with FakeMastodonServer(name="first.fake") as first, FakeMastodonServer(name="second.fake") as second:
+            threads = [threading.Thread(target=add_server, args=(server,)) for server in (first, second)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual({first.base_url, second.base_url}, set(redirect_urls))
+        for domain, redirect_url in redirect_urls.items():
+            self.assertTrue(redirect_url.startswith(domain), redirect_url)
+        self.assertIsNone(self.client.app_client)  # Nor does the main thread
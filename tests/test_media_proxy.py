@@ -0,0 +1,192 @@
+import configparser
+import importlib.util
+import io
+import logging
+import os
+import re
+import socket
+import tempfile
+import threading
+import unittest
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from unittest import mock
+
+from werkzeug.security import generate_password_hash
+
+from benchmarks.fake_mastodon import FakeMastodonServer, AVATAR_PNG, AVATAR_SIZE
+from feed_amalgamator import create_app, dbi, feed
+from feed_amalgamator.constants.common_constants import USER_ID_FIELD
+from feed_amalgamator.helpers.db_interface import User, UserServer
+from feed_amalgamator.helpers.media_proxy import MediaCache, MediaFetchError, MediaProxy, resize_image, \
+    resolve_public_address
+
+PUBLIC_ADDRESS = "93.184.215.14"
+
+
+class TestMediaCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temporary_dir = tempfile.TemporaryDirectory()
+        self.root = Path(self.temporary_dir.name)
+
+    def tearDown(self) -> None:
+        self.temporary_dir.cleanup()
+
+    def test_least_recently_used_files_are_evicted(self):
+        cache = MediaCache(self.root, max_bytes=25)
+        cache.put("aa01", b"x" * 10, ".png")
+        cache.put("bb02", b"x" * 10, ".png")
+        cache.get("aa01")  # Makes bb02 the least recently used file
+        cache.put("cc03", b"x" * 10, ".jpg")
+
+        self.assertIsNone(cache.get("bb02"))
+        self.assertFalse((self.root / "bb" / "bb02.png").exists())
+        self.assertEqual(20, cache.total_bytes)
+        self.assertEqual(self.root / "cc" / "cc03.jpg", cache.get("cc03"))
+
+        # The cache outlives a restart
+        restarted_cache = MediaCache(self.root, max_bytes=25)
+        self.assertEqual(2, len(restarted_cache))
+        self.assertEqual(20, restarted_cache.total_bytes)
+        self.assertIsNotNone(restarted_cache.get("aa01"))
+
+    @unittest.skipUnless(importlib.util.find_spec("PIL"), "Resizing needs Pillow")
+    def test_images_are_resized(self):
+        from PIL import Image
+        resized = resize_image(AVATAR_PNG, 100)
+        with Image.open(io.BytesIO(resized)) as image:
+            self.assertEqual((100, 100), image.size)
+        self.assertEqual(AVATAR_PNG, resize_image(AVATAR_PNG, 2 * AVATAR_SIZE))  # Never enlarged
+
+
+class RedirectToMetadataHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(HTTPStatus.FOUND)
+        self.send_header("Location", "http://169.254.169.254/latest/meta-data/")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestMediaProxy(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temporary_dir = tempfile.TemporaryDirectory()
+        self.cache = MediaCache(Path(self.temporary_dir.name), max_bytes=1024)
+
+    def tearDown(self) -> None:
+        self.temporary_dir.cleanup()
+
+    def test_only_public_http_urls_are_fetched(self):
+        proxy = MediaProxy(logging.getLogger(__name__), self.cache, "secret", max_fetch_bytes=1024)
+        for url in ("file:///etc/passwd", "ftp://files.example/a.png", "http:///a.png"):
+            self.assertRaises(MediaFetchError, proxy.check_fetchable, url)
+        proxy.check_fetchable("https://{a}/avatar.png".format(a=PUBLIC_ADDRESS))
+
+        for host in ("127.0.0.1", "localhost", "10.1.2.3", "169.254.169.254", "::1", "::ffff:192.168.0.1"):
+            self.assertRaises(MediaFetchError, resolve_public_address, host, 80)
+        self.assertEqual(PUBLIC_ADDRESS, resolve_public_address(PUBLIC_ADDRESS, 443))
+
+        with self.assertRaisesRegex(MediaFetchError, "not a public address"):
+            proxy.get("http://127.0.0.1:5000/avatar.png", 100)  # Refused before connecting
+        self.assertEqual(0, len(self.cache))
+
+    def test_connections_go_to_the_checked_address(self):
+        proxy = MediaProxy(logging.getLogger(__name__), self.cache, "secret", max_fetch_bytes=1024)
+        answers = iter([PUBLIC_ADDRESS])
+
+        def rebinding_getaddrinfo(host, port, *args, **kwargs):
+            # Public when first asked, internal from then on
+            return [(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, "", (next(answers, "127.0.0.1"), port))]
+
+        with mock.patch("socket.getaddrinfo", side_effect=rebinding_getaddrinfo), \
+                mock.patch("urllib3.util.connection.create_connection",
+                           side_effect=ConnectionRefusedError) as connect:
+            self.assertRaises(MediaFetchError, proxy.get, "http://rebinding.example/avatar.png", 100)
+        self.assertEqual([(PUBLIC_ADDRESS, 80)], [call.args[0] for call in connect.call_args_list])
+
+    def test_redirects_are_checked(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), RedirectToMetadataHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        proxy = MediaProxy(logging.getLogger(__name__), self.cache, "secret", max_fetch_bytes=1024,
+                           allow_private_addresses=True)
+        checked = []
+
+        def check_fetchable(url):
+            checked.append(url)
+            if "169.254.169.254" in url:
+                raise MediaFetchError(url)
+
+        url = "http://127.0.0.1:{p}/avatar.png".format(p=server.server_address[1])
+        try:
+            # Proxies of the environment are not used, or the redirect would never be seen
+            with mock.patch.object(proxy, "check_fetchable", side_effect=check_fetchable), \
+                    mock.patch.dict(os.environ, {"HTTP_PROXY": "http://127.0.0.1:9", "NO_PROXY": ""}):
+                self.assertRaises(MediaFetchError, proxy.get, url, 100)
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual([url, "http://169.254.169.254/latest/meta-data/"], checked)
+
+
+class TestMediaProxyRoute(unittest.TestCase):
+    """Proxies the avatars served by a local fake server, so no real Mastodon instance is needed"""
+
+    def setUp(self) -> None:
+        test_config_loc = Path("configuration/test_mastodon_client_info.ini")
+        parser = configparser.ConfigParser()
+        parser.read(test_config_loc)
+        self.temporary_dir = tempfile.TemporaryDirectory()
+        self.app = create_app(db_file_name=parser["TEST_SETTINGS"]["test_db_location"])
+        # The fake server is on the loopback address, which the proxy only fetches from when allowed to
+        self.app.config.update({"TESTING": True, "MEDIA_PROXY": True, "MEDIA_CACHE_DIR": self.temporary_dir.name,
+                                "MEDIA_PROXY_ALLOW_PRIVATE_ADDRESSES": True})
+        with self.app.app_context():
+            dbi.drop_all()
+            dbi.create_all()
+            dbi.session.add(User(username="Meowmaster", password=generate_password_hash("Infinite4oid!")))
+            dbi.session.commit()
+        feed.fragment_cache.clear()  # Fragments rendered by other tests link to the remote avatars
+
+        self.server = FakeMastodonServer(name="media.fake", timeline_size=4, reblog_ratio=0).start()
+        with self.app.app_context():
+            dbi.session.add(UserServer(user_id=1, server=self.server.base_url, token="token"))
+            dbi.session.commit()
+        self.client = self.app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[USER_ID_FIELD] = 1
+
+    def tearDown(self) -> None:
+        self.server.stop()
+        self.temporary_dir.cleanup()
+
+    def test_avatars_are_proxied_and_cached(self):
+        page = self.client.get("feed/home").data.decode("utf-8")
+        self.assertNotIn("/avatars/", page)
+        media_urls = set(re.findall(r'src="(/feed/media/[^"]+)"', page))
+        self.assertEqual(1, len(media_urls))  # All four posts are by the same author
+        media_url = media_urls.pop()
+
+        response = self.client.get(media_url)
+        self.assertEqual(HTTPStatus.OK, response.status_code)
+        self.assertEqual("image/png", response.mimetype)
+        self.assertTrue(response.cache_control.immutable)
+        self.assertEqual(365 * 24 * 3600, response.cache_control.max_age)
+
+        # Served from the cache, and not at all to browsers that already have it
+        self.assertEqual(response.data, self.client.get(media_url).data)
+        revalidated = self.client.get(media_url, headers={"If-None-Match": response.get_etag()[0]})
+        self.assertEqual(HTTPStatus.NOT_MODIFIED, revalidated.status_code)
+        self.assertEqual(1, self.server.request_counts["/avatars/author0.png"])
+
+    def test_unproxied_media(self):
+        self.assertEqual(HTTPStatus.NOT_FOUND, self.client.get("feed/media/not-signed").status_code)
+
+        # Images that cannot be fetched are linked to directly
+        with self.app.test_request_context():
+            missing_url = "{b}/missing.png".format(b=self.server.base_url)
+            token = feed.get_media_proxy().sign(missing_url, 100)
+        response = self.client.get("feed/media/{t}".format(t=token))
+        self.assertEqual(HTTPStatus.FOUND, response.status_code)
+        self.assertEqual(missing_url, response.location)
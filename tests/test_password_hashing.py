@@ -0,0 +1,37 @@
+import threading
+import time
+import unittest
+
+from werkzeug.security import generate_password_hash
+
+from feed_amalgamator.helpers.password_hashing import PasswordHashingService, HashingOverloadedError
+
+
+class TestPasswordHashingService(unittest.TestCase):
+    def test_hash_and_check(self):
+        service = PasswordHashingService("pbkdf2:sha256:1000", max_workers=2, max_pending=4, queue_timeout=1)
+        password_hash = service.hash_password("Infinite4oid!")
+        self.assertTrue(password_hash.startswith("pbkdf2:sha256:1000$"))
+        self.assertTrue(service.check_password(password_hash, "Infinite4oid!"))
+        self.assertFalse(service.check_password(password_hash, "meow"))
+        self.assertEqual(3, service.metrics.summary()["completed"])
+
+    def test_needs_rehash(self):
+        service = PasswordHashingService("pbkdf2:sha256:1000", max_workers=1, max_pending=1, queue_timeout=1)
+        self.assertFalse(service.needs_rehash(generate_password_hash("x", "pbkdf2:sha256:1000")))
+        self.assertTrue(service.needs_rehash(generate_password_hash("x", "pbkdf2:sha256:2000")))
+        self.assertTrue(service.needs_rehash(generate_password_hash("x", "scrypt")))
+
+        # Parameters left at their defaults are resolved from an actual hash
+        default_scrypt = PasswordHashingService("scrypt", max_workers=1, max_pending=1, queue_timeout=1)
+        self.assertFalse(default_scrypt.needs_rehash(generate_password_hash("x", "scrypt:32768:8:1")))
+
+    def test_overload_is_turned_away(self):
+        # Slow enough to still be hashing when the second request gives up
+        service = PasswordHashingService("pbkdf2:sha256:2000000", max_workers=1, max_pending=1, queue_timeout=0.01)
+        slow_hash = threading.Thread(target=service.hash_password, args=("Infinite4oid!",))
+        slow_hash.start()
+        time.sleep(0.05)
+        self.assertRaises(HashingOverloadedError, service.hash_password, "meow")
+        slow_hash.join()
+        self.assertEqual(1, service.metrics.summary()["rejected"])
@@ -0,0 +1,76 @@
+import unittest
+from datetime import datetime, timezone
+
+from feed_amalgamator.constants.common_constants import POST_DATE_FORMAT
+from feed_amalgamator.feed import filter_sort_feed
+from feed_amalgamator.helpers.post_view import interned_account_count, PostView, MediaView
+
+
+def make_status(status_id, favourites_count=0, reblog=None, media_attachments=None, display_name="Frieren"):
+    return {
+        "id": status_id,
+        "uri": "https://mastodon.social/users/frieren/statuses/{i}".format(i=status_id),
+        "created_at": datetime(2023, 12, 1, 13, 45, tzinfo=timezone.utc),
+        "edited_at": None,
+        "account": {"display_name": display_name, "acct": "frieren@mastodon.social",
+                    "avatar": "https://mastodon.social/avatar.png", "emojis": []},
+        "reblog": reblog,
+        "content": "<p>Hello {i}</p>".format(i=status_id),
+        "visibility": "public",
+        "reblogs_count": 1,
+        "favourites_count": favourites_count,
+        "media_attachments": media_attachments or [],
+        "mentions": [],
+        "tags": [],
+        "card": None,
+    }
+
+
+class TestPostView(unittest.TestCase):
+    def test_from_status(self):
+        status = make_status(1, favourites_count=5, media_attachments=[
+            {"type": "image", "url": "https://x/1.png", "description": "a cat"},
+            {"type": "audio", "url": "https://x/1.mp3", "description": None},
+        ])
+        post = PostView.from_status(status, original_server="mastodon.social")
+
+        self.assertEqual(1, post.id)
+        self.assertIsNone(post.boosted_by)
+        self.assertEqual("Frieren", post.account.display_name)
+        self.assertEqual("mastodon.social", post.original_server)
+        self.assertEqual(status["created_at"].strftime(POST_DATE_FORMAT), post.created_at_display)
+        self.assertEqual(5, post.favourites_count)
+        # Only media types the template can render are kept
+        self.assertEqual((MediaView("image", "https://x/1.png", "a cat"),), post.media)
+        self.assertFalse(hasattr(post, "__dict__"))
+
+    def test_reblog_is_unwrapped(self):
+        boosted = make_status(1, favourites_count=42, display_name="Himmel")
+        boost = make_status(2, favourites_count=0, reblog=boosted, display_name="Fern")
+        post = PostView.from_status(boost)
+
+        self.assertEqual(2, post.id)  # Identity stays with the boost itself
+        self.assertEqual("Fern", post.boosted_by)
+        self.assertEqual("Himmel", post.account.display_name)
+        self.assertEqual(boosted["content"], post.content)
+        self.assertEqual(42, post.favourites_count)
+
+    def test_authors_are_interned(self):
+        posts = [PostView.from_status(make_status(i), "mastodon.social") for i in range(3)]
+        posts.append(PostView.from_status(make_status(3), "hachyderm.io"))
+        self.assertTrue(all(post.account is posts[0].account for post in posts))
+        renamed = PostView.from_status(make_status(4, display_name="Frieren the Slayer"))
+        self.assertIsNot(posts[0].account, renamed.account)
+        self.assertEqual("frieren@mastodon.social", renamed.account.acct)
+
+        restored = PostView.from_dict(posts[0].to_dict())
+        self.assertEqual("Frieren", posts[0].to_dict()["display_name"])  # Flattened for the JSON api
+        self.assertIs(posts[0].account, restored.account)
+
+        accounts_before = interned_account_count()
+        del renamed
+        self.assertEqual(accounts_before - 1, interned_account_count())  # Dropped with the last post referring to it
+
+    def test_filter_sort_feed(self):
+        posts = [PostView.from_status(make_status(i, favourites_count=count)) for i, count in enumerate([3, 9, 1])]
+        self.assertEqual([9, 3, 1], [post.favourites_count for post in filter_sort_feed(posts)])
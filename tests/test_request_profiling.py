@@ -0,0 +1,140 @@
+import configparser
+import pstats
+import tempfile
+import threading
+import unittest
+from http import HTTPStatus
+from pathlib import Path
+from unittest import mock
+
+from werkzeug.security import generate_password_hash
+
+from benchmarks.fake_mastodon import FakeMastodonServer
+from feed_amalgamator import create_app, dbi
+from feed_amalgamator.constants.common_constants import USER_ID_FIELD, PROFILE_TOKEN_HEADER, PROFILE_ID_HEADER
+from feed_amalgamator.helpers.db_interface import User, UserServer
+from feed_amalgamator.helpers import request_profiling
+from feed_amalgamator.helpers.request_profiling import ProfileRing, RequestProfile
+
+ADMIN_TOKEN = "profiling-admin-token"
+
+
+class TestProfileRing(unittest.TestCase):
+    def test_only_the_newest_profiles_are_kept(self):
+        with tempfile.TemporaryDirectory() as directory:
+            ring = ProfileRing(Path(directory), max_profiles=3)
+            profiles = [RequestProfile("GET", "/feed/home") for _ in range(5)]
+            for profile in profiles:
+                profile.start()
+                sum(range(100))
+                ring.save(profile.stats(), profile.metadata(profile.stop()))
+            self.assertEqual([profile.profile_id for profile in profiles[:1:-1]],
+                             [summary["id"] for summary in ring.list()])
+            self.assertEqual(6, len(list(Path(directory).iterdir())))
+            self.assertIsNone(ring.stats_path(profiles[0].profile_id))
+            self.assertIsNotNone(ring.stats_path(profiles[4].profile_id))
+            self.assertIsNone(ring.stats_path("../" + profiles[4].profile_id))
+
+
+class TestRequestProfiling(unittest.TestCase):
+    """Profiles feeds of a local fake server, so no real Mastodon instance is needed"""
+
+    def setUp(self) -> None:
+        test_config_loc = Path("configuration/test_mastodon_client_info.ini")
+        parser = configparser.ConfigParser()
+        parser.read(test_config_loc)
+        self.profile_dir = tempfile.TemporaryDirectory()
+        self.app = create_app(test_config={"TESTING": True, "PROFILING_TOKEN": ADMIN_TOKEN,
+                                           "PROFILE_DIR": self.profile_dir.name},
+                              db_file_name=parser["TEST_SETTINGS"]["test_db_location"])
+        with self.app.app_context():
+            dbi.drop_all()
+            dbi.create_all()
+            dbi.session.add(User(username="Meowmaster", password=generate_password_hash("Infinite4oid!")))
+            dbi.session.commit()
+        self.client = self.app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[USER_ID_FIELD] = 1
+
+    def tearDown(self) -> None:
+        self.profile_dir.cleanup()
+
+    def list_profiles(self) -> list[dict]:
+        return self.client.get("/profiles", headers={PROFILE_TOKEN_HEADER: ADMIN_TOKEN}).get_json()["profiles"]
+
+    def test_requests_with_the_admin_token_are_profiled(self):
+        with FakeMastodonServer(name="profiling.fake", timeline_size=5) as server:
+            with self.app.app_context():
+                dbi.session.add(UserServer(user_id=1, server=server.base_url, token="token"))
+                dbi.session.commit()
+            unprofiled = self.client.get("feed/api/home")
+            unprofiled.close()
+            self.assertNotIn(PROFILE_ID_HEADER, unprofiled.headers)
+            self.assertEqual([], self.list_profiles())
+
+            response = self.client.get("feed/home", headers={PROFILE_TOKEN_HEADER: ADMIN_TOKEN})
+            response.close()  # Like a server would, once the body is sent
+            profile_id = response.headers[PROFILE_ID_HEADER]
+
+        profiles = self.list_profiles()
+        self.assertEqual([profile_id], [profile["id"] for profile in profiles])
+        self.assertEqual(1, profiles[0]["user_id"])
+        self.assertEqual(HTTPStatus.OK, profiles[0]["status"])
+        spans = profiles[0]["spans"]
+        self.assertEqual(1, spans["get_timeline_data"]["count"])  # Polled on a fetcher thread
+        self.assertIn("filter_sort_feed", spans)
+        self.assertIn("render_template feed/home.html", spans)
+
+        download = self.client.get("/profiles/" + profile_id, headers={PROFILE_TOKEN_HEADER: ADMIN_TOKEN})
+        stats_path = Path(self.profile_dir.name, "download.prof")
+        stats_path.write_bytes(download.data)
+        download.close()
+        profiled_functions = {function for _, _, function in pstats.Stats(str(stats_path)).stats}
+        self.assertIn("get_timeline_data", profiled_functions)  # Worker threads are part of the profile
+
+    def load_profiled_feeds_at_once(self, num_requests: int) -> list[int]:
+        """:return: The status of every request"""
+        statuses = []
+        all_started = threading.Barrier(num_requests)
+
+        def load_profiled_feed():
+            client = self.app.test_client()
+            with client.session_transaction() as sess:
+                sess[USER_ID_FIELD] = 1
+            all_started.wait()
+            response = client.get("feed/home", headers={PROFILE_TOKEN_HEADER: ADMIN_TOKEN})
+            response.close()
+            statuses.append(response.status_code)
+
+        # Slow enough for the requests to overlap
+        with FakeMastodonServer(name="profiling.fake", timeline_size=5, latency=0.2) as server:
+            with self.app.app_context():
+                dbi.session.add(UserServer(user_id=1, server=server.base_url, token="token"))
+                dbi.session.commit()
+            threads = [threading.Thread(target=load_profiled_feed) for _ in range(num_requests)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        return statuses
+
+    def test_requests_profiled_at_the_same_time(self):
+        self.assertEqual([HTTPStatus.OK] * 2, self.load_profiled_feeds_at_once(2))
+        # From Python 3.12, only one profiler can be enabled at a time
+        self.assertEqual(2 if request_profiling.PROFILER_PER_THREAD else 1, len(self.list_profiles()))
+
+    def test_one_request_at_a_time_is_profiled_with_a_single_profiler(self):
+        with mock.patch.object(request_profiling, "PROFILER_PER_THREAD", False):
+            self.assertEqual([HTTPStatus.OK] * 2, self.load_profiled_feeds_at_once(2))
+            profiles = self.list_profiles()
+            self.assertEqual(1, len(profiles))
+            self.assertEqual(1, profiles[0]["spans"]["get_timeline_data"]["count"])
+            self.assertEqual(HTTPStatus.OK, self.load_profiled_feeds_at_once(1)[0])  # No longer held
+            self.assertEqual(2, len(self.list_profiles()))
+
+    def test_profiles_need_the_admin_token(self):
+        self.assertEqual(HTTPStatus.NOT_FOUND, self.client.get("/profiles").status_code)
+        self.assertEqual(HTTPStatus.NOT_FOUND, self.client.get(
+            "/profiles", headers={PROFILE_TOKEN_HEADER: "guess"}).status_code)
+        self.assertEqual(HTTPStatus.NOT_FOUND, self.client.get(
+            "/profiles/1-2-3", headers={PROFILE_TOKEN_HEADER: ADMIN_TOKEN}).status_code)
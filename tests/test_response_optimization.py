@@ -0,0 +1,77 @@
+import configparser
+import gzip
+import re
+import unittest
+from http import HTTPStatus
+from pathlib import Path
+
+from werkzeug.security import generate_password_hash
+
+from benchmarks.fake_mastodon import FakeMastodonServer
+from feed_amalgamator import create_app, dbi
+from feed_amalgamator.constants.common_constants import USER_ID_FIELD
+from feed_amalgamator.helpers.db_interface import User, UserServer
+
+
+class TestResponseOptimization(unittest.TestCase):
+    """Against a local fake server, so no real Mastodon instance is needed"""
+
+    def setUp(self) -> None:
+        test_config_loc = Path("configuration/test_mastodon_client_info.ini")
+        parser = configparser.ConfigParser()
+        parser.read(test_config_loc)
+        self.app = create_app(db_file_name=parser["TEST_SETTINGS"]["test_db_location"])
+        self.app.config.update({"TESTING": True})
+        with self.app.app_context():
+            dbi.drop_all()
+            dbi.create_all()
+            dbi.session.add(User(username="Meowmaster", password=generate_password_hash("Infinite4oid!")))
+            dbi.session.commit()
+        self.client = self.app.test_client()
+
+    def test_feed_is_compressed(self):
+        with FakeMastodonServer(name="one.fake", timeline_size=20) as server_one:
+            with self.app.app_context():
+                dbi.session.add(UserServer(user_id=1, server=server_one.base_url, token="token-one"))
+                dbi.session.commit()
+            with self.client.session_transaction() as sess:
+                sess[USER_ID_FIELD] = 1
+
+            plain = self.client.get("feed/api/home")
+            compressed = self.client.get("feed/api/home", headers={"Accept-Encoding": "gzip, deflate"})
+            self.assertNotIn("Content-Encoding", plain.headers)
+            self.assertEqual("gzip", compressed.headers["Content-Encoding"])
+            self.assertIn("Accept-Encoding", compressed.vary)
+            self.assertLess(len(compressed.data), len(plain.data))
+            self.assertEqual(plain.data, gzip.decompress(compressed.data))
+
+            # The weak ETag of the compressed response still makes for conditional requests
+            etag = compressed.headers["ETag"]
+            self.assertTrue(etag.startswith("W/"))
+            not_modified = self.client.get("feed/api/home", headers={"Accept-Encoding": "gzip",
+                                                                     "If-None-Match": etag})
+            self.assertEqual(HTTPStatus.NOT_MODIFIED, not_modified.status_code)
+
+            refused = self.client.get("feed/api/home", headers={"Accept-Encoding": "gzip;q=0"})
+            self.assertNotIn("Content-Encoding", refused.headers)
+
+            # Streamed pages must reach the browser chunk by chunk
+            streamed = self.client.get("feed/home?stream=1", headers={"Accept-Encoding": "gzip"})
+            self.assertNotIn("Content-Encoding", streamed.headers)
+
+    def test_static_assets_are_fingerprinted(self):
+        page = self.client.get("auth/login").data.decode("utf-8")
+        style_url = re.search(r'href="(/static/style\.css\?v=[0-9a-f]+)"', page).group(1)
+
+        response = self.client.get(style_url, headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(HTTPStatus.OK, response.status_code)
+        self.assertTrue(response.cache_control.immutable)
+        self.assertEqual(365 * 24 * 3600, response.cache_control.max_age)
+        self.assertEqual("gzip", response.headers["Content-Encoding"])
+        self.assertEqual(Path(self.app.static_folder, "style.css").read_bytes(), gzip.decompress(response.data))
+        # Served from the cache of compressed files the second time
+        self.assertEqual(response.data, self.client.get(style_url, headers={"Accept-Encoding": "gzip"}).data)
+
+        # Without a fingerprint, browsers must revalidate
+        with self.client.get("static/style.css") as unversioned:
+            self.assertFalse(unversioned.cache_control.immutable)
@@ -0,0 +1,135 @@
+import configparser
+import tempfile
+import unittest
+from datetime import datetime, timezone
+from http import HTTPStatus
+from pathlib import Path
+from unittest import mock
+
+from werkzeug.security import generate_password_hash
+
+from benchmarks.fake_mastodon import FakeMastodonServer
+from feed_amalgamator import create_app, dbi, feed
+from feed_amalgamator.constants.common_constants import USER_ID_FIELD
+from feed_amalgamator.helpers.db_interface import User, UserServer
+from feed_amalgamator.helpers.post_view import PostView
+from feed_amalgamator.helpers.search_index import SearchIndex, build_match_query, strip_html
+from tests.test_post_view import make_status
+
+
+def make_post(status_id: int, content: str, display_name: str = "Frieren") -> PostView:
+    status = make_status(status_id, display_name=display_name)
+    status["content"] = content
+    return PostView.from_status(status, "mastodon.social")
+
+
+class TestSearchIndex(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temporary_dir = tempfile.TemporaryDirectory()
+        self.index = SearchIndex(max_posts=1000, seen_cache_size=1000, rank_candidates=100)
+        self.index.open(Path(self.temporary_dir.name, "search_index.sqlite"))
+        self.own_timeline = [("mastodon.social", "token")]
+
+    def tearDown(self) -> None:
+        self.index.flush()
+        self.temporary_dir.cleanup()
+
+    def search_ids(self, query: str, server_tokens=None, page: int = 1, page_size: int = 10) -> list[int]:
+        posts, _ = self.index.search(server_tokens or self.own_timeline, query, page, page_size)
+        return [post.id for post in posts]
+
+    def test_helpers(self):
+        self.assertEqual("Tea & cake #baking", strip_html('<p>Tea &amp; cake <a href="x">#<span>baking</span></a></p>'))
+        self.assertEqual('{content author tags} : ("frieren" "elf"*)', build_match_query('frieren "elf'))
+        self.assertIsNone(build_match_query('"* -'))
+
+    def test_posts_are_ranked_and_isolated(self):
+        self.index.add("mastodon.social", "token", [
+            make_post(1, "<p>Baking bread today</p>"),
+            make_post(2, "<p>Nothing to see</p>", display_name="Baking Club"),
+            make_post(3, "<p>My sourdough <a>#<span>baking</span></a> journey</p>"),
+        ])
+        self.index.add("other.social", "other-token", [make_post(4, "<p>Baking for others</p>")])
+        # Ranks only tell matches apart when the word is rare enough
+        self.index.add("mastodon.social", "token", [make_post(i, "<p>Unrelated</p>", "Ubel") for i in range(5, 15)])
+        self.index.flush()
+
+        # Tags rank above authors, and authors above content
+        self.assertEqual([3, 2, 1], self.search_ids("baking"))
+        self.assertEqual([3], self.search_ids("sour"))  # The last word matches as a prefix
+        self.assertEqual([1], self.search_ids("baking bread"))
+        self.assertEqual([], self.search_ids('bread" OR "'))
+        self.assertEqual([4], self.search_ids("baking", [("other.social", "other-token")]))
+        self.assertEqual([], self.search_ids("baking", [("mastodon.social", "another-users-token")]))
+
+        posts, has_more = self.index.search(self.own_timeline, "baking", 1, 2)
+        self.assertEqual(([3, 2], True), ([post.id for post in posts], has_more))
+        self.assertEqual("mastodon.social", posts[0].original_server)
+        self.assertEqual(make_post(3, "<p>My sourdough <a>#<span>baking</span></a> journey</p>").content,
+                         posts[0].content)
+        self.assertEqual([1], self.search_ids("baking", page=2, page_size=2))
+
+    def test_edits_are_reindexed(self):
+        self.index.add("mastodon.social", "token", [make_post(1, "<p>Typo in the frist post</p>")])
+        self.index.add("mastodon.social", "token", [make_post(1, "<p>Typo in the frist post</p>")])  # Skipped
+        edited = make_post(1, "<p>No typo in the first post</p>")
+        edited.edited_at = datetime(2023, 12, 2, tzinfo=timezone.utc)
+        self.index.add("mastodon.social", "token", [edited])
+        self.index.flush()
+        self.assertEqual([], self.search_ids("frist"))
+        self.assertEqual([1], self.search_ids("first"))
+        self.assertEqual(edited.edited_at, self.index.search(self.own_timeline, "first", 1, 1)[0][0].edited_at)
+
+    def test_oldest_posts_are_pruned(self):
+        index = SearchIndex(max_posts=5, seen_cache_size=100, rank_candidates=100)
+        index.open(Path(self.temporary_dir.name, "pruned.sqlite"))
+        for status_id in range(1, 11):
+            index.add("mastodon.social", "token", [make_post(status_id, "<p>Post</p>")])
+        index.flush()
+        posts, _ = index.search(self.own_timeline, "post", 1, 20)
+        self.assertEqual([10, 9, 8, 7, 6], [post.id for post in posts])
+
+
+class TestSearchPage(unittest.TestCase):
+    """Searches posts fetched from a local fake server, so no real Mastodon instance is needed"""
+
+    def setUp(self) -> None:
+        test_config_loc = Path("configuration/test_mastodon_client_info.ini")
+        parser = configparser.ConfigParser()
+        parser.read(test_config_loc)
+        self.app = create_app(db_file_name=parser["TEST_SETTINGS"]["test_db_location"])
+        self.app.config.update({"TESTING": True})
+        with self.app.app_context():
+            dbi.drop_all()
+            dbi.create_all()
+            dbi.session.add(User(username="Meowmaster", password=generate_password_hash("Infinite4oid!")))
+            dbi.session.commit()
+        feed.search_index.clear()
+        self.client = self.app.test_client()
+
+    def test_search_fetched_posts(self):
+        self.assertEqual(HTTPStatus.UNAUTHORIZED, self.client.get("feed/api/search?q=post").status_code)
+        with FakeMastodonServer(name="search.fake", timeline_size=30, reblog_ratio=0) as server:
+            with self.app.app_context():
+                dbi.session.add(UserServer(user_id=1, server=server.base_url, token="token"))
+                dbi.session.commit()
+            with self.client.session_transaction() as sess:
+                sess[USER_ID_FIELD] = 1
+            self.client.get("feed/api/home")
+        feed.search_index.flush()
+
+        # Posts are fetched 20 at a time, so post 25 was never shown and cannot be found
+        found = [post["content"] for post in self.client.get("feed/api/search?q=post 3").get_json()["posts"]]
+        self.assertIn("<p>Post 3 of home on search.fake for token</p>", found)
+        self.assertEqual([], self.client.get("feed/api/search?q=post 25").get_json()["posts"])
+
+        with mock.patch.object(feed, "SEARCH_PAGE_SIZE", 15):
+            first_page = self.client.get("feed/api/search?q=search.fake").get_json()
+            self.assertTrue(first_page["has_more"])
+            second_page = self.client.get("feed/api/search?q=search.fake&page=2").get_json()
+            self.assertFalse(second_page["has_more"])
+        self.assertEqual(20, len(first_page["posts"]) + len(second_page["posts"]))
+
+        page = self.client.get("feed/search?q=post 3").data.decode("utf-8")
+        self.assertIn("Post 3 of home on search.fake", page)
+        self.assertIn('value="post 3"', page)
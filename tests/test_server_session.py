@@ -0,0 +1,118 @@
+import configparser
+import logging
+import unittest
+from http import HTTPStatus
+from pathlib import Path
+from unittest import mock
+
+from werkzeug.security import generate_password_hash
+
+from benchmarks.fake_mastodon import FakeMastodonServer
+from feed_amalgamator import create_app, dbi
+from feed_amalgamator.constants.common_constants import USERNAME_FIELD, PASSWORD_FIELD, SERVERS_FIELD
+from feed_amalgamator.helpers.db_interface import User, UserServer
+from feed_amalgamator.helpers.logging_helper import LoggingHelper
+from feed_amalgamator.helpers.server_session import LocalSessionStore, ServerSideSessionInterface
+from feed_amalgamator.helpers.timeline_fetcher import TimelineFetcher
+from feed_amalgamator.helpers.user_client_pool import UserClientPool
+
+
+class TestLocalSessionStore(unittest.TestCase):
+    def test_expiry_and_eviction(self):
+        store = LocalSessionStore(max_entries=2)
+        store.set("a", "1", ttl=600)
+        store.set("b", "2", ttl=600)
+        store.get("a")  # Makes b the least recently used entry
+        store.set("c", "3", ttl=600)
+        self.assertEqual(["1", None, "3"], [store.get(key) for key in ("a", "b", "c")])
+
+        with mock.patch("time.monotonic", return_value=10 ** 9):
+            self.assertIsNone(store.get("a"))
+
+
+class TestServerSideSessions(unittest.TestCase):
+    """Logs in through the auth page with sessions kept in a local store"""
+
+    def setUp(self) -> None:
+        test_config_loc = Path("configuration/test_mastodon_client_info.ini")
+        parser = configparser.ConfigParser()
+        parser.read(test_config_loc)
+        self.app = create_app(db_file_name=parser["TEST_SETTINGS"]["test_db_location"])
+        self.app.config.update({"TESTING": True})
+        self.session_interface = ServerSideSessionInterface(LocalSessionStore(max_entries=100), derived_state_ttl=600)
+        self.app.session_interface = self.session_interface
+        with self.app.app_context():
+            dbi.drop_all()
+            dbi.create_all()
+            dbi.session.add(User(username="Meowmaster", password=generate_password_hash("Infinite4oid!")))
+            dbi.session.commit()
+        self.client = self.app.test_client()
+
+    def log_in(self):
+        self.client.post("auth/login", data={USERNAME_FIELD: "Meowmaster", PASSWORD_FIELD: "Infinite4oid!"})
+
+    def test_cookie_only_holds_the_session_id(self):
+        self.client.set_cookie("session", "forged")  # Unsigned ids are ignored
+        with self.client.session_transaction() as sess:
+            sess["theme"] = "dark"  # Some state from before logging in
+        cookie = self.client.get_cookie("session").value
+        sid = cookie.rsplit(".", 1)[0]
+        self.assertIsNotNone(self.session_interface.store.get(ServerSideSessionInterface.SESSION_PREFIX + sid))
+
+        # Logging in issues a new id, so that an id planted before login is worthless, and drops the old one
+        self.log_in()
+        self.assertNotEqual(cookie, self.client.get_cookie("session").value)
+        self.assertIsNone(self.session_interface.store.get(ServerSideSessionInterface.SESSION_PREFIX + sid))
+
+        self.client.get("auth/logout")
+        self.assertIsNone(self.client.get_cookie("session"))
+
+    def test_server_list_is_derived_once(self):
+        with FakeMastodonServer(name="one.fake") as server_one:
+            with self.app.app_context():
+                dbi.session.add(UserServer(user_id=1, server=server_one.base_url, token="token-one"))
+                dbi.session.add(UserServer(user_id=1, server="serverTwo", token="token-two"))
+                dbi.session.commit()
+            self.log_in()
+            self.client.post("feed/delete_server", data={SERVERS_FIELD: ["serverTwo"]})
+
+            self.assertEqual(HTTPStatus.OK, self.client.get("feed/api/home").status_code)
+            self.assertEqual([(server_one.base_url, "token-one")],
+                             self.session_interface.get_derived_state("servers:1"))
+            with self.app.app_context():
+                # Not done through the feed page, so the derived list is not invalidated and still used
+                UserServer.query.filter_by(server=server_one.base_url).update({"token": "token-other"})
+                dbi.session.commit()
+            self.assertIn("for token-one", str(self.client.get("feed/api/home").get_json()))
+
+            # Changes to the servers invalidate the derived list
+            self.client.post("feed/delete_server", data={SERVERS_FIELD: [server_one.base_url]})
+            self.assertIsNone(self.session_interface.get_derived_state("servers:1"))
+
+
+class TestUserClientPool(unittest.TestCase):
+    def setUp(self) -> None:
+        logger_name = "user_client_pool_test"
+        self.logger = LoggingHelper.generate_logger(logging.INFO, Path("logs/test_logs/{n}.log".format(n=logger_name)),
+                                                    logger_name)
+
+    def test_started_clients_are_reused(self):
+        with FakeMastodonServer(timeline_size=5) as server:
+            fetcher = TimelineFetcher(self.logger, max_workers=2, client_pool=UserClientPool(2, idle_ttl=300))
+            for _ in range(3):
+                self.assertEqual(5, len(fetcher.fetch_timeline(server.base_url, "token", "home", 20)))
+            # The client's start up round trips are only made once, the timeline is fetched every time
+            self.assertEqual(1, server.request_counts["/api/v1/instance"])
+            self.assertEqual(4, server.request_counts["/api/v1/timelines/home"])
+
+    def test_expired_clients_are_not_reused(self):
+        pool = UserClientPool(max_idle_per_key=1, idle_ttl=300)
+        key = ("mastodon.social", "token")
+        pool.checkin(key, "first")
+        pool.checkin(key, "second")  # Beyond max_idle_per_key
+        self.assertEqual("first", pool.checkout(key, lambda: "new"))
+        self.assertEqual("new", pool.checkout(key, lambda: "new"))
+
+        pool.checkin(key, "first")
+        with mock.patch("time.monotonic", return_value=10 ** 9):
+            self.assertEqual("new", pool.checkout(key, lambda: "new"))
@@ -0,0 +1,122 @@
+import configparser
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import IntegrityError
+
+from feed_amalgamator import create_app, dbi, feed
+from feed_amalgamator.constants.common_constants import CREATE_SCHEMA_SETTING, WARM_UP_SETTING
+from feed_amalgamator.helpers.app_settings import read_app_settings
+from feed_amalgamator.helpers.app_token_registry import AppCredentials
+from feed_amalgamator.helpers.db_interface import ApplicationTokens
+from feed_amalgamator.helpers.logging_helper import LoggingHelper
+
+
+class TestStartup(unittest.TestCase):
+    def setUp(self) -> None:
+        parser = configparser.ConfigParser()
+        parser.read(Path("configuration/test_mastodon_client_info.ini"))
+        self.db_file_name = parser["TEST_SETTINGS"]["test_db_location"]
+
+    def test_importing_the_app_defers_mastodon(self):
+        imported = subprocess.run([sys.executable, "-c", "import sys, feed_amalgamator; "
+                                                         "print('mastodon' in sys.modules, 'requests' in sys.modules)"],
+                                  capture_output=True, text=True, check=True).stdout.strip().splitlines()[-1]
+        self.assertEqual("False False", imported)
+
+    def test_settings_are_read_once(self):
+        self.assertIs(read_app_settings(), read_app_settings())
+
+    def test_loggers_are_only_set_up_once(self):
+        with tempfile.TemporaryDirectory() as directory:
+            logger = LoggingHelper.generate_logger(logging.INFO, Path(directory, "a.log"), "test_startup")
+            LoggingHelper.generate_logger(logging.INFO, Path(directory, "a.log"), "test_startup")
+            self.assertEqual(2, len(logger.handlers))
+            LoggingHelper.generate_logger(logging.INFO, Path(directory, "b.log"), "test_startup")
+            self.assertEqual(3, len(logger.handlers))
+            for handler in logger.handlers[:]:
+                logger.removeHandler(handler)
+                handler.close()
+
+    def test_init_db_creates_the_schema(self):
+        app = create_app(test_config={"TESTING": True, CREATE_SCHEMA_SETTING: False}, db_file_name=self.db_file_name)
+        with app.app_context():
+            dbi.drop_all()
+            self.assertFalse(inspect(dbi.engine).has_table(ApplicationTokens.__tablename__))
+        result = app.test_cli_runner().invoke(args=["init-db"])
+        self.assertEqual(0, result.exit_code, result.output)
+        with app.app_context():
+            self.assertTrue(inspect(dbi.engine).has_table(ApplicationTokens.__tablename__))
+
+    def test_init_db_migrates_application_tokens(self):
+        app = create_app(test_config={"TESTING": True, CREATE_SCHEMA_SETTING: False}, db_file_name=self.db_file_name)
+        with app.app_context():
+            dbi.drop_all()
+            with dbi.engine.begin() as connection:
+                # As created before the server was unique and the access token could be left out
+                connection.execute(text("CREATE TABLE application_tokens (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                                        "server VARCHAR(100) NOT NULL, client_id VARCHAR(500) NOT NULL, "
+                                        "client_secret VARCHAR(500) NOT NULL, access_token VARCHAR(500) NOT NULL, "
+                                        "redirect_uri VARCHAR(500) NOT NULL)"))
+                for client_id in ("first", "second"):
+                    connection.execute(text("INSERT INTO application_tokens (server, client_id, client_secret, "
+                                            "access_token, redirect_uri) VALUES ('dup.social', :c, 's', 't', 'r')"),
+                                       {"c": client_id})
+        result = app.test_cli_runner().invoke(args=["init-db"])
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertIn("removing 1 duplicate rows", result.output)
+        self.assertIn("access_token nullable", result.output)
+        with app.app_context():
+            self.assertEqual(["first"], [row.client_id for row in ApplicationTokens.query.all()])
+            # Registered without requesting the app's access token
+            dbi.session.add(ApplicationTokens(server="new.social", client_id="id", client_secret="s",
+                                              access_token=None, redirect_uri="r"))
+            dbi.session.commit()
+            dbi.session.add(ApplicationTokens(server="dup.social", client_id="third", client_secret="s",
+                                              access_token="t", redirect_uri="r"))
+            self.assertRaises(IntegrityError, dbi.session.commit)
+            dbi.session.rollback()
+        # Already migrated
+        self.assertEqual("Initialized the database\n", app.test_cli_runner().invoke(args=["init-db"]).output)
+
+    def test_warm_up_loads_caches(self):
+        app = create_app(test_config={"TESTING": True}, db_file_name=self.db_file_name)
+        with app.app_context():
+            dbi.drop_all()
+            dbi.create_all()
+            dbi.session.add(ApplicationTokens(server="warm.up", client_id="id", client_secret="secret",
+                                              access_token=None, redirect_uri="urn:ietf:wg:oauth:2.0:oob"))
+            dbi.session.commit()
+        feed.auth_api.app_token_registry.clear()
+
+        warm_app = create_app(test_config={"TESTING": True, WARM_UP_SETTING: True}, db_file_name=self.db_file_name)
+        compiled = {template.name for template in warm_app.jinja_env.cache.values()}
+        self.assertEqual(set(warm_app.jinja_env.list_templates()), compiled)
+        with warm_app.app_context():
+            self.assertEqual(AppCredentials("id", "secret", None),
+                             feed.auth_api.app_token_registry.lookup("warm.up", lambda domain: None))
+        feed.auth_api.app_token_registry.clear()
+
+    @unittest.skipUnless(hasattr(os, "fork"), "Needs fork")
+    def test_forked_workers_do_not_share_pooled_connections(self):
+        app = create_app(test_config={"TESTING": True, WARM_UP_SETTING: True}, db_file_name=self.db_file_name)
+        with app.app_context():
+            pool = dbi.engine.pool
+            self.assertGreater(pool.checkedin(), 0)  # Filled by the warm-up
+            read_end, write_end = os.pipe()
+            pid = os.fork()
+            if pid == 0:  # The forked worker
+                os.close(read_end)
+                os.write(write_end, b"1" if dbi.engine.pool is not pool and dbi.engine.pool.checkedin() == 0 else b"0")
+                os._exit(0)
+            os.close(write_end)
+            os.waitpid(pid, 0)
+            with os.fdopen(read_end, "rb") as reader:
+                self.assertEqual(b"1", reader.read())
+            self.assertIs(pool, dbi.engine.pool)  # The parent keeps its connections
@@ -0,0 +1,135 @@
+import logging
+import time
+import unittest
+from pathlib import Path
+
+from benchmarks.fake_mastodon import FakeMastodonServer
+from feed_amalgamator.helpers.feed_updates import FeedSubscription
+from feed_amalgamator.helpers.logging_helper import LoggingHelper
+from feed_amalgamator.helpers.post_view import PostView
+from feed_amalgamator.helpers.stream_ingestion import StreamIngestionService
+from feed_amalgamator.helpers.timeline_fetcher import TimelineFetcher
+from feed_amalgamator.helpers.timeline_store import TimelineStore
+from tests.test_post_view import make_status
+
+
+def wait_until(predicate, timeout=5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return predicate()
+
+
+class TestTimelineStore(unittest.TestCase):
+    def setUp(self) -> None:
+        self.store = TimelineStore(max_posts_per_timeline=3)
+        self.key = ("mastodon.social", "token")
+
+    def test_not_live_timelines_are_not_read(self):
+        self.store.replace(self.key, [PostView.from_status(make_status(1))])
+        self.assertIsNone(self.store.get_live(self.key, 10))
+        self.store.set_live(self.key, True)
+        self.assertEqual([1], [post.id for post in self.store.get_live(self.key, 10)])
+        self.assertEqual("mastodon.social", self.store.get_live(self.key, 10)[0].original_server)
+
+    def test_events_are_applied(self):
+        self.store.set_live(self.key, True)
+        self.store.replace(self.key, [PostView.from_status(make_status(i)) for i in range(1, 4)])
+        self.store.add(self.key, PostView.from_status(make_status(4)))  # Evicts the oldest post
+        self.assertEqual([4, 3, 2], [post.id for post in self.store.get_live(self.key, 10)])
+
+        self.store.delete(self.key, 3)
+        edited = make_status(2)
+        edited["content"] = "<p>Edited</p>"
+        self.store.update(self.key, PostView.from_status(edited))
+        self.store.update(self.key, PostView.from_status(make_status(99)))  # Unknown posts are not added
+
+        posts = self.store.get_live(self.key, 10)
+        self.assertEqual([4, 2], [post.id for post in posts])
+        self.assertEqual("<p>Edited</p>", posts[1].content)
+        self.assertEqual([4], [post.id for post in self.store.get_live(self.key, 1)])
+
+    def test_new_posts_are_offered_to_subscriptions(self):
+        subscription = FeedSubscription({self.key}, max_queued_posts=2)
+        self.store.replace(self.key, [PostView.from_status(make_status(1))])
+        self.store.subscribe(subscription)
+
+        self.store.add(self.key, PostView.from_status(make_status(2)))
+        self.store.add(self.key, PostView.from_status(make_status(2)))  # Already known, so not offered again
+        self.store.add(("other.server", "token"), PostView.from_status(make_status(3)))
+        self.assertEqual(2, subscription.get(timeout=0).id)
+        self.assertIsNone(subscription.get(timeout=0))
+
+        # Posts missed while disconnected are caught up on by the next poll
+        self.store.replace(self.key, [PostView.from_status(make_status(i)) for i in range(1, 5)])
+        self.assertEqual([3, 4], [subscription.get(timeout=0).id for _ in range(2)])
+
+        self.store.add(self.key, PostView.from_status(make_status(5)))
+        self.store.add(self.key, PostView.from_status(make_status(6)))
+        self.store.add(self.key, PostView.from_status(make_status(7)))  # Does not fit the buffer
+        self.assertTrue(subscription.overflowed)
+
+        self.store.unsubscribe(subscription)
+        self.store.add(self.key, PostView.from_status(make_status(8)))
+        self.assertEqual([5, 6], [subscription.get(timeout=0).id for _ in range(2)])
+        self.assertIsNone(subscription.get(timeout=0))
+
+
+class TestStreamIngestion(unittest.TestCase):
+    """Streams from a local fake server, so no real Mastodon instance is needed"""
+
+    def setUp(self) -> None:
+        logger_name = "stream_ingestion_test"
+        self.logger = LoggingHelper.generate_logger(logging.INFO, Path("logs/test_logs/{n}.log".format(n=logger_name)),
+                                                    logger_name)
+        self.server = FakeMastodonServer(timeline_size=5, heartbeat_interval=0.05).start()
+        self.store = TimelineStore(max_posts_per_timeline=50)
+        self.service = StreamIngestionService(self.logger, self.store, num_posts_to_get=20, initial_backoff=0.05,
+                                              max_backoff=0.2, read_timeout=5)
+        self.key = (self.server.base_url, "token")
+
+    def tearDown(self) -> None:
+        self.service.stop_all()
+        self.server.stop()
+
+    def live_ids(self) -> list:
+        return [post.id for post in self.store.get_live(self.key, 50) or []]
+
+    def test_events_are_ingested(self):
+        self.service.subscribe(*self.key)
+        self.assertTrue(wait_until(lambda: self.store.is_live(self.key)))
+        self.assertEqual(5, len(self.live_ids()))
+
+        new_status = self.server.publish_status("token")
+        self.assertTrue(wait_until(lambda: int(new_status["id"]) in self.live_ids()))
+
+        self.server.edit_status("token", new_status["id"], "<p>Edited</p>")
+        self.assertTrue(wait_until(lambda: self.store.get_live(self.key, 1)[0].content == "<p>Edited</p>"))
+
+        self.server.delete_status("token", new_status["id"])
+        self.assertTrue(wait_until(lambda: int(new_status["id"]) not in self.live_ids()))
+
+    def test_reconnects_after_disconnect(self):
+        self.service.subscribe(*self.key)
+        self.assertTrue(wait_until(lambda: self.store.is_live(self.key)))
+
+        self.server.disconnect_streams()
+        self.assertTrue(wait_until(lambda: self.server.request_counts["/api/v1/streaming/user"] == 2))
+        self.assertTrue(wait_until(lambda: self.store.is_live(self.key)))
+
+        # Unsubscribing closes the stream for good
+        self.service.unsubscribe(*self.key)
+        self.assertTrue(wait_until(lambda: self.server.open_stream_count("token") == 0))
+        self.assertFalse(self.store.is_live(self.key))
+
+    def test_fetcher_reads_live_timelines(self):
+        fetcher = TimelineFetcher(self.logger, max_workers=2, timeline_store=self.store)
+        self.service.subscribe(*self.key)
+        self.assertTrue(wait_until(lambda: self.store.is_live(self.key)))
+        polls_before = self.server.request_counts["/api/v1/timelines/home"]
+
+        posts = fetcher.fetch_sources([self.key + ("home",)], 20)
+        self.assertEqual(5, len(posts))
+        self.assertEqual(polls_before, self.server.request_counts["/api/v1/timelines/home"])
@@ -0,0 +1,62 @@
+import json
+import unittest
+from datetime import datetime, timezone
+
+from benchmarks.codec_benchmark import benchmark_encoding, ENCODINGS, generate_timelines
+from feed_amalgamator.helpers.post_view import intern_account, PostView
+from feed_amalgamator.helpers.timeline_codec import decode_timeline, encode_timeline, FORMAT_VERSION
+from tests.test_post_view import make_status
+
+
+def make_timeline(num_posts: int) -> list[PostView]:
+    posts = []
+    for i in range(num_posts):
+        status = make_status(10 ** 17 + i, favourites_count=i, media_attachments=[
+            {"type": "image", "url": "https://x/{i}.png".format(i=i), "description": None if i % 2 else "a cat"},
+        ] * (i % 3), display_name="Author {n}".format(n=i % 4))
+        if i % 5 == 0:
+            status["edited_at"] = datetime(2023, 12, 2, 8, 30, 15, 123456, tzinfo=timezone.utc)
+        if i % 7 == 0:
+            status = make_status(i, reblog=status, display_name="Booster")
+        posts.append(PostView.from_status(status, "mastodon.social"))
+    return posts
+
+
+class TestTimelineCodec(unittest.TestCase):
+    def test_round_trip(self):
+        posts = make_timeline(50)
+        for compress in (False, True):
+            decoded = decode_timeline(encode_timeline(posts, compress=compress))
+            self.assertEqual(posts, decoded)
+            self.assertEqual([post.created_at.utcoffset() for post in posts],
+                             [post.created_at.utcoffset() for post in decoded])
+        self.assertEqual([], decode_timeline(encode_timeline([])))
+
+    def test_unusual_posts_round_trip(self):
+        post = make_timeline(1)[0]
+        post.id = "not-a-number"
+        post.content = "<p>Contains \0 and ünïcödé 🐈</p>"
+        post.account = intern_account("", post.account.acct, post.account.avatar)
+        post.created_at = post.created_at.replace(tzinfo=None)
+        post.edited_at = post.edited_at.replace(tzinfo=None)
+        self.assertEqual([post], decode_timeline(encode_timeline([post])))
+
+    def test_payloads_are_compact(self):
+        posts = make_timeline(200)
+        json_size = len(json.dumps([post.to_dict() for post in posts]).encode("utf-8"))
+        self.assertLess(len(encode_timeline(posts)), json_size / 2)
+        self.assertLess(len(encode_timeline(posts, compress=True)), json_size / 10)
+
+    def test_unknown_payloads_are_rejected(self):
+        payload = encode_timeline(make_timeline(2))
+        with self.assertRaises(ValueError):
+            decode_timeline(b"{}")
+        with self.assertRaises(ValueError):
+            decode_timeline(payload[:2] + bytes([FORMAT_VERSION + 1]) + payload[3:])
+
+    def test_benchmark_encodings_round_trip(self):
+        timelines = generate_timelines(num_timelines=2, num_posts=5, reblog_ratio=0.5)
+        for name, (encode, decode) in ENCODINGS.items():
+            summary = benchmark_encoding(encode, decode, timelines, rounds=1)
+            self.assertTrue(summary["round_trips"], name)
+            self.assertGreater(summary["bytes_per_post"], 0)
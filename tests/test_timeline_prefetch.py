@@ -0,0 +1,92 @@
+import configparser
+import unittest
+from concurrent.futures import Future
+from pathlib import Path
+from unittest import mock
+
+from werkzeug.security import generate_password_hash
+
+from benchmarks.fake_mastodon import FakeMastodonServer
+from feed_amalgamator import create_app, feed
+from feed_amalgamator.constants.common_constants import USERNAME_FIELD, PASSWORD_FIELD, PREFETCH_AT_LOGIN_SETTING
+from feed_amalgamator.helpers.db_interface import dbi, User, UserServer
+from feed_amalgamator.helpers.timeline_prefetch import PrefetchedTimelines
+
+KEY = ("mastodon.social", "token", "home", 20)
+
+
+def resolved(result=None, error=None) -> Future:
+    future = Future()
+    if error is None:
+        future.set_result(result)
+    else:
+        future.set_exception(error)
+    return future
+
+
+class TestPrefetchedTimelines(unittest.TestCase):
+    def test_prefetches_are_handed_out_once(self):
+        prefetched = PrefetchedTimelines(max_entries=10, ttl=30.0)
+        prefetched.put(KEY, resolved(["post"]))
+        self.assertEqual(["post"], prefetched.take(KEY))
+        self.assertIsNone(prefetched.take(KEY))
+        self.assertEqual((1, 1), (prefetched.hits, prefetched.misses))
+
+    def test_stale_and_failed_prefetches_are_not_handed_out(self):
+        prefetched = PrefetchedTimelines(max_entries=10, ttl=30.0)
+        prefetched.put(KEY, resolved(error=ConnectionError()))
+        self.assertIsNone(prefetched.take(KEY))
+
+        with mock.patch("time.monotonic", return_value=10 ** 9):
+            prefetched.put(KEY, resolved(["post"]))
+        with mock.patch("time.monotonic", return_value=10 ** 9 + 30):
+            self.assertIsNone(prefetched.take(KEY))
+
+    def test_oldest_prefetches_are_dropped(self):
+        prefetched = PrefetchedTimelines(max_entries=2, ttl=30.0)
+        for n in range(3):
+            prefetched.put(KEY[:3] + (n,), resolved([n]))
+        self.assertEqual(2, len(prefetched))
+        self.assertIsNone(prefetched.take(KEY[:3] + (0,)))
+        self.assertEqual([2], prefetched.take(KEY[:3] + (2,)))
+
+
+class TestLoginPrefetch(unittest.TestCase):
+    """Logs in to a feed of a local fake server, so no real Mastodon instance is needed"""
+
+    def setUp(self) -> None:
+        parser = configparser.ConfigParser()
+        parser.read(Path("configuration/test_mastodon_client_info.ini"))
+        self.app = create_app(test_config={"TESTING": True},
+                              db_file_name=parser["TEST_SETTINGS"]["test_db_location"])
+        with self.app.app_context():
+            dbi.drop_all()
+            dbi.create_all()
+            dbi.session.add(User(username="Meowmaster", password=generate_password_hash("Infinite4oid!")))
+            dbi.session.commit()
+
+    def log_in_and_load_feed(self, server: FakeMastodonServer) -> list[dict]:
+        with self.app.app_context():
+            dbi.session.add(UserServer(user_id=1, server=server.base_url, token="token"))
+            dbi.session.commit()
+        client = self.app.test_client()
+        response = client.post("auth/login", data={USERNAME_FIELD: "Meowmaster", PASSWORD_FIELD: "Infinite4oid!"})
+        self.assertIn("feed/home", response.headers["Location"])
+        return client.get("feed/api/home").get_json()["posts"]
+
+    def test_feed_is_fetched_at_login(self):
+        self.app.config[PREFETCH_AT_LOGIN_SETTING] = True
+        hits = feed.prefetched_timelines.hits
+        with FakeMastodonServer(name="prefetch.fake", timeline_size=5, latency=0.1) as server:
+            posts = self.log_in_and_load_feed(server)
+            self.assertEqual(5, len(posts))
+            # One for starting the client, one for the timeline. The feed waited for the prefetch rather than fetch
+            self.assertEqual(2, server.request_counts["/api/v1/timelines/home"])
+        self.assertEqual(hits + 1, feed.prefetched_timelines.hits)
+
+    def test_prefetching_is_off_by_default(self):
+        hits = feed.prefetched_timelines.hits
+        with FakeMastodonServer(name="prefetch.fake", timeline_size=5) as server:
+            self.assertEqual(5, len(self.log_in_and_load_feed(server)))
+            self.assertEqual(2, server.request_counts["/api/v1/timelines/home"])
+        self.assertEqual(hits, feed.prefetched_timelines.hits)
@@ -0,0 +1,111 @@
+import configparser
+import threading
+import time
+import unittest
+from pathlib import Path
+
+from werkzeug.security import generate_password_hash
+
+from benchmarks.fake_mastodon import FakeMastodonServer
+from feed_amalgamator import create_app, dbi
+from feed_amalgamator.constants.common_constants import USER_ID_FIELD
+from feed_amalgamator.constants.error_messages import TIMELINE_ALREADY_EXISTS_MSG
+from feed_amalgamator.helpers.db_interface import User, UserServer
+from feed_amalgamator.helpers.timeline_sources import SharedTimelineCache, build_timeline_name, is_shared_timeline
+
+
+class TestTimelineSources(unittest.TestCase):
+    def test_timeline_names(self):
+        self.assertEqual("tag/caturday", build_timeline_name("tag", " #CatURDay"))
+        self.assertEqual("list/42", build_timeline_name("list", "42"))
+        self.assertEqual("public", build_timeline_name("public", "ignored"))
+        self.assertIsNone(build_timeline_name("tag", "two words"))
+        self.assertIsNone(build_timeline_name("list", "../home"))
+        self.assertIsNone(build_timeline_name("notifications"))
+        self.assertTrue(is_shared_timeline("tag/caturday"))
+        self.assertFalse(is_shared_timeline("list/42"))
+
+    def test_concurrent_requests_share_one_fetch(self):
+        cache = SharedTimelineCache(max_entries=10, ttl=60.0, login_required_ttl=60.0)
+        fetches = []
+
+        def fetch():
+            fetches.append(1)
+            time.sleep(0.1)
+            return ["post"]
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get_or_fetch(("a.social", "public", 20),
+                                                                                     fetch)))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([["post"]] * 8, results)
+        self.assertEqual(1, len(fetches))
+
+        def failing_fetch():
+            raise ValueError("Unreachable")
+        with self.assertRaises(ValueError):
+            cache.get_or_fetch(("b.social", "public", 20), failing_fetch)
+        self.assertEqual(["post"], cache.get_or_fetch(("b.social", "public", 20), fetch))  # Failures are not kept
+
+
+class TestTimelinesPage(unittest.TestCase):
+    """Combines timelines of a local fake server, so no real Mastodon instance is needed"""
+
+    def setUp(self) -> None:
+        test_config_loc = Path("configuration/test_mastodon_client_info.ini")
+        parser = configparser.ConfigParser()
+        parser.read(test_config_loc)
+        self.app = create_app(db_file_name=parser["TEST_SETTINGS"]["test_db_location"])
+        self.app.config.update({"TESTING": True})
+        with self.app.app_context():
+            dbi.drop_all()
+            dbi.create_all()
+            for username in ("Meowmaster", "Woofmaster"):
+                dbi.session.add(User(username=username, password=generate_password_hash("Infinite4oid!")))
+            dbi.session.commit()
+
+    def login(self, user_id: int):
+        client = self.app.test_client()
+        with client.session_transaction() as sess:
+            sess[USER_ID_FIELD] = user_id
+        return client
+
+    def test_hashtag_timelines_are_shared(self):
+        with FakeMastodonServer(name="timelines.fake", timeline_size=5, reblog_ratio=0) as server:
+            with self.app.app_context():
+                for user_id in (1, 2):
+                    dbi.session.add(UserServer(user_id=user_id, server=server.base_url,
+                                               token="token{u}".format(u=user_id)))
+                dbi.session.commit()
+            clients = [self.login(1), self.login(2)]
+            self.assertEqual(5, len(clients[0].get("feed/api/home").get_json()["posts"]))
+
+            for client, user_server_id in zip(clients, (1, 2)):
+                client.post("feed/timelines", data={"user_server_id": user_server_id, "timeline_kind": "tag",
+                                                    "timeline_value": "#Caturday"})
+            clients[0].post("feed/timelines", data={"user_server_id": 1, "timeline_kind": "tag",
+                                                    "timeline_value": "caturday"})
+            page = clients[0].get("feed/timelines").data.decode("utf-8")
+            self.assertIn(TIMELINE_ALREADY_EXISTS_MSG, page)
+            self.assertIn("tag/caturday", page)
+
+            for client, user_id in zip(clients, (1, 2)):
+                contents = {post["content"] for post in client.get("feed/api/home").get_json()["posts"]}
+                # The home timeline stays in the feed alongside the hashtag
+                self.assertEqual(10, len(contents))
+                self.assertIn("<p>Post 0 of home on timelines.fake for token{u}</p>".format(u=user_id), contents)
+                self.assertIn("<p>Post 0 of tag/caturday on timelines.fake for </p>", contents)
+            self.assertEqual(1, server.request_counts["/api/v1/timelines/tag/caturday"])
+
+            # Users cannot add timelines of servers that are not theirs
+            clients[0].post("feed/timelines", data={"user_server_id": 2, "timeline_kind": "public"})
+            self.assertEqual(10, len(clients[0].get("feed/api/home").get_json()["posts"]))
+
+            home_timeline_id = 1
+            clients[0].post("feed/timelines", data={"timelines": [home_timeline_id]})
+            contents = {post["content"] for post in clients[0].get("feed/api/home").get_json()["posts"]}
+            self.assertEqual({"<p>Post {i} of tag/caturday on timelines.fake for </p>".format(i=i) for i in range(5)},
+                             contents)